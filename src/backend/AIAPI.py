@@ -1,10 +1,33 @@
 from openai import OpenAI # type: ignore
-from openai._exceptions import OpenAIError, RateLimitError # type: ignore
+from openai._exceptions import LengthFinishReasonError, OpenAIError, RateLimitError # type: ignore
 from pydantic import BaseModel, Field, ValidationError
+from typing import List
 import os
+import re
 import json
 import time
 import random
+import threading
+import contextlib
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from metrics import (API_BATCH_SPLITS, API_CALLS, API_RETRIES, API_SECONDS, RATE_LIMIT_WAIT_SECONDS,
+                     RATE_LIMIT_WAITS, log)
+
+# Default number of identification requests in flight at once
+DEFAULT_CONCURRENCY = int(os.environ.get('OPENAI_CONCURRENCY', '8'))
+
+# Default number of segment images identified per request (1 = one request per segment)
+DEFAULT_BATCH_SIZE = int(os.environ.get('OPENAI_BATCH_SIZE', '1'))
+
+# Most API keys whose HTTP client and rate limiter are kept; the least recently
+# used client is closed beyond that
+CLIENT_CACHE_SIZE = int(os.environ.get('OPENAI_CLIENT_CACHE_SIZE', '16'))
+
+
+class IncompleteResponseError(Exception):
+    """Raised when a structured answer is cut off or does not match the response format."""
 
 
 class BoardGame(BaseModel):
@@ -13,15 +36,221 @@ class BoardGame(BaseModel):
 class Response(BaseModel):
     boardGame: BoardGame
 
+class NumberedBoardGame(BaseModel):
+    image: int = Field(description="Number of the image, starting at 1")
+    name: str
+
+class BatchResponse(BaseModel):
+    boardGames: List[NumberedBoardGame]
+
+
+def match_batch_response(batch_response, count):
+    """
+    Maps the games of a batched answer back to the images of the request.
+
+    Args:
+        batch_response (BatchResponse): Parsed answer
+        count (int): Number of images in the request
+
+    Returns:
+        list: One game name per image in request order, or None if any image
+            is missing, numbered twice or out of range, or has an empty name
+    """
+    names = {}
+    for game in batch_response.boardGames:
+        if not 1 <= game.image <= count or game.image in names or not game.name.strip():
+            return None
+        names[game.image] = game.name.strip()
+    if len(names) != count:
+        return None
+    return [names[number] for number in range(1, count + 1)]
+
+
+def parse_reset_duration(value):
+    """
+    Parses the reset durations used by the OpenAI rate limit headers (e.g. "1s", "6m0s", "20ms").
+
+    Args:
+        value (str): Duration string
+
+    Returns:
+        float: Duration in seconds, or None if the value cannot be parsed
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(amount) * units[unit] for amount, unit in parts)
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every request made with the same API key.
+
+    The bucket starts unlimited and is sized from the x-ratelimit-* response
+    headers once the first response arrives. When the server reports that
+    requests or tokens are exhausted (or answers 429), all callers wait for the
+    reported reset time instead of each sleeping on its own backoff.
+    """
+
+    def __init__(self):
+        self.rate = None          # Requests per second, None until known
+        self.capacity = None
+        self.tokens = None
+        self.blocked_until = 0.0
+        self.updated_at = time.monotonic()
+        self.condition = threading.Condition()
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+
+        Returns:
+            float: Seconds spent waiting
+        """
+        started = time.monotonic()
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                elif self.rate is None or self.tokens >= 1:
+                    if self.rate is not None:
+                        self.tokens -= 1
+                    return time.monotonic() - started
+                else:
+                    wait = (1 - self.tokens) / self.rate
+
+                self.condition.wait(wait)
+
+    def update(self, headers):
+        """
+        Updates the bucket from the rate limit headers of a response.
+
+        Args:
+            headers (Mapping): HTTP response headers
+        """
+        limit = headers.get('x-ratelimit-limit-requests')
+        remaining = headers.get('x-ratelimit-remaining-requests')
+        remaining_tokens = headers.get('x-ratelimit-remaining-tokens')
+
+        with self.condition:
+            now = time.monotonic()
+            self._refill(now)
+
+            if limit:
+                # Limits are reported per minute
+                self.capacity = max(1, int(limit))
+                self.rate = self.capacity / 60.0
+                if self.tokens is None:
+                    self.tokens = float(self.capacity)
+            if remaining is not None and self.rate is not None:
+                self.tokens = min(self.tokens, float(remaining))
+
+            if remaining == '0':
+                self._block(now, parse_reset_duration(headers.get('x-ratelimit-reset-requests')))
+            if remaining_tokens == '0':
+                self._block(now, parse_reset_duration(headers.get('x-ratelimit-reset-tokens')))
+
+            self.condition.notify_all()
+
+    def back_off(self, seconds):
+        """
+        Blocks every caller for the given number of seconds (e.g. after a 429).
+        """
+        with self.condition:
+            self._block(time.monotonic(), seconds)
+
+    def _block(self, now, seconds):
+        if seconds:
+            self.blocked_until = max(self.blocked_until, now + seconds)
+
+
+class PooledClient:
+    """
+    HTTP client and rate limiter of one API key, shared across requests.
+    """
+
+    def __init__(self, api_key):
+        base_url = os.environ.get('OPENAI_BASE_URL') or None
+        # Retries are left to _complete, so a 429 pauses every request on the key
+        self.client = OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+        self.rate_limiter = RateLimiter()
+        self.users = 0          # Requests currently using the client
+        self.evicted = False
+
+
+# Pooled clients by API key, least recently used first
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def lease_client(api_key):
+    """
+    Lends out the pooled OpenAI client and rate limiter for an API key.
+
+    Beyond CLIENT_CACHE_SIZE keys, the least recently used client is evicted
+    and closed as soon as no request is using it any more.
+
+    Args:
+        api_key (str): OpenAI API key
+
+    Yields:
+        tuple: (OpenAI client, RateLimiter)
+    """
+    idle = []
+    with _clients_lock:
+        pooled = _clients.pop(api_key, None) or PooledClient(api_key)
+        _clients[api_key] = pooled
+        pooled.users += 1
+        while len(_clients) > max(1, CLIENT_CACHE_SIZE):
+            _, evicted = _clients.popitem(last=False)
+            evicted.evicted = True
+            if evicted.users == 0:
+                idle.append(evicted)
+    for evicted in idle:
+        evicted.client.close()
+
+    try:
+        yield pooled.client, pooled.rate_limiter
+    finally:
+        with _clients_lock:
+            pooled.users -= 1
+            close = pooled.evicted and pooled.users == 0
+        if close:
+            pooled.client.close()
+
+
 class AIAPI:
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, concurrency=DEFAULT_CONCURRENCY, batch_size=DEFAULT_BATCH_SIZE, client=None):
         # Use provided API key if available, otherwise fall back to environment variable
-        if api_key:
-            self.client = OpenAI(api_key=api_key)
-        else:
+        if not api_key:
             # Try to get from environment, with a fallback empty string to avoid errors
-            env_api_key = os.environ.get('OPENAI_API_KEY', '')
-            self.client = OpenAI(api_key=env_api_key)
+            api_key = os.environ.get('OPENAI_API_KEY', '')
+        self.api_key = api_key
+        self.client = client    # (OpenAI client, RateLimiter) to use instead of the pooled one
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+
+    def _lease(self):
+        if self.client is not None:
+            return contextlib.nullcontext(self.client)
+        return lease_client(self.api_key)
 
     def getAPIResponse(self, gameImg, model = "gpt-4o-mini", max_retries=500, initial_backoff=1):
         messages = [
@@ -47,53 +276,199 @@ class AIAPI:
             }
         ]
 
+        try:
+            responseMessage = self._complete(messages, Response, model, max_retries, initial_backoff)
+        except IncompleteResponseError:
+            return None
+        if responseMessage is None or not responseMessage.parsed:
+            return None
+        return responseMessage.content
+
+    def getBatchAPIResponse(self, gameImgs, model = "gpt-4o-mini", max_retries=500, initial_backoff=1):
+        """
+        Identifies several segment images with a single request whose structured
+        answer lists one game per image number. If the answer misses, repeats or
+        misnumbers an image (or is refused), the batch is split in two halves
+        that are tried again, down to single-image requests.
+
+        Args:
+            gameImgs (list): Base64 encoded segment images
+            model (str): Model to use
+            max_retries (int): Maximum rate limit retries per request
+            initial_backoff (float): Backoff used when the server gives no reset time
+
+        Returns:
+            list: One response per image in the format of getAPIResponse (JSON
+                content of a Response, or None)
+        """
+        if len(gameImgs) == 1:
+            return [self.getAPIResponse(gameImgs[0], model, max_retries, initial_backoff)]
+
+        content = []
+        for number, gameImg in enumerate(gameImgs, start=1):
+            content.append({"type": "text", "text": f"Image {number}:"})
+            content.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{gameImg}"}})
+        messages = [
+            {
+                "role": "system",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": f"1. You are given {len(gameImgs)} numbered images, each of a board game "
+                                "2. Identify the board game in every image "
+                                "3. Answer with exactly one entry per image, using the image's number"
+                    }
+                ]
+            },
+            {
+                "role": "user",
+                "content": content
+            }
+        ]
+
+        try:
+            responseMessage = self._complete(messages, BatchResponse, model, max_retries, initial_backoff)
+        except IncompleteResponseError:
+            names = None
+        else:
+            if responseMessage is None:
+                # The request itself failed (e.g. no balance); splitting would not help
+                return [None] * len(gameImgs)
+            names = match_batch_response(responseMessage.parsed, len(gameImgs)) if responseMessage.parsed else None
+
+        if names is not None:
+            return [json.dumps({"boardGame": {"name": name}}) for name in names]
+
+        API_BATCH_SPLITS.inc()
+        log("Incomplete batched identification, splitting the batch", images=len(gameImgs))
+        middle = len(gameImgs) // 2
+        return (self.getBatchAPIResponse(gameImgs[:middle], model, max_retries, initial_backoff) +
+                self.getBatchAPIResponse(gameImgs[middle:], model, max_retries, initial_backoff))
+
+    def _complete(self, messages, response_format, model, max_retries, initial_backoff):
+        """
+        Sends a structured output request, waiting for the shared rate limiter
+        and retrying rate limit errors.
+
+        Returns:
+            The completion message (whose parsed field is None if the model
+            refused), or None if the request failed
+
+        Raises:
+            IncompleteResponseError: If the answer was cut off or does not match
+                the response format
+        """
+        with self._lease() as (client, rate_limiter):
+            return self._complete_with(client, rate_limiter, messages, response_format, model, max_retries,
+                                       initial_backoff)
+
+    def _complete_with(self, client, rate_limiter, messages, response_format, model, max_retries,
+                       initial_backoff):
         # Initialize retry counter and backoff time
         retries = 0
         backoff = initial_backoff
 
         while retries <= max_retries:
             try:
-                completion = self.client.beta.chat.completions.parse(
-                    model=model,
-                    messages=messages,
-                    response_format=Response
-                )
+                # Wait for the shared rate limiter instead of sleeping per call
+                waited = rate_limiter.acquire()
+                if waited > 0.001:
+                    RATE_LIMIT_WAITS.inc()
+                    RATE_LIMIT_WAIT_SECONDS.inc(waited)
+                with API_SECONDS.time():
+                    raw_response = client.beta.chat.completions.with_raw_response.parse(
+                        model=model,
+                        messages=messages,
+                        response_format=response_format
+                    )
+                rate_limiter.update(raw_response.headers)
+                completion = raw_response.parse()
 
                 responseMessage = completion.choices[0].message
                 if responseMessage.parsed:
-                    return completion.choices[0].message.content
+                    API_CALLS.inc(outcome="ok")
                 # Refusal comes from not wanting to match the response format
                 else:
-                    print(f"Refused Response : \n{responseMessage.refusal}")
-                    return None
+                    API_CALLS.inc(outcome="refused")
+                    log("Refused response", refusal=responseMessage.refusal)
+                return responseMessage
+
+            except (LengthFinishReasonError, ValidationError) as e:
+                API_CALLS.inc(outcome="invalid")
+                log("Invalid structured response", error=str(e))
+                raise IncompleteResponseError(str(e)) from e
 
             except RateLimitError as e:
-                # Handle rate limit errors with exponential backoff
+                # Handle rate limit errors by pausing every request on this key
+                API_CALLS.inc(outcome="rate_limited")
                 retries += 1
                 if retries > max_retries:
-                    print(f"Maximum retries ({max_retries}) exceeded. Check OpenAI balance: {e}")
+                    log("Maximum retries exceeded, check OpenAI balance", max_retries=max_retries, error=str(e))
                     return None
-                
-                # Calculate backoff time with jitter to avoid thundering herd problem
-                jitter = random.uniform(0, 0.1 * backoff)
-                sleep_time = backoff + jitter
-                
-                print(f"Rate limit exceeded. Retrying in {sleep_time:.2f} seconds (attempt {retries}/{max_retries})...")
-                time.sleep(sleep_time)
-                
-                # Exponential backoff: double the wait time for next attempt
-                backoff *= 2
-                
+                API_RETRIES.inc()
+
+                # Prefer the server's reset time, fall back to exponential backoff with jitter
+                headers = e.response.headers if e.response is not None else {}
+                wait_time = parse_reset_duration(headers.get('retry-after')) or \
+                    parse_reset_duration(headers.get('x-ratelimit-reset-requests'))
+                if not wait_time:
+                    wait_time = backoff + random.uniform(0, 0.1 * backoff)
+                    # Exponential backoff: double the wait time for next attempt
+                    backoff *= 2
+
+                log("Rate limit exceeded, retrying", wait_seconds=round(wait_time, 2),
+                    attempt=retries, max_retries=max_retries)
+                rate_limiter.update(headers)
+                rate_limiter.back_off(wait_time)
+
             except OpenAIError as e:
                 # Handle other OpenAI errors
-                print(f"OpenAI API error: {e}")
+                API_CALLS.inc(outcome="error")
+                log("OpenAI API error", error=str(e))
                 return None
-                
+
             except Exception as e:
                 # Handle other potential errors
-                print(f"An unexpected error occurred: {e}")
+                API_CALLS.inc(outcome="error")
+                log("Unexpected error calling OpenAI", error=str(e))
                 return None
 
+    def getAPIResponses(self, gameImgs, model = "gpt-4o-mini", max_retries=500, initial_backoff=1, batch_size=None):
+        """
+        Identifies several segment images concurrently, up to self.concurrency
+        requests in flight, all sharing the API key's rate limiter. With a
+        batch size above 1, each request covers up to batch_size images (see
+        getBatchAPIResponse).
+
+        Args:
+            gameImgs (list): Base64 encoded segment images
+            model (str): Model to use
+            max_retries (int): Maximum rate limit retries per request
+            initial_backoff (float): Backoff used when the server gives no reset time
+            batch_size (int): Images per request, self.batch_size if None
+
+        Yields:
+            tuple: (index, response) in completion order, where response is the
+                JSON content returned by getAPIResponse (or None)
+        """
+        if not gameImgs:
+            return
+
+        batch_size = max(1, batch_size or self.batch_size)
+        batches = [list(range(start, min(start + batch_size, len(gameImgs))))
+                   for start in range(0, len(gameImgs), batch_size)]
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.concurrency, len(batches)))) as executor:
+            # Each request runs in a copy of the caller's context to keep its trace ID
+            futures = {
+                executor.submit(contextvars.copy_context().run, self.getBatchAPIResponse,
+                                [gameImgs[index] for index in batch], model, max_retries, initial_backoff): batch
+                for batch in batches
+            }
+            for future in as_completed(futures):
+                for index, response in zip(futures[future], future.result()):
+                    yield index, response
+
     def parse_api_response(self, json_str: str) -> Response:
         try:
             # Load JSON string into a Python dictionary
@@ -103,5 +478,5 @@ class AIAPI:
             api_response = Response.model_validate(data)
             return api_response
         except ValidationError as e:
-            print("Validation Error:", e)
+            log("Invalid API response", error=str(e))
             raise
@@ -0,0 +1,426 @@
+"""
+Per-stage benchmark of the recognition pipeline.
+
+Runs each stage on its own against a fixed corpus (the frontend example
+images plus synthetic shelf images with known box layouts) and records wall
+time, peak RSS, mask memory and mask/segment counts per stage:
+
+    ingest          decode and downscale the upload (ingest_image)
+    sam             raw SAM masks for the working image (generate_masks)
+    overlap_filter  area, overlap and envelope filters (filter_masks)
+    text_filter     segment crops and batched OCR (crop_segment, find_text_segments)
+    identify        concurrent identification through AIAPI with a stubbed OpenAI client
+
+Stages that are not selected are replaced by fixed inputs: without the sam
+stage, the overlap filter runs on masks built from the synthetic layouts.
+
+Mask memory is the size of the compact masks (mask_store.CompactMask) an
+image holds after the stage; the largest per stage is reported as its peak.
+Set MASK_MEMORY_BUDGET_MB to benchmark a tighter per-request budget.
+
+Usage:
+    python benchmark.py run --output before.json
+    python benchmark.py run --stages ingest,overlap_filter --profile fast --output after.json
+    python benchmark.py compare before.json after.json
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+import types
+
+import numpy as np # type: ignore
+import cv2 # type: ignore
+
+os.environ.setdefault('MODEL_LOADING', 'lazy')
+
+from AIAPI import AIAPI, RateLimiter
+from ingest import ingest_image
+from main import OCR_BATCH_SIZE, OCR_CANVAS_SIZE, OCR_MODE, SEGMENTATION_SETTINGS, filter_masks, generate_masks
+from mask_store import CompactMask
+from models import models
+from profiles import PROFILE_NAMES
+from text_filter import crop_segment, find_text_segments
+
+STAGES = ("ingest", "sam", "overlap_filter", "text_filter", "identify")
+EXAMPLE_IMAGE_DIR = os.path.join(os.path.dirname(__file__), '..', 'frontend', 'assets', 'images', 'examples')
+
+
+class RssSampler:
+    """
+    Samples the resident set size in a background thread to find the peak
+    RSS while a stage runs (ru_maxrss only gives the peak of the whole process).
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def current_rss():
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError):
+            # No procfs (macOS): fall back to the process-wide peak
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.current_rss())
+
+    def __enter__(self):
+        self.start_rss = self.peak = self.current_rss()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.current_rss())
+        return False
+
+
+def synthetic_shelf(seed, size=(1536, 2048), shelves=3):
+    """
+    Draws a shelf image with known game box positions.
+
+    Args:
+        seed (int): Random seed; the same seed always gives the same image
+        size (tuple): (height, width) of the image
+        shelves (int): Number of shelves
+
+    Returns:
+        tuple: (image, boxes) with a BGR image and the XYXY boxes of the games
+    """
+    rng = np.random.RandomState(seed)
+    height, width = size
+    image = np.full((height, width, 3), 210, dtype=np.uint8)
+    boxes = []
+
+    shelf_height = height // shelves
+    for shelf in range(shelves):
+        bottom = (shelf + 1) * shelf_height - 20
+        cv2.rectangle(image, (0, bottom), (width - 1, bottom + 18), (40, 60, 90), -1)
+
+        x = 12
+        while True:
+            box_width = int(rng.randint(width // 20, width // 7))
+            if x + box_width >= width - 12:
+                break
+            box_height = int(rng.randint(shelf_height // 2, shelf_height - 40))
+            color = tuple(int(c) for c in rng.randint(20, 235, 3))
+            top = bottom - box_height
+            cv2.rectangle(image, (x, top), (x + box_width, bottom), color, -1)
+
+            # A title in contrasting color so the text filter has something to find
+            ink = (255, 255, 255) if sum(color) < 380 else (0, 0, 0)
+            scale = box_width / 160
+            cv2.putText(image, f"GAME {len(boxes) + 1}", (x + 6, top + box_height // 2),
+                        cv2.FONT_HERSHEY_SIMPLEX, scale, ink, max(1, int(scale * 2)), cv2.LINE_AA)
+
+            boxes.append((x, top, x + box_width, bottom))
+            x += box_width + int(rng.randint(2, 10))
+
+    return image, boxes
+
+
+def layout_masks(boxes, source_size, working_size, seed):
+    """
+    Builds raw mask records like SAM's for a synthetic layout: one mask per box,
+    plus near duplicates, subsections and merged neighbours for the filters to remove.
+
+    Args:
+        boxes (list): XYXY game boxes in source image coordinates
+        source_size (tuple): (height, width) of the source image
+        working_size (tuple): (height, width) of the working image
+        seed (int): Random seed
+
+    Returns:
+        list: Mask records with segmentation (a CompactMask), area, bbox and stability_score
+    """
+    rng = np.random.RandomState(seed)
+    scale_y, scale_x = working_size[0] / source_size[0], working_size[1] / source_size[1]
+
+    def record(x0, y0, x1, y1, stability):
+        top, left = int(y0 * scale_y), int(x0 * scale_x)
+        box = np.ones((int(y1 * scale_y) - top, int(x1 * scale_x) - left), dtype=bool)
+        mask = CompactMask.from_crop(box, (top, left), working_size)
+        return {"segmentation": mask, "area": mask.area, "stability_score": float(stability),
+                "bbox": [int(x0 * scale_x), int(y0 * scale_y), int((x1 - x0) * scale_x), int((y1 - y0) * scale_y)]}
+
+    masks = []
+    for index, (x0, y0, x1, y1) in enumerate(boxes):
+        masks.append(record(x0, y0, x1, y1, rng.uniform(0.95, 0.99)))
+        masks.append(record(x0 + 3, y0 + 3, x1 - 3, y1 - 3, rng.uniform(0.94, 0.98)))   # Near duplicate
+        masks.append(record(x0, y0, x1, (y0 + y1) // 2, rng.uniform(0.94, 0.97)))       # Subsection
+        if index + 1 < len(boxes) and boxes[index + 1][3] == y1:                         # Merged neighbours
+            masks.append(record(x0, min(y0, boxes[index + 1][1]), boxes[index + 1][2], y1, rng.uniform(0.94, 0.96)))
+    return masks
+
+
+def load_corpus(example_dir, synthetic_count):
+    """
+    Loads the benchmark corpus.
+
+    Args:
+        example_dir (str): Directory with example images
+        synthetic_count (int): Number of synthetic shelf images
+
+    Returns:
+        list: Dicts with name, data (encoded image bytes) and boxes (None for example images)
+    """
+    corpus = []
+    if os.path.isdir(example_dir):
+        for name in sorted(os.listdir(example_dir)):
+            if name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                with open(os.path.join(example_dir, name), 'rb') as f:
+                    corpus.append({"name": name, "data": f.read(), "boxes": None})
+
+    for seed in range(synthetic_count):
+        image, boxes = synthetic_shelf(seed)
+        _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, 92])
+        corpus.append({"name": f"synthetic_{seed}.jpg", "data": buffer.tobytes(), "boxes": boxes,
+                       "size": image.shape[:2]})
+    return corpus
+
+
+def stub_ai(latency):
+    """
+    Builds an AIAPI whose OpenAI client answers every request after a fixed
+    latency with a valid structured response, without any network access.
+
+    Args:
+        latency (float): Seconds per request
+
+    Returns:
+        AIAPI: Client with the stubbed OpenAI client and its own rate limiter
+    """
+    def parse(model, messages, response_format):
+        time.sleep(latency)
+        content = json.dumps({"boardGame": {"name": "Benchmark Game"}})
+        message = types.SimpleNamespace(content=content, parsed=True, refusal=None)
+        completion = types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+        return types.SimpleNamespace(headers={}, parse=lambda: completion)
+
+    client = types.SimpleNamespace(beta=types.SimpleNamespace(chat=types.SimpleNamespace(
+        completions=types.SimpleNamespace(with_raw_response=types.SimpleNamespace(parse=parse)))))
+
+    return AIAPI(api_key="benchmark", client=(client, RateLimiter()))
+
+
+def mask_mb(masks):
+    return sum(mask["segmentation"].nbytes for mask in masks) / 2 ** 20
+
+
+def run_stage(results, stage, corpus, fn):
+    """
+    Runs one stage over the corpus and records its timings, counts and peak RSS.
+
+    Args:
+        results (dict): Results to add the stage to
+        stage (str): Stage name
+        corpus (list): Corpus entries
+        fn (callable): Called with a corpus entry, returns a dict of counts
+    """
+    images = {}
+    with RssSampler() as rss:
+        start = time.perf_counter()
+        for entry in corpus:
+            image_start = time.perf_counter()
+            counts = fn(entry)
+            images[entry["name"]] = {"seconds": time.perf_counter() - image_start, **counts}
+        total = time.perf_counter() - start
+
+    results["stages"][stage] = {
+        "seconds": total,
+        "peak_rss_mb": rss.peak / 2 ** 20,
+        "rss_growth_mb": (rss.peak - rss.start_rss) / 2 ** 20,
+        "images": images
+    }
+    summary = f"{stage:>15}: {total:8.3f}s, peak RSS {rss.peak / 2 ** 20:8.1f} MB"
+    mask_peaks = [counts["mask_mb"] for counts in images.values() if "mask_mb" in counts]
+    if mask_peaks:
+        results["stages"][stage]["peak_mask_mb"] = max(mask_peaks)
+        summary += f", peak mask memory {max(mask_peaks):6.2f} MB"
+    print(summary)
+
+
+def run(args):
+    stages = args.stages.split(',') if args.stages else list(STAGES)
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        print(f"Unknown stages {unknown}, expected some of {list(STAGES)}")
+        return 1
+
+    corpus = load_corpus(args.examples, args.synthetic)
+    results = {
+        "meta": {
+            "created_at": time.time(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "profile": args.profile,
+            "ocr_mode": OCR_MODE,
+            "corpus": [entry["name"] for entry in corpus]
+        },
+        "stages": {}
+    }
+
+    # Every entry carries its intermediate results so later stages can run without earlier ones
+    for entry in corpus:
+        ingested = ingest_image(entry["data"], max_size=SEGMENTATION_SETTINGS['max_size'],
+                                detail_max_size=SEGMENTATION_SETTINGS['detail_max_size'])
+        entry["ingested"] = ingested
+        entry["masks"] = None
+        if entry["boxes"] is not None:
+            entry["masks"] = layout_masks(entry["boxes"], entry["size"], ingested.working.shape[:2], seed=len(entry["boxes"]))
+
+    if "ingest" in stages:
+        def ingest(entry):
+            ingested = ingest_image(entry["data"], max_size=SEGMENTATION_SETTINGS['max_size'],
+                                    detail_max_size=SEGMENTATION_SETTINGS['detail_max_size'])
+            return {"working_pixels": int(ingested.working.shape[0] * ingested.working.shape[1])}
+        run_stage(results, "ingest", corpus, ingest)
+
+    if "sam" in stages or "text_filter" in stages:
+        # Model loading is reported on its own, not as part of the first image
+        start = time.perf_counter()
+        models.load_all()
+        results["meta"]["model_load_seconds"] = time.perf_counter() - start
+        results["meta"]["models"] = models.status()
+
+    if "sam" in stages:
+        def sam(entry):
+            entry["masks"] = generate_masks(entry["ingested"].working, args.profile)
+            return {"masks": len(entry["masks"]), "mask_mb": mask_mb(entry["masks"])}
+        run_stage(results, "sam", corpus, sam)
+
+    # The remaining stages run on the entries that have masks
+    corpus = [entry for entry in corpus if entry["masks"] is not None]
+
+    if "overlap_filter" in stages:
+        def overlap_filter(entry):
+            entry["filtered"] = filter_masks(entry["masks"])
+            counts = {"masks": len(entry["masks"]), "kept": len(entry["filtered"]),
+                      "mask_mb": mask_mb(entry["masks"])}
+            if entry["boxes"] is not None:
+                counts["layout_boxes"] = len(entry["boxes"])
+            return counts
+        run_stage(results, "overlap_filter", corpus, overlap_filter)
+
+    for entry in corpus:
+        if "filtered" not in entry:
+            entry["filtered"] = filter_masks(entry["masks"])
+        image = entry["ingested"].image
+        entry["crops"] = []
+        for mask in entry["filtered"]:
+            segmentation = mask["segmentation"]
+            crop, _ = crop_segment(image, segmentation.crop(), segmentation.bbox, segmentation.shape)
+            if crop is not None:
+                entry["crops"].append(crop)
+
+    if "text_filter" in stages:
+        reader = models.get("ocr")
+
+        def text_filter(entry):
+            confidences = find_text_segments(reader, entry["crops"], mode=OCR_MODE,
+                                             canvas_size=OCR_CANVAS_SIZE, batch_size=OCR_BATCH_SIZE)
+            entry["crops"] = [crop for crop, confidence in zip(entry["crops"], confidences) if confidence is not None]
+            return {"segments": len(confidences), "with_text": len(entry["crops"])}
+        run_stage(results, "text_filter", corpus, text_filter)
+
+    if "identify" in stages:
+        ai = stub_ai(args.stub_latency)
+
+        def identify(entry):
+            images = [base64.b64encode(cv2.imencode('.png', crop)[1]).decode('utf-8') for crop in entry["crops"]]
+            responses = [response for _, response in ai.getAPIResponses(images, max_retries=0)]
+            return {"requests": len(images), "identified": sum(1 for response in responses if response)}
+        run_stage(results, "identify", corpus, identify)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved results to {args.output}")
+    return 0
+
+
+def compare(args):
+    """
+    Compares two result files stage by stage and flags regressions: a stage
+    that got slower or used more memory than the tolerance allows, or whose
+    mask/segment counts changed.
+    """
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    regressions = []
+    print(f"{'stage':>15} {'baseline s':>11} {'candidate s':>11} {'change':>8} {'peak MB':>16}")
+    for stage in STAGES:
+        if stage not in baseline["stages"] or stage not in candidate["stages"]:
+            continue
+        before, after = baseline["stages"][stage], candidate["stages"][stage]
+        change = after["seconds"] / before["seconds"] - 1 if before["seconds"] else 0.0
+        print(f"{stage:>15} {before['seconds']:11.3f} {after['seconds']:11.3f} {change:+8.1%} "
+              f"{before['peak_rss_mb']:7.1f} -> {after['peak_rss_mb']:6.1f}")
+
+        if change > args.tolerance and after["seconds"] - before["seconds"] > args.min_seconds:
+            regressions.append(f"{stage}: {change:+.1%} wall time")
+        if after["peak_rss_mb"] > before["peak_rss_mb"] * (1 + args.tolerance):
+            regressions.append(f"{stage}: peak RSS {before['peak_rss_mb']:.1f} -> {after['peak_rss_mb']:.1f} MB")
+
+        for name, counts in after["images"].items():
+            reference = before["images"].get(name)
+            if reference is None:
+                continue
+            changed = {key: (reference[key], value) for key, value in counts.items()
+                       if key != "seconds" and reference.get(key) != value}
+            if changed:
+                regressions.append(f"{stage}: counts changed for {name}: {changed}")
+
+    if regressions:
+        print("Regressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print("No regressions")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="Run the benchmark")
+    run_parser.add_argument('--stages', help=f"Comma-separated stages (default: all of {','.join(STAGES)})")
+    run_parser.add_argument('--profile', choices=[name for name in PROFILE_NAMES if name != "auto"], default='accurate',
+                            help="Segmentation profile for the sam stage")
+    run_parser.add_argument('--examples', default=EXAMPLE_IMAGE_DIR, help="Directory of example images")
+    run_parser.add_argument('--synthetic', type=int, default=4, help="Number of synthetic shelf images")
+    run_parser.add_argument('--stub-latency', type=float, default=0.2, help="Seconds per stubbed OpenAI request")
+    run_parser.add_argument('--output', default='benchmark_results.json')
+
+    compare_parser = commands.add_parser("compare", help="Compare two result files")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('candidate')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1, help="Allowed relative increase")
+    compare_parser.add_argument('--min-seconds', type=float, default=0.05,
+                                help="Ignore slowdowns smaller than this many seconds")
+
+    args = parser.parse_args()
+    return run(args) if args.command == "run" else compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
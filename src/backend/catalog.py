@@ -0,0 +1,190 @@
+import csv
+import json
+import os
+
+import numpy as np # type: ignore
+
+from collection import normalize_title
+
+CATALOG_SETTINGS = {
+    # CSV (with a "name" or "title" column) or JSON (a list of names, or of
+    # objects with a "name" or "title") of known board game titles; no catalog if unset
+    "path": os.environ.get('TITLE_CATALOG_PATH'),
+    # Least score (shared trigrams over the title's trigrams plus a share of
+    # the text's unmatched trigrams) for a match
+    "min_score": float(os.environ.get('TITLE_CATALOG_MIN_SCORE', '0.8')),
+    # Weight of each trigram of the text that is not part of the title
+    "unmatched_weight": float(os.environ.get('TITLE_CATALOG_UNMATCHED_WEIGHT', '0.25')),
+    # Least trigrams a title must share with the text, so a single short word
+    # of box text is never enough
+    "min_shared": int(os.environ.get('TITLE_CATALOG_MIN_SHARED', '5')),
+    # A match is ambiguous if the runner-up (a different title) comes within
+    # this share of its shared trigrams and its score
+    "min_margin": float(os.environ.get('TITLE_CATALOG_MIN_MARGIN', '0.05')),
+    # Shorter titles (after normalization) match too much stray text to be trusted
+    "min_title_length": 4
+}
+
+_NAME_FIELDS = ("name", "title", "primary_name")
+
+
+def trigrams(text):
+    """
+    Returns the set of character trigrams of normalized text (see
+    collection.normalize_title), padded with a space on both sides so word
+    starts and ends count as well.
+    """
+    padded = f" {text} "
+    return {padded[start:start + 3] for start in range(len(padded) - 2)}
+
+
+def read_titles(path):
+    """
+    Reads the game titles of a catalog dump.
+
+    Args:
+        path (str): CSV file with a name/title column (the first column if
+            there is none), or JSON file with a list of names or of objects
+            with a name/title
+
+    Returns:
+        list: Titles in file order
+    """
+    if path.lower().endswith(".json"):
+        with open(path, encoding="utf-8") as f:
+            entries = json.load(f)
+        if isinstance(entries, dict):
+            entries = entries.get("games", entries.get("titles", []))
+        titles = []
+        for entry in entries:
+            if isinstance(entry, dict):
+                entry = next((entry[field] for field in _NAME_FIELDS if entry.get(field)), None)
+            if isinstance(entry, str):
+                titles.append(entry)
+        return titles
+
+    with open(path, encoding="utf-8", newline="") as f:
+        rows = list(csv.reader(f))
+    if not rows:
+        return []
+    header = [cell.strip().lower() for cell in rows[0]]
+    column = next((header.index(field) for field in _NAME_FIELDS if field in header), None)
+    if column is None:
+        # No header, the titles are in the first column
+        column, header_rows = 0, 0
+    else:
+        header_rows = 1
+    return [row[column] for row in rows[header_rows:] if len(row) > column and row[column].strip()]
+
+
+class TitleCatalog:
+    """
+    Local catalog of board game titles with a trigram index for matching the
+    OCR text of segments.
+
+    A title is a candidate when each of its words occurs as a whole word of
+    the OCR text and it shares at least min_shared trigrams with it. Its score
+    is the share of its trigrams found in the text, with each of the text's
+    other trigrams weighing unmatched_weight in the denominator: box text also
+    holds subtitles, publishers and player counts, so some extra text is
+    allowed, but a short title is not matched from a long unrelated line that
+    merely contains it. The candidate sharing the most trigrams with the text
+    wins, so a longer title that is present beats a short one it contains,
+    unless another candidate comes close. Each trigram keeps a posting list of
+    its titles, so a lookup only adds up the postings of the text's trigrams
+    in one bincount.
+    """
+
+    def __init__(self, titles, min_score=0.8, min_margin=0.05, min_title_length=4,
+                 unmatched_weight=0.25, min_shared=5):
+        """
+        Args:
+            titles (list): Game titles; of titles that normalize to the same
+                text, the first is kept
+            min_score (float): Least score for a match
+            min_margin (float): Lead in shared trigrams and score over the runner-up
+                needed to match
+            min_title_length (int): Shorter normalized titles are never matched
+            unmatched_weight (float): Weight of the text's trigrams that are not
+                part of the title
+            min_shared (int): Least trigrams a title must share with the text
+        """
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.unmatched_weight = unmatched_weight
+        self.min_shared = min_shared
+        self.titles = []
+        self._words = []
+
+        postings = {}
+        sizes = []
+        seen = set()
+        for title in titles:
+            normalized = normalize_title(title)
+            if len(normalized) < min_title_length or normalized in seen:
+                continue
+            seen.add(normalized)
+            title_id = len(self.titles)
+            self.titles.append(title.strip())
+            self._words.append(frozenset(normalized.split()))
+            grams = trigrams(normalized)
+            sizes.append(len(grams))
+            for gram in grams:
+                postings.setdefault(gram, []).append(title_id)
+
+        self._sizes = np.array(sizes, dtype=np.int32)
+        self._postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()}
+
+    def __len__(self):
+        return len(self.titles)
+
+    @classmethod
+    def load(cls, settings=CATALOG_SETTINGS):
+        """
+        Builds the catalog from the dump at settings["path"].
+
+        Returns:
+            TitleCatalog: The catalog, or None if no path is configured
+        """
+        if not settings["path"]:
+            return None
+        return cls(read_titles(settings["path"]), settings["min_score"], settings["min_margin"],
+                   settings["min_title_length"], settings["unmatched_weight"], settings["min_shared"])
+
+    def match(self, text):
+        """
+        Finds the title a segment's OCR text names.
+
+        Args:
+            text (str): Recognized text of the segment
+
+        Returns:
+            tuple: (title, score) of a confident match, or (None, score of the
+                best candidate) if there is none
+        """
+        normalized = normalize_title(text or "")
+        grams = trigrams(normalized)
+        postings = [self._postings[gram] for gram in grams if gram in self._postings]
+        if not postings:
+            return None, 0.0
+
+        shared = np.bincount(np.concatenate(postings), minlength=len(self.titles))
+        unmatched = len(grams) - shared
+        scores = shared / (self._sizes + self.unmatched_weight * unmatched)
+        words = set(normalized.split())
+        candidates = [title_id for title_id in np.flatnonzero((scores >= self.min_score) &
+                                                              (shared >= self.min_shared))
+                      if self._words[title_id] <= words]
+        if not candidates:
+            return None, float(scores.max())
+
+        order = sorted(candidates, key=lambda title_id: (shared[title_id], scores[title_id]), reverse=True)
+        best = order[0]
+        score = float(scores[best])
+        if len(order) > 1:
+            runner_up = order[1]
+            if (shared[runner_up] >= (1 - self.min_margin) * shared[best] and
+                    scores[runner_up] >= score - self.min_margin):
+                return None, score
+
+        return self.titles[best], score
@@ -0,0 +1,116 @@
+"""
+Checks the CPU inference profile against float32 SAM on sample images.
+
+Runs the automatic mask generator with the float32 model and with the
+profile (int8 or bf16 image encoder, optionally compiled), matches every
+float32 mask to its best profile mask by IoU and reports the accuracy and
+the speedup. Exits with status 1 if the profile is below the thresholds.
+
+Usage:
+    python check_cpu_profile.py --precision int8 ../frontend/assets/images/examples
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np # type: ignore
+
+os.environ.setdefault('MODEL_LOADING', 'lazy')
+
+from segment_anything import SamAutomaticMaskGenerator # type: ignore
+from ingest import ingest_image
+from main import SEGMENTATION_SETTINGS
+from mask_filters import compute_mask_stats, pairwise_intersections
+from mask_store import CompactMask
+from models import CPU_PRECISIONS, DEVICE, load_sam, optimize_for_cpu
+from profiles import GENERATOR_PROFILES, MASK_OUTPUT_MODE
+
+DEFAULT_IMAGE_DIR = os.path.join(os.path.dirname(__file__), '..', 'frontend', 'assets', 'images', 'examples')
+
+
+def match_masks(reference, candidates):
+    """
+    Finds the best IoU of every reference mask among the candidate masks.
+
+    Args:
+        reference (list): CompactMasks from the float32 model
+        candidates (list): CompactMasks from the profile
+
+    Returns:
+        numpy.ndarray: Best IoU per reference mask (0 when there are no candidates)
+    """
+    if not reference or not candidates:
+        return np.zeros(len(reference))
+
+    segmentations = reference + candidates
+    areas, bboxes = compute_mask_stats(segmentations)
+    intersections = pairwise_intersections(segmentations, bboxes)[:len(reference), len(reference):]
+    unions = areas[:len(reference), None] + areas[None, len(reference):] - intersections
+    return (intersections / np.maximum(unions, 1)).max(axis=1)
+
+
+def generate(sam, image, profile):
+    generator = SamAutomaticMaskGenerator(sam, output_mode=MASK_OUTPUT_MODE, **GENERATOR_PROFILES[profile])
+    start = time.perf_counter()
+    masks = generator.generate(image)
+    seconds = time.perf_counter() - start
+    return [CompactMask.from_rle(mask['segmentation']) for mask in masks], seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('images', nargs='?', default=DEFAULT_IMAGE_DIR, help="Directory of sample images")
+    parser.add_argument('--precision', choices=CPU_PRECISIONS, default='int8')
+    parser.add_argument('--profile', choices=list(GENERATOR_PROFILES), default='accurate',
+                        help="Mask generator profile to compare with")
+    parser.add_argument('--compile', action='store_true', help="Also compile the encoder with torch.compile")
+    parser.add_argument('--min-iou', type=float, default=0.85, help="Minimum mean best IoU of the float32 masks")
+    parser.add_argument('--min-recall', type=float, default=0.9,
+                        help="Minimum share of float32 masks matched with IoU >= 0.5")
+    args = parser.parse_args()
+
+    if DEVICE.type != 'cpu':
+        print("CUDA is available; run with CUDA_VISIBLE_DEVICES= to check the CPU profile")
+        return 1
+
+    paths = sorted(os.path.join(args.images, name) for name in os.listdir(args.images)
+                   if name.lower().endswith(('.jpg', '.jpeg', '.png')))
+    if not paths:
+        print(f"No images found in {args.images}")
+        return 1
+
+    # The reference model is loaded without the profile, the candidate gets it explicitly
+    reference_sam = load_sam(precision="fp32")
+    profile_sam = optimize_for_cpu(load_sam(precision="fp32"), args.precision, args.compile)
+
+    ious, reference_seconds, profile_seconds = [], 0.0, 0.0
+    for path in paths:
+        with open(path, 'rb') as f:
+            image = ingest_image(f.read(), max_size=SEGMENTATION_SETTINGS['max_size']).working
+
+        reference_masks, reference_time = generate(reference_sam, image, args.profile)
+        profile_masks, profile_time = generate(profile_sam, image, args.profile)
+        best = match_masks(reference_masks, profile_masks)
+
+        ious.append(best)
+        reference_seconds += reference_time
+        profile_seconds += profile_time
+        print(f"{os.path.basename(path)}: {len(reference_masks)} fp32 / {len(profile_masks)} {args.precision} masks, "
+              f"mean IoU {best.mean() if len(best) else 0.0:.3f}, "
+              f"{reference_time:.1f}s -> {profile_time:.1f}s")
+
+    ious = np.concatenate(ious)
+    mean_iou = float(ious.mean()) if len(ious) else 0.0
+    recall = float((ious >= 0.5).mean()) if len(ious) else 0.0
+    print(f"Mean IoU {mean_iou:.3f}, recall {recall:.3f}, "
+          f"speedup {reference_seconds / max(profile_seconds, 1e-9):.2f}x")
+
+    if mean_iou < args.min_iou or recall < args.min_recall:
+        print("CPU profile is below the accuracy thresholds")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
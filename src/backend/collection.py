@@ -0,0 +1,62 @@
+import re
+import unicodedata
+from collections import Counter
+
+# Names given to segments that could not be identified; never merged into the collection
+UNIDENTIFIED_PREFIX = "Unknown Game"
+
+
+def normalize_title(name):
+    """
+    Reduces a game title to a key that ignores case, accents, punctuation and
+    a leading article, so spelling variants of the same game compare equal.
+
+    Args:
+        name (str): Game title
+
+    Returns:
+        str: Normalized title
+    """
+    text = unicodedata.normalize('NFKD', name)
+    text = ''.join(char for char in text if not unicodedata.combining(char)).lower()
+    text = text.replace('&', ' and ')
+    words = re.findall(r"[a-z0-9]+", text)
+    if len(words) > 1 and words[0] in ("the", "a", "an"):
+        words = words[1:]
+    return ' '.join(words)
+
+
+def merge_collection(images):
+    """
+    Merges the identified games of several shelf images into one collection,
+    counting a game once no matter how many photos it appears on.
+
+    Args:
+        images (list): Per-image results with "image_id" and "segments" (each
+            with "id" and "name"); entries without segments are skipped
+
+    Returns:
+        list: One entry per game, sorted by name, with the most common spelling
+            as "name", the number of segments showing it as "count" and their
+            image and segment ids as "occurrences"
+    """
+    games = {}
+    for image in images:
+        for segment in image.get("segments") or []:
+            name = segment.get("name")
+            if not name or name.startswith(UNIDENTIFIED_PREFIX):
+                continue
+            key = normalize_title(name)
+            if not key:
+                continue
+            game = games.setdefault(key, {"spellings": Counter(), "occurrences": []})
+            game["spellings"][name] += 1
+            game["occurrences"].append({"image_id": image["image_id"], "segment_id": segment["id"]})
+
+    collection = [{
+        "name": game["spellings"].most_common(1)[0][0],
+        "count": len(game["occurrences"]),
+        "occurrences": game["occurrences"]
+    } for game in games.values()]
+    collection.sort(key=lambda entry: entry["name"].lower())
+    return collection
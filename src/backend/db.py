@@ -0,0 +1,228 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from sqlite3 import Error
+
+from metrics import log
+
+DB_PATH = os.environ.get('DB_PATH', '/app/data/images.db')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '8'))
+
+# Applied to every new connection
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",          # Readers never block the writer and vice versa
+    "PRAGMA synchronous=NORMAL",        # Safe with WAL, avoids an fsync per commit
+    "PRAGMA busy_timeout=5000",         # Wait for locks instead of failing right away
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",         # 16 MB page cache per connection
+    "PRAGMA mmap_size=268435456",       # Memory-map up to 256 MB of the database
+]
+
+
+def _add_column(conn, table, column, definition):
+    # ALTER TABLE ... ADD COLUMN is not idempotent; databases created before
+    # the migrations existed may already have some of these columns
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _create_base_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS images (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            data BLOB
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS segments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            image_id INTEGER REFERENCES images (id),
+            mask_path TEXT,
+            mask_width INTEGER,
+            mask_height INTEGER,
+            confidence REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_segments_image_id ON segments (image_id)")
+
+
+def _add_pipeline_columns(conn):
+    _add_column(conn, "images", "content_hash", "TEXT")
+    _add_column(conn, "images", "working_data", "BLOB")
+    _add_column(conn, "images", "thumbnail", "BLOB")
+    _add_column(conn, "segments", "mask_data", "BLOB")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_content_hash ON images (content_hash)")
+
+
+def _create_cache_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS result_cache (
+            image_hash TEXT NOT NULL,
+            settings_key TEXT NOT NULL,
+            version TEXT NOT NULL,
+            image_id INTEGER,
+            result TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (image_hash, settings_key)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS identification_cache (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            phash INTEGER NOT NULL,
+            embedding BLOB,
+            name TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_identification_cache_last_used ON identification_cache (last_used)")
+
+
+def _add_identification_columns(conn):
+    _add_column(conn, "segments", "name", "TEXT")
+    _add_column(conn, "segments", "text_confidence", "REAL")
+    _add_column(conn, "images", "previous_image_id", "INTEGER REFERENCES images (id)")
+
+
+# Versioned schema migrations, applied in order and tracked with PRAGMA user_version.
+# Append new migrations; never edit one that has shipped.
+MIGRATIONS = [
+    (1, "images and segments tables, index on segments.image_id", _create_base_tables),
+    (2, "content hash, working copy, thumbnail and encoded mask columns", _add_pipeline_columns),
+    (3, "result and identification cache tables", _create_cache_tables),
+    (4, "identified names on segments and rescan lineage on images", _add_identification_columns),
+]
+
+
+def migrate(conn):
+    """
+    Brings the database schema up to the latest migration.
+
+    Args:
+        conn (sqlite3.Connection): Database connection
+
+    Returns:
+        int: Schema version after migrating
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for migration_version, description, apply in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        log("Applying database migration", version=migration_version, description=description)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            apply(conn)
+            conn.execute(f"PRAGMA user_version={migration_version}")
+            conn.commit()
+        except Error:
+            conn.rollback()
+            raise
+        version = migration_version
+    return version
+
+
+class ConnectionPool:
+    """
+    Fixed-size pool of SQLite connections shared by the request handlers and
+    the model worker threads.
+
+    Each connection is used by one thread at a time; a connection handed back
+    with an open transaction is rolled back before it is reused.
+    """
+
+    def __init__(self, path=DB_PATH, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.connections = queue.LifoQueue(maxsize=size)
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self, timeout=30.0):
+        """
+        Takes a connection from the pool, opening a new one while below the pool size.
+
+        Args:
+            timeout (float): Seconds to wait for a free connection
+
+        Returns:
+            sqlite3.Connection: Database connection
+        """
+        try:
+            return self.connections.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            if self.created < self.size:
+                conn = self._connect()
+                self.created += 1
+                return conn
+
+        return self.connections.get(timeout=timeout)
+
+    def release(self, conn):
+        """
+        Returns a connection to the pool.
+
+        Args:
+            conn (sqlite3.Connection): Connection taken with acquire
+        """
+        if conn.in_transaction:
+            conn.rollback()
+        self.connections.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager that borrows a pooled connection.
+
+        Yields:
+            sqlite3.Connection: Database connection
+        """
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """
+        Closes every idle connection in the pool.
+        """
+        while True:
+            try:
+                conn = self.connections.get_nowait()
+            except queue.Empty:
+                return
+            conn.close()
+            with self.lock:
+                self.created -= 1
+
+
+pool = ConnectionPool()
+
+
+def get_connection():
+    """
+    Borrows a connection from the shared pool.
+
+    Returns:
+        contextmanager: Use as `with get_connection() as conn:`
+    """
+    return pool.connection()
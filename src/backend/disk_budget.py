@@ -0,0 +1,93 @@
+import os
+import threading
+
+from metrics import log
+
+
+class DiskBudget:
+    """
+    Byte budget for a cache directory with least recently used deletion.
+
+    Files count as used when they are written or touched (their mtime is
+    bumped), so the oldest mtimes are deleted first. The directory is only
+    scanned once and whenever the running total goes over the budget; pruning
+    then goes down to low_water of the budget so it does not run on every write.
+    """
+
+    def __init__(self, directory, max_bytes, suffixes, low_water=0.9):
+        """
+        Args:
+            directory (str): Cache directory
+            max_bytes (int): Most bytes the cache files may take, 0 for no limit
+            suffixes (tuple): File name suffixes of cache files; nothing else is deleted
+            low_water (float): Share of max_bytes pruning goes down to
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffixes = tuple(suffixes)
+        self.low_water = low_water
+        self.lock = threading.Lock()
+        self.used = None
+
+    def touch(self, path):
+        """
+        Marks a cache file as recently used.
+        """
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def add(self, size):
+        """
+        Accounts for a newly written file of size bytes, deleting the least
+        recently used files if the cache is now over budget.
+        """
+        if not self.max_bytes:
+            return
+        with self.lock:
+            if self.used is None:
+                self.used = sum(size for _, size, _ in self._files())
+            else:
+                self.used += size
+            if self.used > self.max_bytes:
+                self._prune()
+
+    def _files(self):
+        # (path, size, mtime) of every cache file; files deleted meanwhile are skipped
+        files = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return files
+        for name in names:
+            if not name.endswith(self.suffixes):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _prune(self):
+        # Caller holds the lock
+        files = sorted(self._files(), key=lambda file: file[2])
+        used = sum(size for _, size, _ in files)
+        target = self.max_bytes * self.low_water
+        deleted = 0
+        for path, size, _ in files:
+            if used <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log("Could not delete cache file", path=path, error=str(e))
+                continue
+            used -= size
+            deleted += 1
+        self.used = used
+        log("Pruned cache directory", directory=self.directory, files=deleted, bytes=used)
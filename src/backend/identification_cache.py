@@ -0,0 +1,213 @@
+import threading
+import time
+
+import numpy as np # type: ignore
+import cv2 # type: ignore
+
+from mask_filters import popcount
+
+
+def perceptual_hash(image):
+    """
+    Computes a 64-bit DCT perceptual hash (pHash) of an image.
+
+    The image is reduced to 32x32 grayscale, transformed with a DCT, and the
+    8x8 lowest frequencies are compared against their median. Small changes in
+    scale, compression or lighting flip only a few bits.
+
+    Args:
+        image (numpy.ndarray): BGR or grayscale image
+
+    Returns:
+        int: Unsigned 64-bit hash
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_frequencies = cv2.dct(small)[:8, :8].flatten()
+    bits = low_frequencies > np.median(low_frequencies[1:])
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def image_embedding(image, size=16):
+    """
+    Computes a small L2-normalized embedding used to confirm near-duplicate hash matches.
+
+    Args:
+        image (numpy.ndarray): BGR image
+        size (int): Side of the downsampled color thumbnail
+
+    Returns:
+        numpy.ndarray: float32 vector of length size * size * channels
+    """
+    thumbnail = cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA).astype(np.float32).flatten()
+    thumbnail -= thumbnail.mean()
+    norm = np.linalg.norm(thumbnail)
+    return thumbnail / norm if norm > 0 else thumbnail
+
+
+def _to_signed(value):
+    # SQLite integers are signed 64-bit
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+class IdentificationCache:
+    """
+    Persistent cache of game names keyed by the perceptual hash of segment crops.
+
+    Lookups return the closest stored crop within max_distance Hamming bits
+    (and, when embeddings are used, above min_similarity cosine similarity).
+    Entries expire after ttl seconds and the least recently used entries are
+    evicted beyond max_entries. The hashes are mirrored in memory so a lookup
+    is a single vectorized XOR/popcount over all entries; stores update the
+    mirror in place, and it is only reloaded when another worker changed the table.
+    """
+
+    def __init__(self, max_distance=6, ttl=30 * 24 * 3600, max_entries=50000,
+                 use_embedding=True, min_similarity=0.9):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.use_embedding = use_embedding
+        self.min_similarity = min_similarity
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._hashes = np.zeros(0, dtype=np.uint64)
+        self._version = None
+
+    def stats(self):
+        """
+        Returns the hit/miss counters.
+
+        Returns:
+            dict: hits, misses, stores, evictions and hit_rate
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+    def _refresh(self, conn):
+        # Reload the in-memory hash index when another worker changed the table; caller holds the lock
+        version = conn.execute("SELECT COUNT(*), MAX(id) FROM identification_cache").fetchone()
+        if version == self._version:
+            return
+        rows = conn.execute("SELECT id, phash FROM identification_cache").fetchall()
+        self._ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self._hashes = np.array([row[1] for row in rows], dtype=np.int64).view(np.uint64)
+        self._version = version
+
+    def lookup(self, conn, image):
+        """
+        Looks up the game name stored for a near-duplicate of a segment crop.
+
+        Args:
+            conn (sqlite3.Connection): Database connection
+            image (numpy.ndarray): BGR crop of the segment
+
+        Returns:
+            str: The stored game name, or None on a miss
+        """
+        phash = perceptual_hash(image)
+
+        with self.lock:
+            self._refresh(conn)
+            if len(self._hashes) == 0:
+                self.misses += 1
+                return None
+
+            distances = popcount((self._hashes ^ np.uint64(phash)).view(np.uint8).reshape(-1, 8), axis=1)
+            order = np.argsort(distances, kind='stable')
+            candidates = [int(self._ids[idx]) for idx in order if distances[idx] <= self.max_distance]
+
+            now = time.time()
+            embedding = image_embedding(image) if self.use_embedding else None
+            for entry_id in candidates:
+                row = conn.execute("""
+                    SELECT name, embedding, created_at FROM identification_cache WHERE id=?
+                """, (entry_id,)).fetchone()
+                if not row or now - row[2] > self.ttl:
+                    continue
+                if embedding is not None and row[1] is not None:
+                    stored = np.frombuffer(row[1], dtype=np.float32)
+                    if stored.shape != embedding.shape or float(stored @ embedding) < self.min_similarity:
+                        continue
+
+                conn.execute("UPDATE identification_cache SET last_used=?, hits=hits+1 WHERE id=?", (now, entry_id))
+                conn.commit()
+                self.hits += 1
+                return row[0]
+
+            self.misses += 1
+            return None
+
+    def store(self, conn, image, name):
+        """
+        Stores the identified game name for a segment crop and evicts expired
+        and least recently used entries.
+
+        Args:
+            conn (sqlite3.Connection): Database connection
+            image (numpy.ndarray): BGR crop of the segment
+            name (str): Identified game name
+        """
+        phash = perceptual_hash(image)
+        embedding = image_embedding(image).tobytes() if self.use_embedding else None
+        now = time.time()
+
+        with self.lock:
+            try:
+                cursor = conn.execute("""
+                    INSERT INTO identification_cache (phash, embedding, name, created_at, last_used)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (_to_signed(phash), embedding, name, now, now))
+                entry_id = cursor.lastrowid
+                self.stores += 1
+
+                # No other worker can write while this transaction is open, so this tells
+                # whether the in-memory index still matches the table apart from the new row
+                in_sync = self._version is not None and conn.execute(
+                    "SELECT COUNT(*), MAX(id) FROM identification_cache WHERE id != ?", (entry_id,)
+                ).fetchone() == self._version
+
+                # TTL expiry, then LRU eviction down to max_entries
+                evicted = _delete_ids(conn, "SELECT id FROM identification_cache WHERE created_at < ?",
+                                      (now - self.ttl,))
+                evicted += _delete_ids(conn, """
+                    SELECT id FROM identification_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                """, (self.max_entries,))
+                self.evictions += len(evicted)
+
+                if in_sync:
+                    # Apply this store to the index instead of reloading it on the next lookup
+                    ids = np.append(self._ids, entry_id)
+                    hashes = np.append(self._hashes, np.uint64(phash))
+                    keep = ~np.isin(ids, evicted)
+                    self._ids, self._hashes = ids[keep], hashes[keep]
+                    self._version = conn.execute("SELECT COUNT(*), MAX(id) FROM identification_cache").fetchone()
+                else:
+                    self._version = None
+                conn.commit()
+            except Exception:
+                self._version = None
+                raise
+
+
+def _delete_ids(conn, query, params):
+    """
+    Deletes the identification cache entries selected by a query.
+
+    Returns:
+        list: IDs of the deleted entries
+    """
+    ids = [row[0] for row in conn.execute(query, params)]
+    conn.executemany("DELETE FROM identification_cache WHERE id=?", [(entry_id,) for entry_id in ids])
+    return ids
@@ -0,0 +1,175 @@
+import struct
+
+import numpy as np # type: ignore
+import cv2 # type: ignore
+
+# JPEG start-of-frame markers (SOF0-SOF15 without DHT, JPG and DAC)
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# Reduced-scale decode flags by reduction factor
+_REDUCED_DECODE_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+]
+
+
+def read_image_size(image_data):
+    """
+    Reads the pixel size of a JPEG or PNG from its header without decoding it.
+
+    Args:
+        image_data (bytes): Raw image data in bytes
+
+    Returns:
+        tuple: (height, width, format) with format "jpeg" or "png", or None if
+            the format is not recognized
+    """
+    if image_data[:8] == b'\x89PNG\r\n\x1a\n' and len(image_data) >= 24:
+        width, height = struct.unpack('>II', image_data[16:24])
+        return height, width, "png"
+
+    if image_data[:2] != b'\xff\xd8':
+        return None
+
+    # Walk the JPEG segments until the start-of-frame header
+    offset = 2
+    while offset + 4 <= len(image_data):
+        if image_data[offset] != 0xFF:
+            return None
+        marker = image_data[offset + 1]
+        if marker == 0xFF:  # Fill byte
+            offset += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:  # Markers without a length
+            offset += 2
+            continue
+
+        length = struct.unpack('>H', image_data[offset + 2:offset + 4])[0]
+        if marker in _JPEG_SOF_MARKERS and offset + 9 <= len(image_data):
+            height, width = struct.unpack('>HH', image_data[offset + 5:offset + 9])
+            return height, width, "jpeg"
+        offset += 2 + length
+
+    return None
+
+
+def _fit(image, max_size):
+    # Downscale so the longest side is at most max_size
+    height, width = image.shape[:2]
+    if height <= max_size and width <= max_size:
+        return image
+    scale = max_size / max(height, width)
+    return cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+
+
+class IngestedImage:
+    """
+    An uploaded image decoded once and shared by every pipeline stage.
+
+    Attributes:
+        image (numpy.ndarray): BGR image at detail resolution, used to cut out segment crops
+        working (numpy.ndarray): BGR image at working resolution, fed to SAM
+        original_size (tuple): (height, width) of the uploaded image
+        reduction (int): JPEG reduced-decode factor that was used (1 = full decode)
+    """
+
+    def __init__(self, image, working, original_size, reduction=1):
+        self.image = image
+        self.working = working
+        self.original_size = original_size
+        self.reduction = reduction
+
+    @property
+    def working_scale(self):
+        """
+        (scale_y, scale_x) from working to original coordinates.
+        """
+        return (self.original_size[0] / self.working.shape[0],
+                self.original_size[1] / self.working.shape[1])
+
+    @property
+    def detail_scale(self):
+        """
+        (scale_y, scale_x) from detail to original coordinates.
+        """
+        return (self.original_size[0] / self.image.shape[0],
+                self.original_size[1] / self.image.shape[1])
+
+
+def ingest_image(image_data, max_size=1024, detail_max_size=2560):
+    """
+    Decodes an upload once, at the smallest resolution later stages need.
+
+    JPEGs larger than detail_max_size are decoded with OpenCV's reduced-scale
+    decoder (1/2, 1/4 or 1/8), which skips most of the IDCT work and never
+    allocates the full-resolution frame. The working copy for SAM is derived
+    from the detail image.
+
+    Args:
+        image_data (bytes): Raw image data in bytes
+        max_size (int): Longest side of the working image
+        detail_max_size (int): Longest side of the detail image
+
+    Returns:
+        IngestedImage: The decoded image
+
+    Raises:
+        ValueError: If the data cannot be decoded as an image
+    """
+    nparr = np.frombuffer(image_data, np.uint8)
+    header = read_image_size(image_data)
+
+    image, reduction = None, 1
+    if header and header[2] == "jpeg":
+        longest_side = max(header[0], header[1])
+        for factor, flag in _REDUCED_DECODE_FLAGS:
+            if longest_side / factor >= detail_max_size:
+                image, reduction = cv2.imdecode(nparr, flag), factor
+                break
+
+    if image is None:
+        image, reduction = cv2.imdecode(nparr, cv2.IMREAD_COLOR), 1
+    if image is None:
+        raise ValueError("Could not decode the uploaded image")
+
+    if header:
+        original_size = (header[0], header[1])
+        # EXIF rotation applied by the decoder may swap the axes
+        if (image.shape[0] > image.shape[1]) != (original_size[0] > original_size[1]):
+            original_size = original_size[::-1]
+    else:
+        original_size = image.shape[:2]
+
+    image = _fit(image, detail_max_size)
+    working = _fit(image, max_size)
+    return IngestedImage(image, working, tuple(original_size), reduction)
+
+
+def encode_jpeg(image, quality=90):
+    """
+    Encodes a BGR image as JPEG.
+
+    Args:
+        image (numpy.ndarray): BGR image
+        quality (int): JPEG quality (0-100)
+
+    Returns:
+        bytes: JPEG data
+    """
+    _, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return buffer.tobytes()
+
+
+def make_thumbnail(image, size=256):
+    """
+    Creates a thumbnail whose longest side is size pixels.
+
+    Args:
+        image (numpy.ndarray): BGR image
+        size (int): Longest side of the thumbnail
+
+    Returns:
+        bytes: JPEG thumbnail
+    """
+    return encode_jpeg(_fit(image, size), quality=80)
@@ -0,0 +1,266 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import log
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at its depth limit."""
+
+
+class Job:
+    """
+    A unit of pipeline work tracked by the JobQueue.
+
+    Attributes:
+        id (str): Unique job identifier
+        status (str): One of 'queued', 'running', 'done' or 'failed'
+        result (dict): Response payload once the job has finished
+        status_code (int): HTTP status code belonging to the result
+        error (str): Error message if the job failed
+    """
+
+    def __init__(self):
+        self.id = uuid.uuid4().hex
+        self.status = 'queued'
+        self.result = None
+        self.status_code = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self.retain = True
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def to_dict(self):
+        """
+        Returns the job status without its result, as exposed by /jobs/{id}.
+        """
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "error": self.error
+        }
+
+
+class JobQueue:
+    """
+    Bounded pool of worker threads running the model pipeline off the event loop.
+
+    At most max_workers jobs run at once and at most max_pending jobs may be
+    waiting or running; further submissions raise QueueFullError. Finished jobs
+    are kept for result_ttl seconds so their results can be fetched, except
+    inline jobs (see submit_inline), which are forgotten as soon as they finish.
+    Expired jobs are pruned whenever a job is submitted, finishes or is read.
+    Streamed jobs (see submit_stream) buffer at most stream_buffer events.
+    """
+
+    def __init__(self, max_workers=1, max_pending=16, result_ttl=3600, stream_buffer=32):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.stream_buffer = stream_buffer
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="model-worker")
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    @property
+    def depth(self):
+        """
+        Number of jobs that are queued or running.
+        """
+        with self.lock:
+            self._prune()
+            return sum(1 for job in self.jobs.values() if not job.finished)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Enqueues a pipeline call. The function must return a (payload, status_code) tuple.
+
+        Args:
+            fn (callable): Pipeline function to run on a worker
+            *args: Positional arguments for fn
+            **kwargs: Keyword arguments for fn
+
+        Returns:
+            Job: The queued job
+
+        Raises:
+            QueueFullError: If max_pending jobs are already queued or running
+        """
+        return self._submit(fn, args, kwargs, retain=True)
+
+    def submit_inline(self, fn, *args, **kwargs):
+        """
+        Enqueues a pipeline call whose caller waits for the job itself (see
+        wait). The job counts against max_pending while it runs but is dropped
+        as soon as it finishes, so its result is only held by the caller.
+
+        Args:
+            fn (callable): Pipeline function to run on a worker
+            *args: Positional arguments for fn
+            **kwargs: Keyword arguments for fn
+
+        Returns:
+            Job: The queued job
+
+        Raises:
+            QueueFullError: If max_pending jobs are already queued or running
+        """
+        return self._submit(fn, args, kwargs, retain=False)
+
+    def _submit(self, fn, args, kwargs, retain):
+        job = Job()
+        job.retain = retain
+        with self.lock:
+            self._prune()
+            pending = sum(1 for queued in self.jobs.values() if not queued.finished)
+            if pending >= self.max_pending:
+                raise QueueFullError(f"Too many images in progress ({pending}), try again later")
+            self.jobs[job.id] = job
+
+        # Run in a copy of the caller's context so the request's trace ID follows the job
+        context = contextvars.copy_context()
+        job.future = self.executor.submit(context.run, self._run, job, fn, args, kwargs)
+        return job
+
+    def submit_stream(self, fn, *args, **kwargs):
+        """
+        Enqueues a pipeline call that yields progress events and returns an async
+        iterator over them. The last event's "status_code" becomes the job's
+        status code and the event itself the job's result.
+
+        At most stream_buffer events wait for the reader; the pipeline waits
+        while the buffer is full. Once the iterator is closed (the client
+        disconnected) the generator is closed as well, so no further work is
+        done for the stream.
+
+        Must be called from the event loop that consumes the events.
+
+        Args:
+            fn (callable): Generator function yielding event dicts
+            *args: Positional arguments for fn
+            **kwargs: Keyword arguments for fn
+
+        Returns:
+            tuple: (job, events) where events is an async iterator of event dicts
+
+        Raises:
+            QueueFullError: If max_pending jobs are already queued or running
+        """
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue(maxsize=self.stream_buffer)
+        closed = threading.Event()
+
+        def forward(event):
+            # Waits for room in the buffer; False once the reader is gone
+            if closed.is_set():
+                return False
+            future = asyncio.run_coroutine_threadsafe(events.put(event), loop)
+            while True:
+                try:
+                    future.result(timeout=0.1)
+                    return True
+                except concurrent.futures.TimeoutError:
+                    if closed.is_set():
+                        future.cancel()
+                        return False
+
+        def consume():
+            last_event = {"event": "error", "error": "Pipeline produced no events", "status_code": 500}
+            if closed.is_set():
+                return {"event": "error", "error": "Stream closed by the client", "status_code": 499}, 499
+            generator = fn(*args, **kwargs)
+            try:
+                for event in generator:
+                    if not forward(event):
+                        last_event = {"event": "error", "error": "Stream closed by the client", "status_code": 499}
+                        break
+                    last_event = event
+            except Exception as e:
+                forward({"event": "error", "error": str(e), "status_code": 500})
+                raise
+            finally:
+                generator.close()
+                forward(None)
+            return last_event, last_event.get("status_code", 200)
+
+        job = self.submit(consume)
+
+        async def iterate():
+            try:
+                while True:
+                    event = await events.get()
+                    if event is None:
+                        return
+                    yield event
+            finally:
+                closed.set()
+
+        return job, iterate()
+
+    def get(self, job_id):
+        """
+        Returns the job with the given ID, or None if it is unknown or expired.
+        """
+        with self.lock:
+            self._prune()
+            return self.jobs.get(job_id)
+
+    async def wait(self, job):
+        """
+        Waits for a job without blocking the event loop.
+
+        Args:
+            job (Job): Job returned by submit
+
+        Returns:
+            Job: The finished job
+        """
+        await asyncio.wrap_future(job.future)
+        return job
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, job, fn, args, kwargs):
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            job.result, job.status_code = fn(*args, **kwargs)
+            status = 'done'
+        except Exception as e:
+            # Runs in the submitter's context, so the line carries the request's trace ID
+            log("Job failed", job_id=job.id, error=str(e), traceback=traceback.format_exc())
+            job.error = str(e)
+            job.result = {"error": str(e)}
+            job.status_code = 500
+            status = 'failed'
+        job.finished_at = time.time()
+        job.status = status
+
+        with self.lock:
+            if not job.retain:
+                self.jobs.pop(job.id, None)
+            self._prune()
+
+    def _prune(self):
+        # Drop finished jobs whose results have expired; caller holds the lock
+        now = time.time()
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished and now - job.finished_at > self.result_ttl]
+        for job_id in expired:
+            del self.jobs[job_id]
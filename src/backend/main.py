@@ -1,26 +1,59 @@
-from http.client import HTTPException
 import os
 from fastapi import FastAPI, File, UploadFile, Request, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 import sqlite3
 from sqlite3 import Error
-import io
-from segment_anything import sam_model_registry, SamPredictor, SamAutomaticMaskGenerator, sam_model_registry # type: ignore
 import numpy as np # type: ignore
 import cv2 # type: ignore
-import torch # type: ignore
+import threading
+import time
 import warnings
 import base64
-from fastapi.responses import JSONResponse, HTMLResponse
-import easyocr # type: ignore
+import copy
+import json
+import collections
+import contextlib
+import queue
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from AIAPI import AIAPI
-from typing import List, Dict, Any, Optional
+from catalog import CATALOG_SETTINGS, TitleCatalog
+from collection import UNIDENTIFIED_PREFIX, merge_collection
+from db import get_connection, migrate, pool
+from identification_cache import IdentificationCache
+from ingest import encode_jpeg, ingest_image, make_thumbnail, read_image_size
+from jobs import JobQueue, QueueFullError
+from mask_filters import filter_overlapping_masks, remove_enveloped_masks
+from mask_store import CompactMask, as_compact, compact_records, load_mask_crop
+from model_server import ModelClient, ModelServerError
+from metrics import (CATALOG_LOOKUPS, MASKS_GENERATED, MASKS_KEPT, MASKS_OVER_BUDGET, REGISTRY, REQUEST_SECONDS, RESULT_CACHE_LOOKUPS, STAGE_SECONDS,
+                     log, new_trace_id, trace_id_var)
+from models import CHECKPOINT_PATH, MODEL_LOADING, SAM_PRECISION, LoadedModel, models
+from rescan import (RESCAN_SETTINGS, RescanNotPossible, align_images, find_changed_regions, find_changes,
+                    warp_mask)
+from profiles import GENERATOR_PROFILES, PROFILE_NAMES, MaskGeneratorCache, choose_profile
+from prompted import PROMPTED_SETTINGS, find_candidate_boxes, segment_with_box_prompts
+from result_cache import (CachingSamPredictor, EmbeddingCache, cache_version, get_cached_result,
+                          hash_image, purge_stale_results, settings_key, store_result)
+from stages import Stage
+from segment_images import IMAGE_MODES, SEGMENT_IMAGE_SETTINGS, VARIANTS, SegmentImageCache, etag, media_type
+from text_filter import crop_segment, find_text_segments
+from typing import List, Optional
 
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
-# Initialize EasyOCR reader
-global reader
-reader = easyocr.Reader(['en'])
+# Text filter settings: "recognize" keeps segments with recognized text,
+# "detect" skips the recognizer and keeps segments with any detected text region
+OCR_MODE = os.environ.get('OCR_MODE', 'recognize')
+OCR_CANVAS_SIZE = 800   # Crops are fitted into a square canvas of this size
+OCR_BATCH_SIZE = int(os.environ.get('OCR_BATCH_SIZE', '16'))
+
+# Streaming pipeline settings: kept masks flow into a pool of OCR threads in
+# small batches and text segments flow on into identification, with at most
+# STAGE_QUEUE_SIZE items waiting in front of each stage
+OCR_THREADS = int(os.environ.get('OCR_THREADS', '2'))
+STREAM_OCR_BATCH_SIZE = int(os.environ.get('STREAM_OCR_BATCH_SIZE', '4'))
+STAGE_QUEUE_SIZE = int(os.environ.get('STAGE_QUEUE_SIZE', '8'))
 
 app = FastAPI()
 
@@ -30,575 +63,1860 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Job-Id", "X-Trace-Id"],
 )
 
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """
+    Tags each request with a trace ID (taken from the X-Trace-Id header or newly
+    generated) that appears in every log line of its pipeline run and is
+    returned in the X-Trace-Id response header.
+    """
+    trace_id = request.headers.get("X-Trace-Id") or new_trace_id()
+    trace_id_var.set(trace_id)
+    response = await call_next(request)
+    response.headers["X-Trace-Id"] = trace_id
+    return response
+
 """
-Initialize the Segment Anything Model (SAM) with the following settings:
-- Uses the ViT-H architecture
-- Loads weights from sam_vit_b_01ec64.pth
-- Automatically selects GPU if available, otherwise CPU
+The Segment Anything Model (SAM) and the EasyOCR reader are loaded by the model
+registry (see models.py) after the app starts:
+- SAM_MODEL_TYPE selects vit_b, vit_l (default) or vit_h and its checkpoint
+- MODEL_LOADING selects background (default), eager or lazy loading
+- GPU is used automatically if available, otherwise CPU with the CPU
+  inference profile (SAM_CPU_PRECISION, SAM_CPU_THREADS, SAM_COMPILE)
+- MODEL_SERVER_SOCKET moves them into a model server shared by several API
+  worker processes (see model_server.py)
 """
-# CHECKPOINT_PATH = "sam_vit_b_01ec64.pth"
-CHECKPOINT_PATH= "sam_vit_l_0b3195.pth"
-# CHECKPOINT_PATH= "sam_vit_h_4b8939.pth"
-DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-# if torch.cuda.is_available(): print("CUDA is available")
-# else: print("CUDA is NOT available")
 
-# sam = sam_model_registry["vit_b"](checkpoint=CHECKPOINT_PATH)
-sam = sam_model_registry["vit_l"](checkpoint=CHECKPOINT_PATH)
-# sam = sam_model_registry["vit_h"](checkpoint=CHECKPOINT_PATH)
-sam.to(device=DEVICE)
-predictor = SamPredictor(sam)
+# Socket of a shared model server (see model_server.py); when set, this process
+# loads no models and sends mask generation and text checks to the server, so
+# several uvicorn workers share one copy of the models
+MODEL_SERVER_SOCKET = os.environ.get('MODEL_SERVER_SOCKET')
+model_client = ModelClient(MODEL_SERVER_SOCKET) if MODEL_SERVER_SOCKET else None
+
+# Mask generator profile (see profiles.py): "fast", "balanced", "accurate",
+# "auto" to pick one per image from its size and the server load, or "prompted"
+# for box-prompted segmentation; requests can override it with the profile
+# query parameter
+SEGMENTATION_PROFILE = os.environ.get('SEGMENTATION_PROFILE', 'accurate')
+if SEGMENTATION_PROFILE not in PROFILE_NAMES:
+    raise ValueError(f"Unknown SEGMENTATION_PROFILE '{SEGMENTATION_PROFILE}', expected one of {PROFILE_NAMES}")
+
+# Thresholds applied to the generated masks
+SEGMENTATION_SETTINGS = {
+    "max_size": 1024,                   # Longest image side fed to SAM
+    "detail_max_size": 2560,            # Longest image side segment crops are cut from
+    "min_area_threshold": 4000,         # Minimum area in pixels (e.g., 30x30)
+    "overlap_threshold": 0.3,           # Base IoU threshold
+    "containment_threshold": 0.85,      # Higher threshold for determining if one mask is contained within another
+    "envelope_area_ratio": 1.5,         # Enveloping mask must be at least 50% bigger
+    "envelope_containment_ratio": 0.9   # 90% of the smaller mask must be contained
+}
+
+# Masks are held as bounding-box crops (mask_store.CompactMask); a request may
+# hold this many MB of them per image, beyond which the least stable masks are
+# dropped
+MASK_MEMORY_BUDGET_MB = float(os.environ.get('MASK_MEMORY_BUDGET_MB', '256'))
+
+# Store a JPEG working copy and thumbnail next to each uploaded original
+STORE_IMAGE_DERIVATIVES = os.environ.get('STORE_IMAGE_DERIVATIVES', '0') == '1'
+
+# Batch uploads (/process_images): most images per request, and images per SAM
+# image encoder pass
+MAX_BATCH_IMAGES = int(os.environ.get('MAX_BATCH_IMAGES', '10'))
+ENCODER_BATCH_SIZE = int(os.environ.get('ENCODER_BATCH_SIZE', '4'))
+
+# Results and image embeddings are cached by content hash; entries from another
+# checkpoint or pipeline version are invalidated; results are cached per profile
+CACHE_VERSION = cache_version(CHECKPOINT_PATH, SAM_PRECISION)
+CACHE_SETTINGS_KEYS = {
+    profile: settings_key({
+        "mask_generator": generator_settings,
+        "segmentation": SEGMENTATION_SETTINGS,
+        "ocr_mode": OCR_MODE
+    })
+    for profile, generator_settings in GENERATOR_PROFILES.items()
+}
+CACHE_SETTINGS_KEYS["prompted"] = settings_key({
+    "prompted": PROMPTED_SETTINGS,
+    "segmentation": SEGMENTATION_SETTINGS,
+    "ocr_mode": OCR_MODE
+})
+embedding_cache = EmbeddingCache(CACHE_VERSION)
+
+# Mask generators (and the predictor for prompted segmentation) are built once
+# per profile and worker thread; they reuse cached image embeddings so repeated
+# images skip the ViT encoder
+mask_generators = MaskGeneratorCache(lambda sam: CachingSamPredictor(sam, embedding_cache))
+
+# Segment images in responses: "full" (full-frame PNGs, the original format) or
+# "thumbnail" (cropped thumbnails; full crops via /segments/{id}/image);
+# requests can override it with the image_mode query parameter
+SEGMENT_IMAGE_MODE = os.environ.get('SEGMENT_IMAGE_MODE', 'full')
+if SEGMENT_IMAGE_MODE not in IMAGE_MODES:
+    raise ValueError(f"Unknown SEGMENT_IMAGE_MODE '{SEGMENT_IMAGE_MODE}', expected one of {IMAGE_MODES}")
+
+# Encoded crops and thumbnails of the segments shown to users
+segment_image_cache = SegmentImageCache()
+
+# Game names of previously identified segment crops, matched by perceptual hash
+identification_cache = IdentificationCache(
+    max_distance=int(os.environ.get('ID_CACHE_MAX_DISTANCE', '6')),
+    ttl=float(os.environ.get('ID_CACHE_TTL_DAYS', '30')) * 24 * 3600,
+    max_entries=int(os.environ.get('ID_CACHE_MAX_ENTRIES', '50000'))
+)
+
+def load_title_catalog():
+    catalog = TitleCatalog.load(CATALOG_SETTINGS)
+    if catalog is not None:
+        log("Loaded title catalog", titles=len(catalog), path=CATALOG_SETTINGS['path'])
+    return catalog
+
 
+# Known board game titles (TITLE_CATALOG_PATH); segments whose OCR text
+# confidently names one are identified without OpenAI. Read on first use or
+# at startup (see load_models), not on import
+title_catalog = LoadedModel("title_catalog", load_title_catalog)
 
-def create_connection():
+
+def get_title_catalog():
     """
-    Creates and returns a SQLite database connection.
+    Returns the title catalog, loading it first if needed.
     
     Returns:
-        sqlite3.Connection: Database connection object or None if connection fails
+        TitleCatalog: The catalog, or None if none is configured or it failed to load
+    """
+    try:
+        return title_catalog.load()
+    except RuntimeError:
+        return None
+
+
+@app.on_event("startup")
+def prepare_database():
+    """
+    Applies pending schema migrations and drops cached results written by
+    another checkpoint or pipeline version.
     """
-    conn = None
     try:
-        conn = sqlite3.connect('/app/data/images.db')
-        return conn
+        with get_connection() as conn:
+            version = migrate(conn)
+            log("Database schema ready", version=version)
+            removed = purge_stale_results(conn, CACHE_VERSION)
+            if removed:
+                log("Removed stale cached results", results=removed)
     except Error as e:
-        print(e)
-    return conn
+        log("Error preparing database", error=str(e))
+
+
+@app.on_event("shutdown")
+def close_database():
+    pool.close()
+
+
+@app.on_event("startup")
+def load_models():
+    """
+    Starts loading SAM and EasyOCR (in the background by default, see MODEL_LOADING),
+    unless a model server runs them, and the title catalog, which is always
+    used in this process.
+    """
+    if model_client is None:
+        models.start()
+    if CATALOG_SETTINGS["path"] and MODEL_LOADING != "lazy":
+        threading.Thread(target=get_title_catalog, name="catalog-loader", daemon=True).start()
+
+
+def resolve_profile(profile: str, contents: bytes):
+    """
+    Resolves the "auto" profile to a concrete generator profile from the size
+    SAM will see the image at and the number of jobs waiting for a worker.
+    
+    Args:
+        profile (str): Requested profile name (see PROFILE_NAMES)
+        contents (bytes): Raw image data
+        
+    Returns:
+        str: Name of a profile in GENERATOR_PROFILES
+    """
+    if profile != "auto":
+        return profile
+    
+    max_size = SEGMENTATION_SETTINGS['max_size']
+    header = read_image_size(contents)
+    height, width = header[:2] if header else (max_size, max_size)
+    scale = min(1.0, max_size / max(height, width))
+    backlog = max(0, job_queue.depth - job_queue.max_workers)
+    return choose_profile((height * scale, width * scale), backlog)
+
+
+def generate_masks(image, profile: str = "accurate"):
+    """
+    Generates raw SAM masks for an image with the given profile, in the model
+    server if one is configured.
+    
+    Args:
+        image (numpy.ndarray): BGR image at working resolution (see ingest_image)
+        profile (str): Name of the mask generator profile in GENERATOR_PROFILES,
+            or "prompted" for box-prompted segmentation
+        
+    Returns:
+        list: Mask records as returned by SamAutomaticMaskGenerator, with the
+            segmentation as a mask_store.CompactMask
+    """
+    if model_client is None:
+        return run_mask_generator(image, profile)
+    
+    with STAGE_SECONDS.time(stage="mask_generation"):
+        masks = model_client.generate_masks(image, profile)
+    MASKS_GENERATED.inc(len(masks))
+    return masks
 
-def calculate_iou(mask1, mask2):
+
+def run_mask_generator(image, profile: str = "accurate"):
+    """
+    Generates raw SAM masks for an image with the models of this process.
+    
+    Args:
+        image (numpy.ndarray): BGR image at working resolution (see ingest_image)
+        profile (str): Name of the mask generator profile in GENERATOR_PROFILES,
+            or "prompted" for box-prompted segmentation
+        
+    Returns:
+        list: Mask records as returned by SamAutomaticMaskGenerator, with the
+            segmentation as a mask_store.CompactMask
+    """
+    sam = models.get("sam")
+    if profile == "prompted":
+        # A few dozen box prompts from shelf lines, spines and text regions,
+        # decoded against a single image embedding
+        with STAGE_SECONDS.time(stage="mask_generation"):
+            boxes = find_candidate_boxes(image, models.get("ocr"), PROMPTED_SETTINGS)
+            log("Prompting SAM", boxes=len(boxes))
+            masks = segment_with_box_prompts(mask_generators.predictor(sam), image, boxes, PROMPTED_SETTINGS)
+    else:
+        with STAGE_SECONDS.time(stage="mask_generation"):
+            masks = mask_generators.get(sam, profile).generate(image)
+    masks, dropped = compact_records(masks, int(MASK_MEMORY_BUDGET_MB * 2 ** 20))
+    MASKS_GENERATED.inc(len(masks) + dropped)
+    if dropped:
+        log("Dropped masks over the memory budget", dropped=dropped, budget_mb=MASK_MEMORY_BUDGET_MB)
+        MASKS_OVER_BUDGET.inc(dropped)
+    return masks
+
+
+def filter_masks(masks):
     """
-    Calculate Intersection over Union (IoU) between two binary masks.
+    Filters out masks that are too small based on a minimum area threshold,
+    then resolves overlapping and enveloped masks.
     
     Args:
-        mask1 (numpy.ndarray): First binary mask
-        mask2 (numpy.ndarray): Second binary mask
+        masks (list): Raw mask records (see generate_masks)
         
     Returns:
-        float: IoU value between 0 and 1
+        list: Filtered masks
     """
-    intersection = np.logical_and(mask1, mask2).sum()
-    union = np.logical_or(mask1, mask2).sum()
+    start = time.perf_counter()
+    
+    # Filter out small masks based on area
+    min_area_threshold = SEGMENTATION_SETTINGS['min_area_threshold']
+    area_filtered_masks = [mask for mask in masks if as_compact(mask['segmentation']).area >= min_area_threshold]
     
-    if union == 0:
-        return 0
+    # Handle overlapping masks with improved subsection and stacking detection
+    filtered_masks = filter_overlapping_masks(
+        area_filtered_masks,
+        overlap_threshold=SEGMENTATION_SETTINGS['overlap_threshold'],
+        containment_threshold=SEGMENTATION_SETTINGS['containment_threshold']
+    )
+    
+    # Additional pass to remove enveloped segments
+    # Drop masks that are 90% contained within a mask at least 50% bigger
+    final_masks = remove_enveloped_masks(
+        filtered_masks,
+        area_ratio=SEGMENTATION_SETTINGS['envelope_area_ratio'],
+        containment_ratio=SEGMENTATION_SETTINGS['envelope_containment_ratio']
+    )
     
-    return intersection / union
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage="dedup")
+    MASKS_KEPT.inc(len(final_masks))
+    return final_masks
 
-def process_image_with_sam(image_data):
+
+def process_image_with_sam(image, profile: str = "accurate"):
     """
     Processes an image using the SAM model to generate segmentation masks.
     Filters out masks that are too small based on a minimum area threshold.
     
     Args:
-        image_data (bytes): Raw image data in bytes
+        image (numpy.ndarray): BGR image at working resolution (see ingest_image)
+        profile (str): Name of the mask generator profile in GENERATOR_PROFILES,
+            or "prompted" for box-prompted segmentation
         
     Returns:
         list: Filtered masks
     """
-    # Convert bytes to numpy array
-    nparr = np.frombuffer(image_data, np.uint8)
-    image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    
-    # Resize large images to manageable size
-    max_size = 1024
-    height, width = image.shape[:2]
-    if height > max_size or width > max_size:
-        scale = max_size / max(height, width)
-        image = cv2.resize(image, (int(width * scale), int(height * scale)))
-    
-    # Configure mask generator with memory-efficient settings
-    mask_generator = SamAutomaticMaskGenerator(
-        sam,
-    points_per_side=46,           # Reduce from 32 to focus on larger objects
-    points_per_batch=64,          # Keep as is for processing efficiency
-    pred_iou_thresh=0.9,         # Increase from 0.88 for more precise masks
-    stability_score_thresh=0.94,  # Increase from 0.94 for more stable masks
-    stability_score_offset=1,     # Keep as is
-    box_nms_thresh=0.92,           # Increase from 0.5 to reduce overlapping boxes
-    crop_n_layers=1,              # Keep as is for shelf images
-    crop_nms_thresh=0.92,          # Increase from 0.5 to reduce overlapping regions
-    min_mask_region_area=500      # Increase significantly to filter tiny segments
+    return filter_masks(generate_masks(image, profile))
 
-    )
+
+def check_text(crops: list, ocr_mode: str = OCR_MODE):
+    """
+    Runs the text filter over segment crops, in the model server if one is configured.
     
-    masks = mask_generator.generate(image)
+    Args:
+        crops (list): BGR crops of the segments
+        ocr_mode (str): "recognize" or "detect"
+        
+    Returns:
+        list: (confidence, text) per crop, with confidence None for crops
+            without text (see find_text_segments)
+    """
+    with STAGE_SECONDS.time(stage="ocr"):
+        if model_client is not None:
+            return model_client.find_text_segments(crops, mode=ocr_mode, canvas_size=OCR_CANVAS_SIZE,
+                                                   batch_size=OCR_BATCH_SIZE, with_text=True)
+        return find_text_segments(models.get("ocr"), crops, mode=ocr_mode, canvas_size=OCR_CANVAS_SIZE,
+                                  batch_size=OCR_BATCH_SIZE, with_text=True)
+
+
+def precompute_embeddings(images: list):
+    """
+    Runs the SAM image encoder over several images in batched passes, so their
+    mask generation starts from cached embeddings.
     
-    # Filter out small masks based on area
-    min_area_threshold = 4000  # Minimum area in pixels (e.g., 30x30)
-    area_filtered_masks = [mask for mask in masks if np.sum(mask['segmentation']) >= min_area_threshold]
+    Args:
+        images (list): BGR images at working resolution
+    """
+    if model_client is not None:
+        model_client.precompute(images)
+    else:
+        mask_generators.predictor(models.get("sam")).precompute(images, batch_size=ENCODER_BATCH_SIZE)
+
+
+def load_segment_crops(conn: sqlite3.Connection, image_id: int, image: Optional[np.ndarray] = None):
+    """
+    Cuts every stored segment of an image out of the original image as a tight crop.
     
-    # Handle overlapping masks with improved subsection and stacking detection
-    overlap_threshold = 0.3  # Base IoU threshold
-    containment_threshold = 0.85  # Higher threshold for determining if one mask is contained within another
+    Args:
+        conn (sqlite3.Connection): Database connection
+        image_id (int): ID of the image
+        image (numpy.ndarray): Already decoded BGR image to crop from; decoded
+            from the stored upload if None
+        
+    Returns:
+        tuple: (image, segment_crops) where segment_crops is a list of
+            (seg_id, crop, box) tuples (empty if the image or its segments are missing)
+    """
+    cursor = conn.cursor()
     
-    # Sort masks by stability score first, then by area (ascending)
-    # This helps ensure we keep the most stable segments while still processing smaller ones first
-    sorted_masks = sorted(area_filtered_masks, 
-                         key=lambda x: (-x.get('stability_score', 0.0), np.sum(x['segmentation'])))
+    # Retrieve all segments for the given image ID
+    cursor.execute("""
+        SELECT id, mask_path, mask_width, mask_height, confidence, mask_data 
+        FROM segments WHERE image_id=?
+    """, (image_id,))
+    segment_rows = cursor.fetchall()
     
-    # Initialize list to track which masks to keep
-    masks_to_keep = []
+    if not segment_rows:
+        return image, []
+    
+    if image is None:
+        # Retrieve and decode the original image data
+        cursor.execute("SELECT data FROM images WHERE id=?", (image_id,))
+        image_row = cursor.fetchone()
+        if not image_row:
+            return image, []
+        image = ingest_image(
+            image_row[0],
+            max_size=SEGMENTATION_SETTINGS['max_size'],
+            detail_max_size=SEGMENTATION_SETTINGS['detail_max_size']
+        ).image
+    
+    segment_crops = []
+    for seg_id, mask_path, mask_width, mask_height, confidence, mask_data in segment_rows:
+        # Decode only the mask's bounding box
+        mask_crop, mask_bbox = load_mask_crop(mask_data, mask_path)
+        crop, box = crop_segment(image, mask_crop, mask_bbox, (mask_height, mask_width))
+        if crop is not None:
+            segment_crops.append((seg_id, crop, box))
+    
+    return image, segment_crops
+
+
+def text_segment(image: np.ndarray, seg_id: int, crop: np.ndarray, box: tuple, confidence: float,
+                 text: str = "", image_mode: str = SEGMENT_IMAGE_MODE):
+    """
+    Builds the record of a segment that passed the text filter. Only the
+    segment image of the delivery mode is encoded right away: the full-frame
+    PNG in "full" mode, the cached crop and thumbnail in "thumbnail" mode.
     
-    # For each mask, check if it overlaps significantly with any previously kept mask
-    for i, mask in enumerate(sorted_masks):
-        should_keep = True
+    Args:
+        image (numpy.ndarray): BGR image the crop was cut from
+        seg_id (int): Segment ID
+        crop (numpy.ndarray): BGR crop of the segment
+        box (tuple): (y0, y1, x0, x1) of the crop in image coordinates
+        confidence (float): OCR confidence
+        text (str): Recognized text, matched against the title catalog
+        image_mode (str): "full" or "thumbnail", see present_payload
         
-        # Get current mask segmentation and properties
-        current_mask = mask['segmentation']
-        current_area = np.sum(current_mask)
-        current_stability = mask.get('stability_score', 0.0)
+    Returns:
+        dict: seg_id, base64_image (the full-frame PNG, None until it is
+            needed, see segment_png), confidence, text, crop, box and frame_shape
+    """
+    if image_mode == "thumbnail":
+        # Encode the crop and its thumbnail now, while it is in memory
+        segment_image_cache.put(seg_id, crop)
+    
+    segment = {
+        "seg_id": seg_id, 
+        "base64_image": None, 
+        "confidence": confidence,
+        "text": text,
+        "crop": crop,
+        "box": box,
+        "frame_shape": image.shape
+    }
+    if image_mode == "full":
+        segment_png(segment)
+    return segment
+
+
+def frame_png(frame_shape: tuple, crop: np.ndarray, box: tuple):
+    """
+    Places a crop on a blank canvas of the image size and encodes it as base64 PNG.
+    
+    Args:
+        frame_shape (tuple): Shape of the image the crop was cut from
+        crop (numpy.ndarray): BGR crop
+        box (tuple): (y0, y1, x0, x1) of the crop in image coordinates
         
-        # Get bounding box for current mask
-        current_indices = np.where(current_mask)
-        if len(current_indices[0]) == 0:  # Skip empty masks
-            continue
-            
-        current_y_min, current_y_max = np.min(current_indices[0]), np.max(current_indices[0])
-        current_x_min, current_x_max = np.min(current_indices[1]), np.max(current_indices[1])
-        current_height = current_y_max - current_y_min
-        current_width = current_x_max - current_x_min
-        current_aspect_ratio = current_width / current_height if current_height > 0 else 0
-        
-        # Check against all previously kept masks
-        for kept_idx in masks_to_keep:
-            kept_mask = sorted_masks[kept_idx]['segmentation']
-            kept_stability = sorted_masks[kept_idx].get('stability_score', 0.0)
-            
-            # Get bounding box for kept mask
-            kept_indices = np.where(kept_mask)
-            kept_y_min, kept_y_max = np.min(kept_indices[0]), np.max(kept_indices[0])
-            kept_x_min, kept_x_max = np.min(kept_indices[1]), np.max(kept_indices[1])
-            kept_height = kept_y_max - kept_y_min
-            kept_width = kept_x_max - kept_x_min
-            kept_aspect_ratio = kept_width / kept_height if kept_height > 0 else 0
-            kept_area = np.sum(kept_mask)
-            
-            # Calculate basic overlap metrics first
-            overlap_region = np.logical_and(current_mask, kept_mask)
-            intersection = np.sum(overlap_region)
-            iou = calculate_iou(current_mask, kept_mask)
-            
-            # If there's no overlap at all, skip further checks
-            if intersection == 0:
-                is_stacked = False
-                is_subsection = False
-                continue
-                
-            # Calculate overlap indices and metrics
-            overlap_indices = np.where(overlap_region)
-            overlap_y_min, overlap_y_max = np.min(overlap_indices[0]), np.max(overlap_indices[0])
-            
-            # Calculate overlap dimensions
-            overlap_height = overlap_y_max - overlap_y_min
-            overlap_width = overlap_indices[1].max() - overlap_indices[1].min()
-            
-            # Initialize overlap metrics
-            current_top_overlap = current_bottom_overlap = kept_top_overlap = kept_bottom_overlap = 0
-            current_left_overlap = current_right_overlap = kept_left_overlap = kept_right_overlap = 0
-            total_vertical_overlap = total_horizontal_overlap = 0
-            max_vertical_overlap = max_side_overlap = 0
-            
-            # Calculate vertical overlap metrics if significant height
-            if overlap_height >= 5:
-                # Calculate vertical overlap ratios
-                current_top_overlap = max(0, current_y_min + current_height/4 - overlap_y_min) / overlap_height
-                current_bottom_overlap = max(0, overlap_y_max - (current_y_max - current_height/4)) / overlap_height
-                kept_top_overlap = max(0, kept_y_min + kept_height/4 - overlap_y_min) / overlap_height
-                kept_bottom_overlap = max(0, overlap_y_max - (kept_y_max - kept_height/4)) / overlap_height
-                
-                # Calculate vertical overlap characteristics
-                total_vertical_overlap = current_top_overlap + current_bottom_overlap + kept_top_overlap + kept_bottom_overlap
-                max_vertical_overlap = max(current_top_overlap, current_bottom_overlap, kept_top_overlap, kept_bottom_overlap)
-            
-            # Calculate horizontal overlap metrics if significant width
-            if overlap_width >= 5:
-                # Calculate horizontal overlap ratios
-                current_left_overlap = max(0, current_x_min + current_width/4 - overlap_indices[1].min()) / overlap_width
-                current_right_overlap = max(0, overlap_indices[1].max() - (current_x_max - current_width/4)) / overlap_width
-                kept_left_overlap = max(0, kept_x_min + kept_width/4 - overlap_indices[1].min()) / overlap_width
-                kept_right_overlap = max(0, overlap_indices[1].max() - (kept_x_max - kept_width/4)) / overlap_width
-                
-                # Calculate horizontal overlap characteristics
-                total_horizontal_overlap = current_left_overlap + current_right_overlap + kept_left_overlap + kept_right_overlap
-                max_side_overlap = max(current_left_overlap, current_right_overlap, kept_left_overlap, kept_right_overlap)
-            
-            # Calculate horizontal alignment
-            horizontal_overlap = max(0, min(current_x_max, kept_x_max) - max(current_x_min, kept_x_min))
-            horizontal_overlap_ratio = horizontal_overlap / min(current_width, kept_width)
-            
-            # Calculate containment ratios
-            current_in_kept_ratio = intersection / current_area
-            kept_in_current_ratio = intersection / kept_area
-            
-            # Check if overlap is more horizontal than vertical
-            # Consider both total distribution and peak concentration
-            horizontal_bias = (
-                (total_horizontal_overlap > total_vertical_overlap * 1.2 and  # Require 20% more horizontal overlap
-                 max_side_overlap > 0.5) or  # Must have significant side overlap
-                (max_side_overlap > 0.7 and  # Strong side concentration
-                 max_side_overlap > max_vertical_overlap * 1.3 and  # Much stronger than vertical
-                 abs(current_left_overlap - current_right_overlap) > 0.4)  # Concentrated on one side
-            )
-            
-            # Check for nearly identical segments
-            # Calculate bounding box similarity
-            box_overlap_x = min(current_x_max, kept_x_max) - max(current_x_min, kept_x_min)
-            box_overlap_y = min(current_y_max, kept_y_max) - max(current_y_min, kept_y_min)
-            box_overlap_area = box_overlap_x * box_overlap_y
-            box_union_area = (max(current_x_max, kept_x_max) - min(current_x_min, kept_x_min)) * \
-                            (max(current_y_max, kept_y_max) - min(current_y_min, kept_y_min))
-            box_iou = box_overlap_area / box_union_area if box_union_area > 0 else 0
-
-            # Consider segments nearly identical if:
-            # - High IoU (> 0.65) or high containment ratio (> 0.65)
-            # - Similar bounding boxes (box_iou > 0.7)
-            # - Similar center position (within 10% of box size)
-            center_x_diff = abs((current_x_min + current_x_max) / 2 - (kept_x_min + kept_x_max) / 2)
-            center_y_diff = abs((current_y_min + current_y_max) / 2 - (kept_y_min + kept_y_max) / 2)
-            max_dim = max(current_width, current_height, kept_width, kept_height)
-            centers_close = (center_x_diff < max_dim * 0.1 and center_y_diff < max_dim * 0.1)
-            
-            if ((iou > 0.65 or current_in_kept_ratio > 0.65 or kept_in_current_ratio > 0.65) and
-                box_iou > 0.7 and centers_close):
-                # Keep the more stable one
-                should_keep = current_stability >= kept_stability
-                break
-            
-            # Check for subsections with more comprehensive criteria
-            is_subsection = False
-            
-            # First check if one segment is significantly contained within the other
-            if (current_in_kept_ratio > containment_threshold and current_area < kept_area * 0.9) or \
-               (kept_in_current_ratio > containment_threshold and kept_area < current_area * 0.9):
-                
-                # Then check if it's likely a subsection based on overlap distribution
-                if horizontal_bias:
-                    # If there's strong horizontal bias, it's likely a subsection
-                    is_subsection = True
-                else:
-                    # Check if the overlap is evenly distributed (not concentrated at top/bottom)
-                    even_vertical_distribution = (
-                        abs(current_top_overlap - current_bottom_overlap) < 0.3 and
-                        abs(kept_top_overlap - kept_bottom_overlap) < 0.3
-                    )
-                    
-                    # If overlap is even and not concentrated on one side, it's likely a subsection
-                    if even_vertical_distribution and \
-                       abs(current_left_overlap - current_right_overlap) < 0.3 and \
-                       abs(kept_left_overlap - kept_right_overlap) < 0.3:
-                        is_subsection = True
-            
-            # Check if this might be a combined segment of stacked boxes
-            # Only check if not a subsection and overlap is more vertical than horizontal
-            is_combined_segment = (
-                not is_subsection and
-                not horizontal_bias and
-                current_area > kept_area * 1.4 and  # Slightly lower threshold for combined segments
-                horizontal_overlap_ratio > 0.5 and  # More lenient horizontal alignment
-                current_height > kept_height * 1.6 and  # Should be significantly taller
-                current_stability < kept_stability and  # Individual segments should be more stable
-                ((current_top_overlap > 0.6 and current_bottom_overlap > 0.6) or  # Contains both top and bottom
-                 (kept_top_overlap > 0.6 and kept_bottom_overlap > 0.6))  # Contains both top and bottom
-            )
-            
-            # Only check for stacking if it's not a subsection and not a combined segment
-            is_stacked = False
-            if not is_subsection and not is_combined_segment:
-                # Calculate relative size - stacked boxes should be similar in size
-                size_ratio = min(current_area, kept_area) / max(current_area, kept_area)
-                width_ratio = min(current_width, kept_width) / max(current_width, kept_width)
-                
-                is_stacked = (
-                    horizontal_overlap_ratio > 0.5 and  # More lenient horizontal alignment
-                    abs(current_aspect_ratio - kept_aspect_ratio) < 0.4 and  # More lenient aspect ratio difference
-                    size_ratio > 0.6 and  # More lenient size ratio
-                    width_ratio > 0.7 and  # Similar widths
-                    iou < overlap_threshold and  # Limited overall overlap
-                    ((current_top_overlap > 0.6 and current_bottom_overlap < 0.2) or  # More lenient overlap thresholds
-                     (current_bottom_overlap > 0.6 and current_top_overlap < 0.2) or
-                     (kept_top_overlap > 0.6 and kept_bottom_overlap < 0.2) or
-                     (kept_bottom_overlap > 0.6 and kept_top_overlap < 0.2))
-                )
-            
-            # Determine if we should keep this mask
-            if is_combined_segment:
-                # Don't keep combined segments of stacked boxes
-                should_keep = False
-                break
-            elif is_subsection:
-                # For subsections, always keep the larger mask
-                if current_area < kept_area:
-                    should_keep = False
-                    break
-            elif not is_stacked and iou > overlap_threshold:
-                # For overlapping non-stacked masks, keep the one with better stability
-                if current_stability < kept_stability:
-                    should_keep = False
-                    break
-            elif is_stacked:
-                # For stacked boxes, keep both unless they're too similar
-                if iou > 0.8:  # Very high overlap suggests same box
-                    should_keep = False
-                    break
-        
-        # Add to keep list if it passed all checks
-        if should_keep:
-            masks_to_keep.append(i)
-    
-    # Get the filtered masks
-    filtered_masks = [sorted_masks[i] for i in masks_to_keep]
+    Returns:
+        str: Base64 encoded PNG
+    """
+    y0, y1, x0, x1 = box
+    segment_image = np.zeros(frame_shape, dtype=crop.dtype)
+    segment_image[y0:y1, x0:x1] = crop
+    _, buffer = cv2.imencode('.png', segment_image)
+    return base64.b64encode(buffer).decode('utf-8')
+
+
+def segment_png(segment: dict):
+    """
+    Returns the full-frame PNG of a text segment, encoding it on first use:
+    OpenAI gets it for every segment it identifies, the "full" image mode for
+    every segment.
     
-    # Additional pass to remove enveloped segments
-    # Sort by area descending so we check larger segments first
-    filtered_masks.sort(key=lambda x: np.sum(x['segmentation']), reverse=True)
-    masks_to_remove = set()
+    Args:
+        segment (dict): Text segment (see text_segment)
+        
+    Returns:
+        str: Base64 encoded PNG
+    """
+    if segment['base64_image'] is None:
+        segment['base64_image'] = frame_png(segment['frame_shape'], segment['crop'], segment['box'])
+    return segment['base64_image']
+
+
+def identified_segment(segment: dict, game_name: str):
+    """
+    Builds the response entry of an identified segment, as expected by the frontend.
     
-    # Compare each pair of masks
-    for i in range(len(filtered_masks)):
-        if i in masks_to_remove:
-            continue
-        mask1 = filtered_masks[i]['segmentation']
-        area1 = np.sum(mask1)
+    Args:
+        segment (dict): Text segment (see text_segment)
+        game_name (str): Identified game name
         
-        for j in range(i + 1, len(filtered_masks)):
-            if j in masks_to_remove:
-                continue
-            mask2 = filtered_masks[j]['segmentation']
-            area2 = np.sum(mask2)
-            
-            # Calculate intersection
-            intersection = np.logical_and(mask1, mask2).sum()
-            
-            # If smaller mask is completely or almost completely (90%) contained within larger mask
-            # and the larger mask is at least 50% bigger
-            if area1 > area2 * 1.5:  # Larger mask is at least 50% bigger
-                if intersection / area2 > 0.9:  # 90% of smaller mask is contained
-                    masks_to_remove.add(j)
-            elif area2 > area1 * 1.5:  # Smaller mask is at least 50% bigger
-                if intersection / area1 > 0.9:  # 90% of smaller mask is contained
-                    masks_to_remove.add(i)
-                    break  # No need to check this mask against others
-    
-    # Return masks that weren't removed
-    final_masks = [mask for i, mask in enumerate(filtered_masks) if i not in masks_to_remove]
-    return final_masks
+    Returns:
+        dict: id, confidence, image (PNG data URL; left out if the full-frame
+            PNG was never needed, present_payload adds it when asked for) and name
+    """
+    segment_data = {
+        "id": segment['seg_id'],
+        "confidence": segment["confidence"]
+    }
+    if segment['base64_image'] is not None:
+        segment_data["image"] = f"data:image/png;base64,{segment['base64_image']}"
+    segment_data["name"] = game_name
+    return segment_data
+
+
+def identify_segments(conn: sqlite3.Connection, segments: list, api_key: Optional[str] = None):
+    """
+    Identifies the games on text segments. Segments whose crop was identified
+    before are answered from the identification cache and segments whose OCR
+    text names a known title from the title catalog; the rest are sent to
+    OpenAI concurrently and their names are added to the cache.
+    
+    Args:
+        conn (sqlite3.Connection): Database connection
+        segments (list): Text segments (see text_segment)
+        api_key (str): OpenAI API key, falls back to the environment if None
+        
+    Yields:
+        tuple: (index, game_name, source, failed) as soon as a segment is
+            resolved, where source is "cache", "catalog" or "openai" and failed
+            is True if no name could be obtained
+    """
+    pending = []
+    for index, segment in enumerate(segments):
+        local_name, source = local_identification(conn, segment)
+        if local_name is not None:
+            yield index, local_name, source, False
+        else:
+            pending.append(index)
+    
+    if not pending:
+        return
+    
+    # Use the provided API key if available
+    ai = AIAPI(api_key=api_key)
+    api_responses = ai.getAPIResponses(
+        [segment_png(segments[index]) for index in pending],
+        max_retries=50,  # Retry up to 50 times per segment
+        initial_backoff=1  # Start with 1 second backoff
+    )
+    
+    for pending_index, api_response in api_responses:
+        index = pending[pending_index]
+        game_name, failed = resolve_identification(conn, ai, segments[index], api_response)
+        yield index, game_name, "openai", failed
 
 
-def get_filtered_segments(image_id: int):
+def local_identification(conn: sqlite3.Connection, segment: dict):
     """
-    Helper function to get filtered segments with text for a given image.
+    Identifies a text segment without OpenAI: from the identification cache,
+    or from a confident match of its OCR text in the title catalog.
     
     Args:
-        image_id (int): ID of the image to process
+        conn (sqlite3.Connection): Database connection
+        segment (dict): Text segment (see text_segment)
         
     Returns:
-        list: List of filtered segments with text
+        tuple: (game_name, source) with source "cache" or "catalog", or
+            (None, None) if the segment has to go to OpenAI
     """
-    filtered_segments = []
-    segments_data = []
-    conn = create_connection()
+    if segment['crop'] is not None:
+        cached_name = identification_cache.lookup(conn, segment['crop'])
+        if cached_name is not None:
+            return cached_name, "cache"
+    
+    catalog = get_title_catalog() if segment.get('text') else None
+    if catalog is not None:
+        title, score = catalog.match(segment['text'])
+        CATALOG_LOOKUPS.inc(result="miss" if title is None else "hit")
+        if title is not None:
+            log("Matched title catalog", segment_id=segment['seg_id'], title=title, score=round(score, 3))
+            return title, "catalog"
+    return None, None
+
+
+def resolve_identification(conn: sqlite3.Connection, ai: AIAPI, segment: dict, api_response: Optional[str]):
+    """
+    Turns the OpenAI response for a text segment into a game name and adds it
+    to the identification cache.
     
-    if not conn:
-        return filtered_segments
+    Args:
+        conn (sqlite3.Connection): Database connection
+        ai (AIAPI): Client that produced the response
+        segment (dict): Text segment (see text_segment)
+        api_response (str): JSON response content, None if the request failed
         
+    Returns:
+        tuple: (game_name, failed) where failed is True if no name could be obtained
+    """
     try:
-        cursor = conn.cursor()
-        
-        # Retrieve original image data
-        cursor.execute("SELECT data FROM images WHERE id=?", (image_id,))
-        image_row = cursor.fetchone()
+        if api_response:
+            game_name = ai.parse_api_response(api_response).boardGame.name
+            if segment['crop'] is not None:
+                identification_cache.store(conn, segment['crop'], game_name)
+            return game_name, False
+        log("No valid response, possibly due to insufficient balance", segment_id=segment['seg_id'])
+        return "Unknown Game (Check OpenAI balance)", True
+    except Exception as e:
+        log("Error identifying game", segment_id=segment['seg_id'], error=str(e))
+        return "Unknown Game", True
+
+
+def stream_segments(conn: sqlite3.Connection, image: np.ndarray, segments: list, api_key: Optional[str] = None,
+                    ocr_mode: str = OCR_MODE, image_mode: str = SEGMENT_IMAGE_MODE):
+    """
+    Filters and identifies freshly segmented masks as a streaming pipeline:
+    masks go through the text filter in small batches on OCR_THREADS threads,
+    and every segment with text goes on to identification as soon as it passes,
+    while the remaining masks are still being read. Identification cache hits
+    and title catalog matches are answered right away; the rest are sent to
+    OpenAI in batches, up to the client's concurrency.
+    
+    The database is only used from the calling thread. Every queue between the
+    stages is bounded, so the pipeline only runs ahead of the caller by a few
+    segments; closing the generator cancels the stages.
+    
+    Args:
+        conn (sqlite3.Connection): Database connection
+        image (numpy.ndarray): BGR image to crop the segments from
+        segments (list): (seg_id, mask) pairs, where mask is a CompactMask
+        api_key (str): OpenAI API key, falls back to the environment if None
+        ocr_mode (str): "recognize" or "detect"
+        image_mode (str): Image delivery mode the result is encoded for, see text_segment
         
-        # Retrieve all segments for the given image ID
-        cursor.execute("""
-            SELECT id, mask_path, mask_width, mask_height, confidence 
-            FROM segments WHERE image_id=?
-        """, (image_id,))
-        segment_rows = cursor.fetchall()
+    Yields:
+        tuple: ("filtered", count) once every mask has been through the text
+            filter, and ("segment", segment, game_name, source, failed) as soon
+            as a text segment is resolved (see identify_segments)
+    """
+    events = queue.Queue(maxsize=STAGE_QUEUE_SIZE)
+    
+    def read_text(batch):
+        segment_crops = []
+        for seg_id, mask in batch:
+            crop, box = crop_segment(image, mask.crop(), mask.bbox, mask.shape)
+            if crop is not None:
+                segment_crops.append((seg_id, crop, box))
+        if not segment_crops:
+            return []
+        ocr_results = check_text([crop for _, crop, _ in segment_crops], ocr_mode)
+        return [text_segment(image, seg_id, crop, box, confidence, text, image_mode)
+                for (seg_id, crop, box), (confidence, text) in zip(segment_crops, ocr_results)
+                if confidence is not None]
+    
+    def identify(batch):
+        api_responses = ai.getBatchAPIResponse(
+            [segment_png(segment) for segment in batch],
+            max_retries=50,  # Retry up to 50 times per request
+            initial_backoff=1  # Start with 1 second backoff
+        )
+        return zip(batch, api_responses)
+    
+    log("Checking segments for text", segments=len(segments), mode=ocr_mode, threads=OCR_THREADS)
+    ocr_stage = Stage("ocr", read_text, events, workers=OCR_THREADS, batch_size=STREAM_OCR_BATCH_SIZE,
+                      queue_size=STAGE_QUEUE_SIZE)
+    ai = identify_stage = None
+    try:
+        ocr_stage.feed(segments)
         
-        if not image_row or not segment_rows:
-            return filtered_segments
-            
-        # Decode the original image
-        nparr = np.frombuffer(image_row[0], np.uint8)
-        image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        height, width = image.shape[:2]
-        
-        # Process all masks
-        for seg_id, mask_path, mask_width, mask_height, confidence in segment_rows:
-            # Load mask from file
-            mask = np.load(mask_path)
-            
-            # Resize the mask to match the original image dimensions
-            resized_mask = cv2.resize(mask.astype(np.uint8), (width, height), interpolation=cv2.INTER_NEAREST).astype(bool)
+        text_segments = pending = 0
+        identification_started = None
+        ocr_finished = False
+        # Segments waiting for room in the identify inbox. They are handed on without
+        # blocking, since the identify workers may be waiting for room in events
+        waiting = collections.deque()
+        while not ocr_finished or pending:
+            while waiting and identify_stage.put(waiting[0], block=False):
+                waiting.popleft()
+            try:
+                name, kind, value = events.get(timeout=0.1 if waiting else None)
+            except queue.Empty:
+                continue
+            if kind == "error":
+                raise value
             
-            # Create a blank canvas for the masked region
-            segment_image = np.zeros_like(image)
-            segment_image[resized_mask] = image[resized_mask]
+            if name == "ocr" and kind == "finished":
+                ocr_finished = True
+                yield "filtered", text_segments
             
-            # Encode as base64
-            _, buffer = cv2.imencode('.png', segment_image)
-            base64_image = base64.b64encode(buffer).decode('utf-8')
+            elif name == "ocr":
+                text_segments += 1
+                if identification_started is None:
+                    identification_started = time.perf_counter()
+                local_name, source = local_identification(conn, value)
+                if local_name is not None:
+                    yield "segment", value, local_name, source, False
+                    continue
+                
+                # Use the provided API key if available; the client is only needed when
+                # neither the cache nor the catalog knows the segment
+                if identify_stage is None:
+                    ai = AIAPI(api_key=api_key)
+                    identify_stage = Stage("identify", identify, events, workers=ai.concurrency,
+                                           batch_size=ai.batch_size, queue_size=STAGE_QUEUE_SIZE)
+                pending += 1
+                waiting.append(value)
             
-            segments_data.append([seg_id, base64_image])
+            elif kind == "result":
+                segment, api_response = value
+                pending -= 1
+                game_name, failed = resolve_identification(conn, ai, segment, api_response)
+                yield "segment", segment, game_name, "openai", failed
         
-        print("starting text checker...")
-        for segment in segments_data:
-            tmpSegment = segment[1]
-            image_data = base64.b64decode(tmpSegment)
-            
-            #make image be readable by Easyocr
-            nparr = np.frombuffer(image_data, np.uint8)
-
-            # Decode image using OpenCV
-            image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            image = cv2.resize(image, (800, 800))
-            
-            result = reader.readtext(image)
-            print("checking confidence")
-            for item in result:
-                if isinstance(item, tuple) and len(item) == 3:  # Ensure valid tuple
-                    bbox, text, confidence = item
-                    if isinstance(confidence, (float, int)) and confidence > 0.0:
-                        filtered_segments.append({
-                            "seg_id": segment[0], 
-                            "base64_image": segment[1], 
-                            "confidence": confidence
-                        })
-                        break
-        
-        return filtered_segments
+        if identification_started is not None:
+            STAGE_SECONDS.observe(time.perf_counter() - identification_started, stage="identification")
     finally:
-        conn.close()
+        # Stops the workers, early if the caller gave up on the stream
+        ocr_stage.cancel()
+        if identify_stage is not None:
+            identify_stage.cancel()
 
 
-@app.post("/process_image")
-async def process_image(
-    file: UploadFile = File(...), 
-    request: Request = None, 
-    x_openai_api_key: str = Header(None)
-):
+def load_segment_images(conn: sqlite3.Connection, segment_ids: list, variant: str):
     """
-    Combined endpoint that handles the entire image processing pipeline:
-    1. Upload the image
-    2. Segment it using SAM
-    3. Clean it (filter segments with text)
-    4. Identify the games
-    5. Return the segment data as expected by the frontend
+    Returns encoded segment images from the segment image cache, re-cutting
+    missing ones from the stored masks (one decode per image).
     
     Args:
-        file (UploadFile): Image file to be uploaded
-        request (Request): The FastAPI request object
-        x_openai_api_key (str): OpenAI API key from header
+        conn (sqlite3.Connection): Database connection
+        segment_ids (list): Segment IDs
+        variant (str): "crop" or "thumbnail"
         
     Returns:
-        JSONResponse: Contains image_id and list of processed segments with:
-            - id: segment identifier
-            - confidence: OCR confidence score
-            - image: base64 encoded PNG of the segmented region
-            - name: identified game name
+        dict: Encoded image per segment ID; unknown segments are left out
     """
+    images = {}
+    missing = []
+    for seg_id in segment_ids:
+        data = segment_image_cache.get(seg_id, variant)
+        if data is None:
+            missing.append(seg_id)
+        else:
+            images[seg_id] = data
     
-    # Step 1: Upload and read the image
-    contents = await file.read()
-    conn = create_connection()
+    for seg_id, _, crop, _ in recut_segments(conn, missing):
+        images[seg_id] = segment_image_cache.put(seg_id, crop)[variant]
     
-    if not conn:
-        return JSONResponse({"error": "Database connection failed"}, status_code=500)
+    return images
+
+
+def recut_segments(conn: sqlite3.Connection, segment_ids: list):
+    """
+    Cuts segments out of their stored images again (one decode per image).
     
-    try:
-        cursor = conn.cursor()
+    Args:
+        conn (sqlite3.Connection): Database connection
+        segment_ids (list): Segment IDs
         
-        # Insert image into the database
-        cursor.execute("INSERT INTO images (name, data) VALUES (?, ?)", 
-                       (file.filename, contents))
-        image_id = cursor.lastrowid
+    Yields:
+        tuple: (seg_id, image, crop, box) per known segment
+    """
+    if not segment_ids:
+        return
+    rows = conn.execute(f"""
+        SELECT id, image_id FROM segments WHERE id IN ({','.join('?' * len(segment_ids))})
+    """, segment_ids).fetchall()
+    wanted_by_image = {}
+    for seg_id, image_id in rows:
+        wanted_by_image.setdefault(image_id, set()).add(seg_id)
+    for image_id, wanted in wanted_by_image.items():
+        image, segment_crops = load_segment_crops(conn, image_id)
+        for seg_id, crop, box in segment_crops:
+            if seg_id in wanted:
+                yield seg_id, image, crop, box
+
+
+def present_payload(payload: dict, image_mode: str = SEGMENT_IMAGE_MODE):
+    """
+    Applies an image delivery mode to a pipeline result or stream event. In
+    "thumbnail" mode the inline full-frame PNG of every segment is replaced by
+    a cropped thumbnail, and image_url points to the full crop. In "full" mode
+    segments processed for the thumbnail mode get their full-frame PNG, cut
+    from the stored image again.
+    
+    Args:
+        payload (dict): Result (single, batch or rescan) or event
+        image_mode (str): "full" or "thumbnail"
         
-        # Step 2: Process the image with SAM to generate masks
-        print("Segmenting image...")
-        masks = process_image_with_sam(contents)
+    Returns:
+        dict: The payload for the response (a copy if anything was changed)
+    """
+    def segments_to_present(payload):
+        # Identified segments (not the bounding boxes of "segmented" events)
+        containers = [payload] + [image for image in payload.get("images") or [] if isinstance(image, dict)]
+        segments = [segment for container in containers for segment in container.get("segments") or []
+                    if isinstance(segment, dict) and "name" in segment]
+        if isinstance(payload.get("segment"), dict):
+            segments.append(payload["segment"])
+        if image_mode == "full":
+            segments = [segment for segment in segments if "image" not in segment]
+        return segments
+    
+    if not segments_to_present(payload):
+        return payload
+    
+    payload = copy.deepcopy(payload)
+    segments = segments_to_present(payload)
+    segment_ids = [segment["id"] for segment in segments]
+    with get_connection() as conn:
+        if image_mode == "full":
+            images = {seg_id: f"data:image/png;base64,{frame_png(image.shape, crop, box)}"
+                      for seg_id, image, crop, box in recut_segments(conn, segment_ids)}
+        else:
+            thumbnails = load_segment_images(conn, segment_ids, "thumbnail")
+            images = {seg_id: segment_image_cache.data_url(data) for seg_id, data in thumbnails.items()}
+    for segment in segments:
+        if segment["id"] in images:
+            segment["image"] = images[segment["id"]]
+            if image_mode == "thumbnail":
+                segment["image_url"] = f"/segments/{segment['id']}/image"
+    return payload
+
+
+def store_segment_names(conn: sqlite3.Connection, segments_data: list):
+    """
+    Records the identified name and OCR confidence of segments, so a later
+    rescan of the shelf can carry them over.
+    
+    Args:
+        conn (sqlite3.Connection): Database connection
+        segments_data (list): Segment entries (see identified_segment)
+    """
+    conn.executemany("UPDATE segments SET name=?, text_confidence=? WHERE id=?", [
+        (segment_data["name"], segment_data["confidence"], segment_data["id"]) for segment_data in segments_data
+    ])
+    conn.commit()
+
+
+def store_segmented_image(conn: sqlite3.Connection, filename: str, contents: bytes, image_hash: str,
+                          ingested, masks: list, previous_image_id: Optional[int] = None):
+    """
+    Inserts an uploaded image and its SAM masks in one short transaction.
+    
+    Args:
+        conn (sqlite3.Connection): Database connection
+        filename (str): Name of the uploaded file
+        contents (bytes): Raw image data
+        image_hash (str): Content hash of the upload
+        ingested (ingest.IngestedImage): Decoded upload
+        masks (list): Filtered masks of the working copy
+        previous_image_id (int): Image this upload is a rescan of, if any
         
-        # Create segments directory if it doesn't exist
-        if not os.path.exists('/app/data/segments'):
-            os.makedirs('/app/data/segments')
+    Returns:
+        tuple: (image_id, segment_boxes) where segment_boxes holds the id, XYWH
+            bbox and mask size of every stored segment
+    """
+    # Encode the masks as compact bit-packed blobs and, optionally, the working copy and thumbnail
+    segment_rows = []
+    for mask in masks:
+        segmentation = as_compact(mask['segmentation'])
+        mask_height, mask_width = segmentation.shape
+        segment_rows.append((mask_width, mask_height, float(mask.get('stability_score', 0.0)),
+                             segmentation.encode()))
+    working_data = thumbnail = None
+    if STORE_IMAGE_DERIVATIVES:
+        working_data = encode_jpeg(ingested.working)
+        thumbnail = make_thumbnail(ingested.working)
+    
+    cursor = conn.cursor()
+    cursor.execute("""
+        INSERT INTO images (name, data, content_hash, working_data, thumbnail, previous_image_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (filename, contents, image_hash, working_data, thumbnail, previous_image_id))
+    image_id = cursor.lastrowid
+    cursor.executemany("""
+        INSERT INTO segments (image_id, mask_path, mask_width, mask_height, confidence, mask_data)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [(image_id, None) + row for row in segment_rows])
+    
+    # Segment ids are assigned in insertion order
+    cursor.execute("SELECT id FROM segments WHERE image_id=? ORDER BY id", (image_id,))
+    segment_ids = [row[0] for row in cursor.fetchall()]
+    conn.commit()
+    
+    segment_boxes = [{
+        "id": seg_id,
+        "bbox": [int(v) for v in mask['bbox']],  # XYWH in mask coordinates
+        "mask_width": mask_width,
+        "mask_height": mask_height
+    } for seg_id, mask, (mask_width, mask_height, _, _) in zip(segment_ids, masks, segment_rows)]
+    return image_id, segment_boxes
+
+
+def iter_pipeline(contents: bytes, filename: str, api_key: Optional[str] = None,
+                  profile: str = SEGMENTATION_PROFILE, image_mode: str = SEGMENT_IMAGE_MODE):
+    """
+    Runs the entire image processing pipeline on an uploaded image and yields
+    progress events as soon as they are available:
+    1. Store the image
+    2. Segment it using SAM -> "segmented" event with segment count and bboxes
+    3. Clean it (filter segments with text) -> "filtered" event
+    4. Identify the games -> one "segment" event per identified segment
+       (steps 3 and 4 overlap, see stream_segments)
+    5. Finish -> "summary" event (or an "error" event on failure)
+    
+    This is blocking model work and runs on the job queue's worker threads.
+    
+    Args:
+        contents (bytes): Raw image data
+        filename (str): Name of the uploaded file
+        api_key (str): OpenAI API key, falls back to the environment if None
+        profile (str): Mask generator profile name, "auto" or "prompted"
+        image_mode (str): Image delivery mode the result is encoded for, see text_segment
         
-        # Store each mask as a file and save path in database
-        for idx, mask in enumerate(masks):
-            mask_array = mask['segmentation']
-            mask_height, mask_width = mask_array.shape
-            
-            # Create unique filename for each mask
-            mask_filename = f"mask_{image_id}_{idx}.npy"
-            mask_path = os.path.join('/app/data/segments', mask_filename)
-            
-            # Save mask to file
-            np.save(mask_path, mask_array)
-            
-            cursor.execute("""
-                INSERT INTO segments (image_id, mask_path, mask_width, mask_height, confidence)
-                VALUES (?, ?, ?, ?, ?)
-            """, (image_id, mask_path, mask_width, mask_height, float(mask.get('stability_score', 0.0))))
+    Yields:
+        dict: Event with an "event" key naming its type
+    """
+    # Requests get their trace ID from the middleware; direct callers get a new one
+    if trace_id_var.get() is None:
+        trace_id_var.set(new_trace_id())
+    started = time.perf_counter()
+    
+    try:
+        conn = pool.acquire()
+    except Exception as e:
+        log("Error connecting to database", error=str(e))
+        REQUEST_SECONDS.observe(time.perf_counter() - started, outcome="error")
+        yield {"event": "error", "error": "Database connection failed", "status_code": 500}
+        return
+    
+    try:
+        profile = resolve_profile(profile, contents)
+        cache_settings_key = CACHE_SETTINGS_KEYS[profile]
         
-        conn.commit()
+        # Return the stored result if this exact image was already processed
+        image_hash = hash_image(contents)
+        cached_result = get_cached_result(conn, image_hash, cache_settings_key, CACHE_VERSION)
+        RESULT_CACHE_LOOKUPS.inc(result="miss" if cached_result is None else "hit")
+        if cached_result is not None:
+            log("Returning cached result", image_id=cached_result['image_id'])
+            REQUEST_SECONDS.observe(time.perf_counter() - started, outcome="cached")
+            for segment in cached_result["segments"]:
+                yield {"event": "segment", "image_id": cached_result["image_id"], "segment": segment}
+            yield {
+                "event": "summary",
+                "image_id": cached_result["image_id"],
+                "segment_count": len(cached_result["segments"]),
+                "message": cached_result["message"],
+                "profile": profile,
+                "cached": True,
+                "status_code": 200
+            }
+            return
         
-        # Step 3: Clean segments (filter those with text)
-        print("Cleaning segments...")
-        filtered_segments = get_filtered_segments(image_id)
+        # Decode the upload once; every later stage works on these arrays
+        with STAGE_SECONDS.time(stage="decode"):
+            ingested = ingest_image(
+                contents,
+                max_size=SEGMENTATION_SETTINGS['max_size'],
+                detail_max_size=SEGMENTATION_SETTINGS['detail_max_size']
+            )
         
-        if not filtered_segments:
-            return JSONResponse({
-                "image_id": image_id,
-                "segments": [],
-                "message": "No text segments found in the image"
-            })
+        # Step 2: Process the image with SAM to generate masks (before opening the
+        # write transaction, so the database is not locked while the model runs)
+        log("Segmenting image", filename=filename, profile=profile, size=ingested.working.shape[:2])
+        masks = process_image_with_sam(ingested.working, profile)
+        
+        # Insert the image and all of its segments in one short transaction
+        image_id, segment_boxes = store_segmented_image(conn, filename, contents, image_hash, ingested, masks)
         
-        # Step 4: Identify games for each segment
-        print("Identifying games...")
-        # Use the provided API key if available
-        ai = AIAPI(api_key=x_openai_api_key)
+        yield {
+            "event": "segmented",
+            "image_id": image_id,
+            "profile": profile,
+            "segment_count": len(segment_boxes),
+            "segments": segment_boxes
+        }
+        
+        # Steps 3 and 4: Clean segments (filter those with text) and identify the
+        # games, each segment moving on as soon as it passes the text filter
+        log("Cleaning and identifying segments", image_id=image_id, segments=len(segment_boxes))
+        segments = [(segment_box["id"], as_compact(mask['segmentation']))
+                    for segment_box, mask in zip(segment_boxes, masks)]
+        text_segments = 0
         segments_data = []
+        identification_failed = False
         
-        # Process each filtered segment to get game names
-        for segment in filtered_segments:
-            seg_id = segment['seg_id']
-            base64_image = segment['base64_image']
-            
-            try:
-                # Get AI analysis for the segment with retry logic for rate limits
-                api_response = ai.getAPIResponse(
-                    base64_image, 
-                    max_retries=50,  # Retry up to 5 times
-                    initial_backoff=1  # Start with 1 second backoff
-                )
+        # Each segment is reported as soon as it is resolved; closing this generator
+        # (the client went away) closes stream_segments, which cancels its stages
+        with contextlib.closing(stream_segments(conn, ingested.image, segments, api_key,
+                                                 image_mode=image_mode)) as segment_events:
+            for event in segment_events:
+                if event[0] == "filtered":
+                    text_segments = event[1]
+                    yield {"event": "filtered", "image_id": image_id, "segment_count": text_segments}
+                    continue
                 
-                if api_response:
-                    boardGame = ai.parse_api_response(api_response).boardGame
-                    game_name = boardGame.name
-                else:
-                    print(f"No valid response for segment {seg_id}, possibly due to insufficient balance")
-                    game_name = "Unknown Game (Check OpenAI balance)"
-            except Exception as e:
-                print(f"Error identifying game for segment {seg_id}: {str(e)}")
-                game_name = "Unknown Game"
-            
-            # Add to results
-            segments_data.append({
-                "id": seg_id,
-                "confidence": segment["confidence"],
-                "image": f"data:image/png;base64,{base64_image}",
-                "name": game_name
-            })
+                _, segment, game_name, source, failed = event
+                segment_data = identified_segment(segment, game_name)
+                segments_data.append(segment_data)
+                identification_failed = identification_failed or failed
+                yield {"event": "segment", "image_id": image_id, "segment": segment_data, "source": source}
+        
+        if not text_segments:
+            result = {
+                "image_id": image_id,
+                "segments": [],
+                "message": "No text segments found in the image"
+            }
+            store_result(conn, image_hash, cache_settings_key, CACHE_VERSION, image_id, result)
+            REQUEST_SECONDS.observe(time.perf_counter() - started, outcome="ok")
+            yield {
+                "event": "summary",
+                "image_id": image_id,
+                "segment_count": 0,
+                "message": result["message"],
+                "profile": profile,
+                "status_code": 200
+            }
+            return
+        
+        # Keep the segments in their original order
+        segments_data.sort(key=lambda segment_data: segment_data["id"])
+        store_segment_names(conn, segments_data)
         
         # Step 5: Return the segment data as expected by the frontend
-        return JSONResponse({
+        result = {
             "image_id": image_id,
             "segments": segments_data,
             "message": "Image processed successfully"
+        }
+        
+        # Only cache complete results so failed identifications are retried
+        if not identification_failed:
+            store_result(conn, image_hash, cache_settings_key, CACHE_VERSION, image_id, result)
+        
+        REQUEST_SECONDS.observe(time.perf_counter() - started, outcome="ok")
+        log("Image processed", image_id=image_id, segments=len(segments_data),
+            seconds=round(time.perf_counter() - started, 3))
+        yield {
+            "event": "summary",
+            "image_id": image_id,
+            "segment_count": len(segments_data),
+            "message": result["message"],
+            "profile": profile,
+            "status_code": 200
+        }
+        
+    except Exception as e:
+        log("Error processing image", error=str(e))
+        REQUEST_SECONDS.observe(time.perf_counter() - started, outcome="error")
+        yield {"event": "error", "error": str(e), "status_code": 500}
+    finally:
+        pool.release(conn)
+
+
+def run_pipeline(contents: bytes, filename: str, api_key: Optional[str] = None,
+                 profile: str = SEGMENTATION_PROFILE, image_mode: str = SEGMENT_IMAGE_MODE):
+    """
+    Runs the pipeline to completion and assembles the response expected by the frontend.
+    
+    Args:
+        contents (bytes): Raw image data
+        filename (str): Name of the uploaded file
+        api_key (str): OpenAI API key, falls back to the environment if None
+        profile (str): Mask generator profile name, "auto" or "prompted"
+        image_mode (str): Image delivery mode the result is encoded for, see text_segment
+        
+    Returns:
+        tuple: (payload, status_code) where payload contains image_id and the list of processed segments
+    """
+    segments_data = []
+    for event in iter_pipeline(contents, filename, api_key, profile, image_mode):
+        if event["event"] == "segment":
+            segments_data.append(event["segment"])
+        elif event["event"] == "summary":
+            return {
+                "image_id": event["image_id"],
+                "segments": sorted(segments_data, key=lambda segment: segment["id"]),
+                "message": event["message"]
+            }, event["status_code"]
+        elif event["event"] == "error":
+            return {"error": event["error"]}, event["status_code"]
+    
+    return {"error": "Pipeline ended without a result"}, 500
+
+
+def run_batch_pipeline(uploads: List[tuple], api_key: Optional[str] = None,
+                       profile: str = SEGMENTATION_PROFILE, image_mode: str = SEGMENT_IMAGE_MODE):
+    """
+    Runs the pipeline on several photos of one collection at once, sharing the
+    model and API work between them:
+    1. Decode every image (images processed before come from the result cache)
+    2. Run the SAM image encoder on the new images in batches, then generate
+       and filter the masks of each image
+    3. Check the segments of all images for text in shared OCR batches
+    4. Identify the remaining segments of all images in one concurrent phase
+    5. Merge the games found on all images into one collection list
+    
+    A failure in one image is reported for that image only.
+    
+    Args:
+        uploads (list): (filename, contents) tuples
+        api_key (str): OpenAI API key, falls back to the environment if None
+        profile (str): Mask generator profile name, "auto" or "prompted"
+        image_mode (str): Image delivery mode the result is encoded for, see text_segment
+        
+    Returns:
+        tuple: (payload, status_code) where payload contains "images" (per upload,
+            the /process_image result with filename and profile, or an error),
+            "collection" (see collection.merge_collection) and a message
+    """
+    if trace_id_var.get() is None:
+        trace_id_var.set(new_trace_id())
+    started = time.perf_counter()
+    
+    try:
+        conn = pool.acquire()
+    except Exception as e:
+        log("Error connecting to database", error=str(e))
+        return {"error": "Database connection failed"}, 500
+    
+    try:
+        images = [{"filename": filename, "contents": contents} for filename, contents in uploads]
+        
+        # Step 1: Answer repeated images from the result cache and decode the rest
+        pending = []
+        for image in images:
+            try:
+                image["profile"] = resolve_profile(profile, image["contents"])
+                image["settings_key"] = CACHE_SETTINGS_KEYS[image["profile"]]
+                image["hash"] = hash_image(image["contents"])
+                cached_result = get_cached_result(conn, image["hash"], image["settings_key"], CACHE_VERSION)
+                RESULT_CACHE_LOOKUPS.inc(result="miss" if cached_result is None else "hit")
+                if cached_result is not None:
+                    image["result"] = dict(cached_result, cached=True)
+                    continue
+                with STAGE_SECONDS.time(stage="decode"):
+                    image["ingested"] = ingest_image(
+                        image["contents"],
+                        max_size=SEGMENTATION_SETTINGS['max_size'],
+                        detail_max_size=SEGMENTATION_SETTINGS['detail_max_size']
+                    )
+                pending.append(image)
+            except Exception as e:
+                log("Error decoding image", filename=image["filename"], error=str(e))
+                image["error"] = str(e)
+        
+        # Step 2: Batched encoder passes fill the embedding cache, so segmenting
+        # each image below reuses its embedding instead of running the encoder
+        if pending:
+            log("Encoding images", images=len(pending), batch_size=ENCODER_BATCH_SIZE)
+            try:
+                precompute_embeddings([image["ingested"].working for image in pending])
+            except Exception as e:
+                log("Batched encoding failed, encoding images one by one", error=str(e))
+        
+        segmented = []
+        for image in pending:
+            try:
+                log("Segmenting image", filename=image["filename"], profile=image["profile"])
+                masks = process_image_with_sam(image["ingested"].working, image["profile"])
+                image["image_id"], _ = store_segmented_image(
+                    conn, image["filename"], image["contents"], image["hash"], image["ingested"], masks)
+                _, image["crops"] = load_segment_crops(conn, image["image_id"], image["ingested"].image)
+                segmented.append(image)
+            except Exception as e:
+                log("Error segmenting image", filename=image["filename"], error=str(e))
+                image["error"] = str(e)
+        
+        # Step 3: One text check over the segments of every image
+        crops = [(image, seg_id, crop, box) for image in segmented for seg_id, crop, box in image["crops"]]
+        log("Checking segments for text", images=len(segmented), segments=len(crops), mode=OCR_MODE)
+        ocr_results = []
+        if crops:
+            ocr_results = check_text([crop for _, _, crop, _ in crops])
+        for image in segmented:
+            image["text_segments"] = []
+            image["segments"] = []
+            image["identification_failed"] = False
+        for (image, seg_id, crop, box), (confidence, text) in zip(crops, ocr_results):
+            if confidence is not None:
+                image["text_segments"].append(text_segment(image["ingested"].image, seg_id, crop, box, confidence,
+                                                           text, image_mode))
+        
+        # Step 4: One identification phase (cache, catalog, then concurrent API calls) for all images
+        identification_started = time.perf_counter()
+        to_identify = [(image, segment) for image in segmented for segment in image["text_segments"]]
+        log("Identifying games", images=len(segmented), segments=len(to_identify))
+        for index, game_name, _, failed in identify_segments(conn, [segment for _, segment in to_identify], api_key):
+            image, segment = to_identify[index]
+            image["segments"].append(identified_segment(segment, game_name))
+            image["identification_failed"] = image["identification_failed"] or failed
+        STAGE_SECONDS.observe(time.perf_counter() - identification_started, stage="identification")
+        
+        # Step 5: Per-image results (cached like single uploads) and the merged collection
+        for image in segmented:
+            image["result"] = {
+                "image_id": image["image_id"],
+                "segments": sorted(image["segments"], key=lambda segment_data: segment_data["id"]),
+                "message": "Image processed successfully" if image["text_segments"]
+                           else "No text segments found in the image"
+            }
+            store_segment_names(conn, image["result"]["segments"])
+            if not image["identification_failed"]:
+                store_result(conn, image["hash"], image["settings_key"], CACHE_VERSION,
+                             image["image_id"], image["result"])
+        
+        results = []
+        for image in images:
+            if "error" in image:
+                results.append({"filename": image["filename"], "error": image["error"]})
+            else:
+                results.append({"filename": image["filename"], "profile": image["profile"], **image["result"]})
+        
+        processed = [result for result in results if "error" not in result]
+        log("Batch processed", images=len(images), failed=len(results) - len(processed),
+            seconds=round(time.perf_counter() - started, 3))
+        return {
+            "images": results,
+            "collection": merge_collection(processed),
+            "message": f"Processed {len(processed)} of {len(results)} images"
+        }, 200 if processed else 500
+        
+    except Exception as e:
+        log("Error processing batch", error=str(e))
+        return {"error": str(e)}, 500
+    finally:
+        pool.release(conn)
+
+
+def load_identified_segments(conn: sqlite3.Connection, image_id: int):
+    """
+    Loads the segments of a processed image that were shown to the user, with
+    their full masks and identified names.
+    
+    Args:
+        conn (sqlite3.Connection): Database connection
+        image_id (int): ID of the image
+        
+    Returns:
+        list: Dicts with id, mask (CompactMask at the image's working
+            resolution), stability_score, name and confidence (OCR)
+    """
+    rows = conn.execute("""
+        SELECT id, mask_path, mask_width, mask_height, confidence, mask_data, name, text_confidence
+        FROM segments WHERE image_id=? ORDER BY id
+    """, (image_id,)).fetchall()
+    
+    names = {row[0]: (row[6], row[7]) for row in rows if row[6] is not None}
+    if not names:
+        # Images processed before names were stored on segments: use the cached result
+        cached = conn.execute("""
+            SELECT result FROM result_cache WHERE image_id=? ORDER BY created_at DESC LIMIT 1
+        """, (image_id,)).fetchone()
+        if cached:
+            names = {segment["id"]: (segment["name"], segment["confidence"])
+                     for segment in json.loads(cached[0])["segments"]}
+    
+    segments = []
+    for seg_id, mask_path, mask_width, mask_height, stability_score, mask_data, _, _ in rows:
+        if seg_id not in names:
+            continue
+        crop, (y0, x0, _, _) = load_mask_crop(mask_data, mask_path)
+        mask = CompactMask.from_crop(crop, (y0, x0), (mask_height, mask_width))
+        name, confidence = names[seg_id]
+        segments.append({
+            "id": seg_id,
+            "mask": mask,
+            "stability_score": stability_score or 0.0,
+            "name": name,
+            "confidence": confidence
         })
+    return segments
+
+
+def rescan_image(conn: sqlite3.Connection, contents: bytes, filename: str, previous_image_id: int,
+                 api_key: Optional[str] = None, profile: str = SEGMENTATION_PROFILE,
+                 image_mode: str = SEGMENT_IMAGE_MODE):
+    """
+    Processes a new photo of a shelf that was scanned before, redoing only what changed:
+    1. Align the new photo to the previous one and find the changed pixels
+    2. Carry over the previous segments (and names) whose region is unchanged
+    3. Segment only the changed regions with SAM
+    4. Check the new segments for text and identify them (plus carried-over
+       segments that could not be identified before)
+    
+    Args:
+        conn (sqlite3.Connection): Database connection
+        contents (bytes): Raw image data of the new photo
+        filename (str): Name of the uploaded file
+        previous_image_id (int): ID of the previously processed photo
+        api_key (str): OpenAI API key, falls back to the environment if None
+        profile (str): Mask generator profile name, "auto" or "prompted"
+        image_mode (str): Image delivery mode the result is encoded for, see text_segment
+        
+    Returns:
+        tuple: (payload, status_code) where payload has the /process_image
+            fields plus "rescan" statistics
+        
+    Raises:
+        RescanNotPossible: If the photo has to be processed as a whole instead
+    """
+    previous_row = conn.execute("SELECT data FROM images WHERE id=?", (previous_image_id,)).fetchone()
+    if not previous_row:
+        return {"error": f"Image {previous_image_id} not found"}, 404
+    
+    profile = resolve_profile(profile, contents)
+    image_hash = hash_image(contents)
+    cache_settings_key = CACHE_SETTINGS_KEYS[profile]
+    cached_result = get_cached_result(conn, image_hash, cache_settings_key, CACHE_VERSION)
+    RESULT_CACHE_LOOKUPS.inc(result="miss" if cached_result is None else "hit")
+    if cached_result is not None:
+        return dict(cached_result, cached=True, rescan={
+            "previous_image_id": previous_image_id,
+            "incremental": False,
+            "reason": "this photo was processed before"
+        }), 200
+    
+    previous_segments = load_identified_segments(conn, previous_image_id)
+    if not previous_segments:
+        raise RescanNotPossible("the previous image has no identified segments")
+    
+    with STAGE_SECONDS.time(stage="decode"):
+        previous = ingest_image(
+            previous_row[0],
+            max_size=SEGMENTATION_SETTINGS['max_size'],
+            detail_max_size=SEGMENTATION_SETTINGS['detail_max_size']
+        ).working
+        ingested = ingest_image(
+            contents,
+            max_size=SEGMENTATION_SETTINGS['max_size'],
+            detail_max_size=SEGMENTATION_SETTINGS['detail_max_size']
+        )
+    shape = ingested.working.shape[:2]
+    
+    # Step 1: Align and compare the photos
+    with STAGE_SECONDS.time(stage="alignment"):
+        homography, inliers = align_images(previous, ingested.working)
+        if homography is None:
+            raise RescanNotPossible(f"the photos could not be aligned ({inliers} matching features)")
+        changed = find_changes(previous, ingested.working, homography)
+    changed_fraction = float(changed.mean())
+    if changed_fraction > RESCAN_SETTINGS['max_changed_fraction']:
+        raise RescanNotPossible(f"{changed_fraction:.0%} of the photo changed")
+    
+    # Step 2: Carry over segments whose region did not change
+    area_scale = abs(np.linalg.det(homography[:2, :2]))
+    carried, carried_area = [], np.zeros(shape, dtype=bool)
+    for segment in previous_segments:
+        mask = segment["mask"].to_mask()
+        if mask.shape != previous.shape[:2]:
+            mask = cv2.resize(mask.astype(np.uint8), (previous.shape[1], previous.shape[0]),
+                              interpolation=cv2.INTER_NEAREST) > 0
+        warped = warp_mask(mask, homography, shape)
+        area = int(warped.sum())
+        if area == 0 or area < RESCAN_SETTINGS['min_visible_fraction'] * mask.sum() * area_scale:
+            continue
+        if changed[warped].mean() > RESCAN_SETTINGS['max_segment_change']:
+            continue
+        segmentation = CompactMask.from_mask(warped)
+        y0, x0, height, width = segmentation.bbox
+        carried.append((segment, {
+            "segmentation": segmentation,
+            "area": area,
+            "bbox": [x0, y0, width, height],
+            "stability_score": segment["stability_score"]
+        }))
+        carried_area |= warped
+    
+    # Step 3: Segment the changed regions that no carried-over segment covers
+    regions = find_changed_regions(changed & ~carried_area)
+    if len(regions) > RESCAN_SETTINGS['max_regions']:
+        raise RescanNotPossible(f"{len(regions)} separate regions changed")
+    
+    log("Rescanning image", previous_image_id=previous_image_id, changed_fraction=round(changed_fraction, 3),
+        carried_over=len(carried), regions=len(regions), profile=profile)
+    region_masks = []
+    for x0, y0, x1, y1 in regions:
+        for mask in generate_masks(ingested.working[y0:y1, x0:x1], profile):
+            segmentation = mask['segmentation'].moved((y0, x0), shape)
+            box_x, box_y, box_width, box_height = mask['bbox']
+            region_masks.append(dict(mask, segmentation=segmentation,
+                                     bbox=[box_x + x0, box_y + y0, box_width, box_height]))
+    
+    new_masks = []
+    for mask in filter_masks(region_masks):
+        segmentation = mask['segmentation']
+        area = max(segmentation.area, 1)
+        # Masks of unchanged objects at the edge of a region were already handled in the previous scan
+        if segmentation.count_in(changed) / area < RESCAN_SETTINGS['min_new_mask_change']:
+            continue
+        if segmentation.count_in(carried_area) / area > RESCAN_SETTINGS['max_carried_overlap']:
+            continue
+        new_masks.append(mask)
+    
+    masks = [mask for _, mask in carried] + new_masks
+    image_id, segment_boxes = store_segmented_image(conn, filename, contents, image_hash, ingested, masks,
+                                                    previous_image_id=previous_image_id)
+    _, segment_crops = load_segment_crops(conn, image_id, ingested.image)
+    
+    # Carried-over segments were inserted first
+    previous_by_id = {box["id"]: segment for box, (segment, _) in zip(segment_boxes, carried)}
+    
+    # Step 4: Text check for the new segments only, then identification
+    segments_data, to_identify = [], []
+    new_crops = [(seg_id, crop, box) for seg_id, crop, box in segment_crops if seg_id not in previous_by_id]
+    for seg_id, crop, box in segment_crops:
+        previous_segment = previous_by_id.get(seg_id)
+        if previous_segment is None:
+            continue
+        segment = text_segment(ingested.image, seg_id, crop, box, previous_segment["confidence"],
+                               image_mode=image_mode)
+        if previous_segment["name"].startswith(UNIDENTIFIED_PREFIX):
+            to_identify.append(segment)
+        else:
+            segments_data.append(identified_segment(segment, previous_segment["name"]))
+    
+    if new_crops:
+        ocr_results = check_text([crop for _, crop, _ in new_crops])
+        to_identify.extend(text_segment(ingested.image, seg_id, crop, box, confidence, text, image_mode)
+                           for (seg_id, crop, box), (confidence, text) in zip(new_crops, ocr_results)
+                           if confidence is not None)
+    
+    identification_started = time.perf_counter()
+    identification_failed = False
+    for index, game_name, _, failed in identify_segments(conn, to_identify, api_key):
+        segments_data.append(identified_segment(to_identify[index], game_name))
+        identification_failed = identification_failed or failed
+    STAGE_SECONDS.observe(time.perf_counter() - identification_started, stage="identification")
+    
+    segments_data.sort(key=lambda segment_data: segment_data["id"])
+    store_segment_names(conn, segments_data)
+    result = {
+        "image_id": image_id,
+        "segments": segments_data,
+        "message": "Image processed successfully" if segments_data else "No text segments found in the image"
+    }
+    if not identification_failed:
+        store_result(conn, image_hash, cache_settings_key, CACHE_VERSION, image_id, result)
+    
+    return dict(result, rescan={
+        "previous_image_id": previous_image_id,
+        "incremental": True,
+        "changed_fraction": round(changed_fraction, 4),
+        "carried_over": len(carried),
+        "regions": len(regions),
+        "new_segments": len(new_masks),
+        "identified": len(to_identify)
+    }), 200
+
+
+def run_rescan_pipeline(contents: bytes, filename: str, previous_image_id: int, api_key: Optional[str] = None,
+                        profile: str = SEGMENTATION_PROFILE, image_mode: str = SEGMENT_IMAGE_MODE):
+    """
+    Processes a new photo of a previously scanned shelf incrementally (see
+    rescan_image), or as a whole with run_pipeline if the photos cannot be
+    aligned or too much has changed.
+    
+    Args:
+        contents (bytes): Raw image data
+        filename (str): Name of the uploaded file
+        previous_image_id (int): ID of the previously processed photo of the shelf
+        api_key (str): OpenAI API key, falls back to the environment if None
+        profile (str): Mask generator profile name, "auto" or "prompted"
+        image_mode (str): Image delivery mode the result is encoded for, see text_segment
         
+    Returns:
+        tuple: (payload, status_code) in the /process_image format, with a
+            "rescan" entry describing what was reused
+    """
+    if trace_id_var.get() is None:
+        trace_id_var.set(new_trace_id())
+    started = time.perf_counter()
+    
+    try:
+        conn = pool.acquire()
     except Exception as e:
-        print(f"Error processing image: {str(e)}")
-        return JSONResponse({"error": str(e)}, status_code=500)
+        log("Error connecting to database", error=str(e))
+        return {"error": "Database connection failed"}, 500
+    
+    try:
+        payload, status_code = rescan_image(conn, contents, filename, previous_image_id, api_key, profile,
+                                            image_mode)
+        if status_code == 200:
+            REQUEST_SECONDS.observe(time.perf_counter() - started, outcome="rescan")
+        return payload, status_code
+    except RescanNotPossible as e:
+        reason = str(e)
+    except Exception as e:
+        log("Error rescanning image", previous_image_id=previous_image_id, error=str(e))
+        return {"error": str(e)}, 500
     finally:
-        conn.close()
+        pool.release(conn)
+    
+    log("Processing the whole image instead of rescanning", previous_image_id=previous_image_id, reason=reason)
+    payload, status_code = run_pipeline(contents, filename, api_key, profile, image_mode)
+    if status_code == 200:
+        payload["rescan"] = {"previous_image_id": previous_image_id, "incremental": False, "reason": reason}
+    return payload, status_code
+
+
+def unknown_profile_response(profile: str):
+    """
+    Validates a requested mask generator profile.
+    
+    Args:
+        profile (str): Profile name from the request
+        
+    Returns:
+        JSONResponse: 400 response if the profile is unknown, otherwise None
+    """
+    if profile in PROFILE_NAMES:
+        return None
+    return JSONResponse(
+        {"error": f"Unknown profile '{profile}', expected one of {list(PROFILE_NAMES)}"},
+        status_code=400
+    )
+
+
+def unknown_image_mode_response(image_mode: str):
+    """
+    Validates a requested image delivery mode.
+    
+    Args:
+        image_mode (str): Image mode from the request
+        
+    Returns:
+        JSONResponse: 400 response if the mode is unknown, otherwise None
+    """
+    if image_mode in IMAGE_MODES:
+        return None
+    return JSONResponse(
+        {"error": f"Unknown image_mode '{image_mode}', expected one of {list(IMAGE_MODES)}"},
+        status_code=400
+    )
+
+
+# Bounded worker pool so model work never runs on the event loop
+job_queue = JobQueue(
+    max_workers=int(os.environ.get('MODEL_WORKERS', '1')),
+    max_pending=int(os.environ.get('MAX_QUEUED_JOBS', '16'))
+)
+
+
+@app.on_event("shutdown")
+def stop_job_queue():
+    job_queue.shutdown()
+
+
+def submit_pipeline(contents: bytes, filename: str, api_key: Optional[str], profile: str,
+                    previous_image_id: Optional[int] = None, inline: bool = False,
+                    image_mode: str = SEGMENT_IMAGE_MODE):
+    """
+    Enqueues a full pipeline run, or a rescan if previous_image_id is given.
+    
+    Args:
+        inline (bool): The caller waits for the result itself, so the job is
+            not kept for /jobs once it has finished (see JobQueue.submit_inline)
+        image_mode (str): Image delivery mode the result will most likely be
+            presented in; the other mode still works, at the cost of re-cutting
+    
+    Returns:
+        Job: The queued job
+        
+    Raises:
+        QueueFullError: If the job queue is full
+    """
+    submit = job_queue.submit_inline if inline else job_queue.submit
+    if previous_image_id is not None:
+        return submit(run_rescan_pipeline, contents, filename, previous_image_id, api_key, profile, image_mode)
+    return submit(run_pipeline, contents, filename, api_key, profile, image_mode)
+
+
+@app.post("/process_image")
+async def process_image(
+    file: UploadFile = File(...), 
+    request: Request = None, 
+    x_openai_api_key: str = Header(None),
+    profile: str = SEGMENTATION_PROFILE,
+    previous_image_id: Optional[int] = None,
+    image_mode: str = SEGMENT_IMAGE_MODE
+):
+    """
+    Combined endpoint that handles the entire image processing pipeline
+    (see run_pipeline). The work runs on the job queue and this request waits
+    for it without blocking other clients.
+    
+    Args:
+        file (UploadFile): Image file to be uploaded
+        request (Request): The FastAPI request object
+        x_openai_api_key (str): OpenAI API key from header
+        profile (str): Mask generator profile ("fast", "balanced", "accurate", "auto" or "prompted")
+        previous_image_id (int): Rescan mode: ID of an earlier photo of the same
+            shelf; only the regions that changed since are segmented and
+            identified (see run_rescan_pipeline)
+        image_mode (str): "full" for full-frame PNGs or "thumbnail" for cropped
+            thumbnails plus image_url (see present_payload)
+        
+    Returns:
+        JSONResponse: Contains image_id and list of processed segments with:
+            - id: segment identifier
+            - confidence: OCR confidence score
+            - image: base64 encoded PNG of the segmented region (or thumbnail)
+            - image_url: URL of the full crop (thumbnail mode)
+            - name: identified game name
+        In rescan mode it also contains "rescan" with what was reused.
+        Responds with 429 if too many images are already being processed.
+    """
+    invalid = unknown_profile_response(profile) or unknown_image_mode_response(image_mode)
+    if invalid:
+        return invalid
+    
+    contents = await file.read()
+    
+    try:
+        job = submit_pipeline(contents, file.filename, x_openai_api_key, profile, previous_image_id, inline=True,
+                              image_mode=image_mode)
+    except QueueFullError as e:
+        return JSONResponse({"error": str(e)}, status_code=429)
+    
+    await job_queue.wait(job)
+    return JSONResponse(await run_in_threadpool(present_payload, job.result, image_mode), status_code=job.status_code)
+
+
+@app.post("/process_image/stream")
+async def process_image_stream(
+    file: UploadFile = File(...), 
+    x_openai_api_key: str = Header(None),
+    format: str = "ndjson",
+    profile: str = SEGMENTATION_PROFILE,
+    image_mode: str = SEGMENT_IMAGE_MODE
+):
+    """
+    Streaming variant of /process_image that reports results as soon as they
+    are available instead of one response at the end. Emits:
+    - segmented: segment count and bounding boxes once SAM has finished
+    - segment: one per segment as soon as its game name is resolved
+    - filtered: number of segments that contain text, once every segment has
+      been through the text filter (segments are identified meanwhile, so
+      some segment events may come first)
+    - summary (or error): once the pipeline has finished
+    
+    Args:
+        file (UploadFile): Image file to be uploaded
+        x_openai_api_key (str): OpenAI API key from header
+        format (str): "ndjson" for newline-delimited JSON or "sse" for server-sent events
+        profile (str): Mask generator profile ("fast", "balanced", "accurate", "auto" or "prompted")
+        image_mode (str): "full" or "thumbnail", see /process_image
+        
+    Returns:
+        StreamingResponse: Stream of events, or 429 if too many images are already being processed
+    """
+    invalid = unknown_profile_response(profile) or unknown_image_mode_response(image_mode)
+    if invalid:
+        return invalid
+    
+    contents = await file.read()
+    
+    try:
+        job, events = job_queue.submit_stream(iter_pipeline, contents, file.filename, x_openai_api_key, profile,
+                                              image_mode)
+    except QueueFullError as e:
+        return JSONResponse({"error": str(e)}, status_code=429)
+    
+    async def encode_events():
+        try:
+            async for event in events:
+                if event["event"] == "segment":
+                    event = await run_in_threadpool(present_payload, event, image_mode)
+                if format == "sse":
+                    yield f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+                else:
+                    yield json.dumps(event) + "\n"
+        finally:
+            # Also when the client disconnects: stops the pipeline behind the stream
+            await events.aclose()
+    
+    media_type = "text/event-stream" if format == "sse" else "application/x-ndjson"
+    return StreamingResponse(encode_events(), media_type=media_type, headers={
+        "X-Job-Id": job.id,
+        "Cache-Control": "no-cache"
+    })
+
+
+@app.post("/process_images")
+async def process_images(
+    files: List[UploadFile] = File(...), 
+    x_openai_api_key: str = Header(None),
+    profile: str = SEGMENTATION_PROFILE,
+    image_mode: str = SEGMENT_IMAGE_MODE
+):
+    """
+    Processes several photos of a collection (e.g. one per shelf) in one job
+    (see run_batch_pipeline). Faster than one /process_image call per photo:
+    the image encoder runs on batches of images, and OCR and identification
+    are shared by all of them.
+    
+    Args:
+        files (List[UploadFile]): Image files, at most MAX_BATCH_IMAGES
+        x_openai_api_key (str): OpenAI API key from header
+        profile (str): Mask generator profile ("fast", "balanced", "accurate", "auto" or "prompted")
+        image_mode (str): "full" or "thumbnail", see /process_image
+        
+    Returns:
+        JSONResponse: images (per-image results in the /process_image format,
+            with filename and profile) and collection (the games of all images,
+            with duplicates merged). Responds with 400 for too many images and
+            429 if too many images are already being processed.
+    """
+    invalid = unknown_profile_response(profile) or unknown_image_mode_response(image_mode)
+    if invalid:
+        return invalid
+    if len(files) > MAX_BATCH_IMAGES:
+        return JSONResponse(
+            {"error": f"Too many images ({len(files)}), at most {MAX_BATCH_IMAGES} per request"},
+            status_code=400
+        )
+    
+    uploads = [(file.filename, await file.read()) for file in files]
+    
+    try:
+        job = job_queue.submit_inline(run_batch_pipeline, uploads, x_openai_api_key, profile, image_mode)
+    except QueueFullError as e:
+        return JSONResponse({"error": str(e)}, status_code=429)
+    
+    await job_queue.wait(job)
+    return JSONResponse(await run_in_threadpool(present_payload, job.result, image_mode), status_code=job.status_code)
+
+
+@app.get("/segments/{segment_id}/image")
+def get_segment_image(segment_id: int, request: Request, variant: str = "crop"):
+    """
+    Returns the cropped image of a segment as JPEG or WebP (SEGMENT_IMAGE_FORMAT),
+    from the segment image cache. Responses carry an ETag and may be cached by
+    clients; a matching If-None-Match gives 304 Not Modified.
+    
+    Args:
+        segment_id (int): Segment ID
+        request (Request): The FastAPI request object
+        variant (str): "crop" (size-capped full crop) or "thumbnail"
+        
+    Returns:
+        Response: The encoded image, 304, or 404 if the segment is unknown
+    """
+    if variant not in VARIANTS:
+        return JSONResponse({"error": f"Unknown variant '{variant}', expected one of {list(VARIANTS)}"},
+                            status_code=400)
+    
+    with get_connection() as conn:
+        data = load_segment_images(conn, [segment_id], variant).get(segment_id)
+    if data is None:
+        return JSONResponse({"error": "Segment not found"}, status_code=404)
+    
+    tag = etag(data)
+    headers = {"ETag": tag, "Cache-Control": SEGMENT_IMAGE_SETTINGS["cache_control"]}
+    if_none_match = request.headers.get("if-none-match", "")
+    if tag in [value.strip().removeprefix("W/") for value in if_none_match.split(",")] or if_none_match.strip() == "*":
+        return Response(status_code=304, headers=headers)
+    return Response(data, media_type=media_type(segment_image_cache.image_format), headers=headers)
+
+
+@app.get("/identification_cache/stats")
+async def identification_cache_stats():
+    """
+    Returns the hit/miss counters of the identification cache.
+    
+    Returns:
+        JSONResponse: hits, misses, stores, evictions and hit_rate
+    """
+    return JSONResponse(identification_cache.stats())
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Pipeline stage histograms and counters in the Prometheus text format.
+    
+    Returns:
+        PlainTextResponse: Prometheus exposition text
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness check: the process is up and serving requests.
+    
+    Returns:
+        JSONResponse: status "ok"
+    """
+    return JSONResponse({"status": "ok"})
+
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness check: every model is loaded and warmed up (in the model server
+    if one is configured).
+    
+    Returns:
+        JSONResponse: Model load states and timings, with status code 200 when
+            ready and 503 while loading or after a load failure
+    """
+    if model_client is None:
+        status = models.status()
+    else:
+        try:
+            status = await run_in_threadpool(model_client.status)
+        except ModelServerError as e:
+            status = {"ready": False, "model_server": MODEL_SERVER_SOCKET, "error": str(e)}
+    # The catalog is optional, so it does not count towards readiness
+    status["title_catalog"] = title_catalog.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(
+    file: UploadFile = File(...), 
+    x_openai_api_key: str = Header(None),
+    profile: str = SEGMENTATION_PROFILE,
+    previous_image_id: Optional[int] = None
+):
+    """
+    Enqueues an image for processing and returns immediately.
+    
+    Args:
+        file (UploadFile): Image file to be uploaded
+        x_openai_api_key (str): OpenAI API key from header
+        profile (str): Mask generator profile ("fast", "balanced", "accurate", "auto" or "prompted")
+        previous_image_id (int): Rescan mode, see /process_image
+        
+    Returns:
+        JSONResponse: job_id and status of the queued job, or 429 if the queue is full
+    """
+    invalid = unknown_profile_response(profile)
+    if invalid:
+        return invalid
+    
+    contents = await file.read()
+    
+    try:
+        job = submit_pipeline(contents, file.filename, x_openai_api_key, profile, previous_image_id)
+    except QueueFullError as e:
+        return JSONResponse({"error": str(e)}, status_code=429)
+    
+    return JSONResponse(job.to_dict(), status_code=202)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Returns the status of a queued job.
+    
+    Args:
+        job_id (str): ID returned by POST /jobs
+        
+    Returns:
+        JSONResponse: Job status, queue depth while it is pending, or 404 if unknown
+    """
+    job = job_queue.get(job_id)
+    if not job:
+        return JSONResponse({"error": "Job not found"}, status_code=404)
+    
+    status = job.to_dict()
+    if not job.finished:
+        status["queue_depth"] = job_queue.depth
+    return JSONResponse(status)
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str, image_mode: str = SEGMENT_IMAGE_MODE):
+    """
+    Returns the result of a finished job, in the same format as /process_image.
+    
+    Args:
+        job_id (str): ID returned by POST /jobs
+        image_mode (str): "full" or "thumbnail", see /process_image
+        
+    Returns:
+        JSONResponse: The pipeline result, 202 with the job status while it is
+            still pending, or 404 if the job is unknown
+    """
+    job = job_queue.get(job_id)
+    if not job:
+        return JSONResponse({"error": "Job not found"}, status_code=404)
+    
+    invalid = unknown_image_mode_response(image_mode)
+    if invalid:
+        return invalid
+    
+    if not job.finished:
+        return JSONResponse(job.to_dict(), status_code=202)
+    return JSONResponse(await run_in_threadpool(present_payload, job.result, image_mode), status_code=job.status_code)
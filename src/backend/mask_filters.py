@@ -0,0 +1,490 @@
+import numpy as np # type: ignore
+
+from mask_store import as_compact
+
+
+# Popcount lookup table used when numpy does not provide bitwise_count (numpy < 2.0)
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(packed, axis):
+    """
+    Count the set bits of a packed uint8 array along the given axes.
+
+    Args:
+        packed (numpy.ndarray): Bit-packed uint8 array
+        axis (int or tuple): Axes to sum over
+
+    Returns:
+        numpy.ndarray: Number of set bits along the given axes
+    """
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(packed).sum(axis=axis, dtype=np.int64)
+    return _POPCOUNT_TABLE[packed].sum(axis=axis, dtype=np.int64)
+
+
+def compute_mask_stats(segmentations):
+    """
+    Computes area and bounding box for each mask.
+
+    Bounding boxes follow the inclusive pixel convention used by the overlap
+    filter (y_max and x_max are the last rows/columns containing mask pixels).
+    Empty masks get a bounding box of all -1.
+
+    Args:
+        segmentations (list): Masks of the same frame, as CompactMasks or 2D
+            boolean arrays (see mask_store.as_compact)
+
+    Returns:
+        tuple: (areas, bboxes) where areas is an int64 array of shape (n,) and
+            bboxes is an int64 array of shape (n, 4) as (y_min, y_max, x_min, x_max)
+    """
+    n = len(segmentations)
+    areas = np.zeros(n, dtype=np.int64)
+    bboxes = np.full((n, 4), -1, dtype=np.int64)
+
+    for idx, segmentation in enumerate(segmentations):
+        mask = as_compact(segmentation)
+        if mask.area == 0:
+            continue
+        y0, x0, height, width = mask.bbox
+        areas[idx] = mask.area
+        bboxes[idx] = (y0, y0 + height - 1, x0, x0 + width - 1)
+
+    return areas, bboxes
+
+
+def bboxes_intersect(bbox, bboxes):
+    """
+    Vectorized test of which bounding boxes intersect a given bounding box.
+
+    Args:
+        bbox (numpy.ndarray): Bounding box (y_min, y_max, x_min, x_max)
+        bboxes (numpy.ndarray): Array of shape (n, 4) with bounding boxes in the same format
+
+    Returns:
+        numpy.ndarray: Boolean array of shape (n,), True where the boxes share at least one pixel
+    """
+    return ((bboxes[:, 0] <= bbox[1]) & (bboxes[:, 1] >= bbox[0]) &
+            (bboxes[:, 2] <= bbox[3]) & (bboxes[:, 3] >= bbox[2]))
+
+
+# Most bytes a stack of candidate windows may take (see _stacked_windows); more
+# candidates are processed in chunks
+_STACK_BYTES = 8 * 1024 * 1024
+
+
+def _stacked_windows(compact, bboxes, current, candidates):
+    """
+    ANDs one compact mask with a batch of candidate masks whose bounding boxes
+    touch its own, on the packed bytes only.
+
+    The window each pair shares (no intersection pixel can lie outside of it)
+    is copied from both masks into one layer of two stacks, padded with zeros
+    to the largest window of the batch, and the stacks are ANDed at once, so a
+    batch of pairs costs one numpy pass instead of one per pair.
+
+    Args:
+        compact (list): CompactMasks
+        bboxes (numpy.ndarray): Array of shape (n, 4) with mask bounding boxes
+        current (int): Index of the current mask
+        candidates (numpy.ndarray): Indices of masks whose bounding box touches the current one
+
+    Yields:
+        tuple: (start, stack, y_mins, byte_mins) per chunk of candidates, where
+            stack has shape (k, rows, bytes) and holds the packed AND for
+            candidates[start:start + k], each layer starting at frame row
+            y_mins[layer] and byte column byte_mins[layer]
+    """
+    bbox = bboxes[current]
+    others = bboxes[candidates]
+    y_mins = np.maximum(others[:, 0], bbox[0])
+    y_maxs = np.minimum(others[:, 1], bbox[1])
+    byte_mins = np.maximum(others[:, 2], bbox[2]) // 8
+    byte_maxs = np.minimum(others[:, 3], bbox[3]) // 8
+    heights = y_maxs - y_mins + 1
+    widths = byte_maxs - byte_mins + 1
+
+    mask = compact[current]
+    if len(candidates) == 1:
+        # Nothing to stack
+        window = (y_mins[0], y_maxs[0], byte_mins[0], byte_maxs[0])
+        stack = mask.packed_window(*window) & compact[candidates[0]].packed_window(*window)
+        yield 0, stack[None], y_mins, byte_mins
+        return
+
+    layer_shape = (int(heights.max()), int(widths.max()))
+    chunk = max(1, _STACK_BYTES // (2 * layer_shape[0] * layer_shape[1]))
+
+    for start in range(0, len(candidates), chunk):
+        stop = min(start + chunk, len(candidates))
+        stack = np.zeros((stop - start,) + layer_shape, dtype=np.uint8)
+        other_stack = np.zeros_like(stack)
+        for layer, idx in enumerate(range(start, stop)):
+            window = (y_mins[idx], y_maxs[idx], byte_mins[idx], byte_maxs[idx])
+            stack[layer, :heights[idx], :widths[idx]] = mask.packed_window(*window)
+            other_stack[layer, :heights[idx], :widths[idx]] = compact[candidates[idx]].packed_window(*window)
+        stack &= other_stack
+        yield start, stack, y_mins[start:stop], byte_mins[start:stop]
+
+
+def _first_and_last(flags):
+    """
+    Returns the first and last True index of every row of a 2D boolean array
+    (rows must have at least one True value).
+    """
+    first = flags.argmax(axis=1)
+    last = flags.shape[1] - 1 - flags[:, ::-1].argmax(axis=1)
+    return first, last
+
+
+def _overlap_metrics(compact, bboxes, current, candidates):
+    """
+    Computes intersection size and the bounding box of the intersection region
+    between one mask and a batch of candidate masks.
+
+    Args:
+        compact (list): CompactMasks
+        bboxes (numpy.ndarray): Array of shape (n, 4) with mask bounding boxes
+        current (int): Index of the current mask
+        candidates (numpy.ndarray): Indices of masks whose bounding box touches the current one
+
+    Returns:
+        tuple: (intersections, overlap_bboxes) with intersection pixel counts of shape (k,)
+            and intersection bounding boxes of shape (k, 4); rows without overlap are -1
+    """
+    intersections = np.zeros(len(candidates), dtype=np.int64)
+    overlap_bboxes = np.full((len(candidates), 4), -1, dtype=np.int64)
+
+    for start, stack, y_mins, byte_mins in _stacked_windows(compact, bboxes, current, candidates):
+        counts = popcount(stack, axis=(1, 2))
+        intersections[start:start + len(stack)] = counts
+        overlapping = np.flatnonzero(counts)
+        if len(overlapping) == 0:
+            continue
+        stack, y_mins, x_mins = stack[overlapping], y_mins[overlapping], byte_mins[overlapping] * 8
+        first_row, last_row = _first_and_last(stack.any(axis=2))
+        first_col, last_col = _first_and_last(np.unpackbits(np.bitwise_or.reduce(stack, axis=1), axis=1))
+        overlap_bboxes[start + overlapping] = np.stack([
+            y_mins + first_row, y_mins + last_row, x_mins + first_col, x_mins + last_col
+        ], axis=1)
+    return intersections, overlap_bboxes
+
+
+def _resolve_pair(current_area, current_bbox, current_stability,
+                  kept_area, kept_bbox, kept_stability,
+                  intersection, overlap_bbox,
+                  overlap_threshold, containment_threshold):
+    """
+    Decides how a candidate mask relates to a previously kept mask.
+
+    This is the per-pair decision logic of the overlap filter. It works on the
+    precomputed areas, bounding boxes and intersection metrics instead of the
+    full-resolution masks.
+
+    Returns:
+        bool or None: None if the pair does not decide anything, otherwise the
+            value of should_keep for the current mask (the kept-mask loop stops)
+    """
+    current_y_min, current_y_max, current_x_min, current_x_max = current_bbox
+    current_height = current_y_max - current_y_min
+    current_width = current_x_max - current_x_min
+    current_aspect_ratio = current_width / current_height if current_height > 0 else 0
+
+    kept_y_min, kept_y_max, kept_x_min, kept_x_max = kept_bbox
+    kept_height = kept_y_max - kept_y_min
+    kept_width = kept_x_max - kept_x_min
+    kept_aspect_ratio = kept_width / kept_height if kept_height > 0 else 0
+
+    iou = intersection / (current_area + kept_area - intersection)
+
+    overlap_y_min, overlap_y_max, overlap_x_min, overlap_x_max = overlap_bbox
+    overlap_height = overlap_y_max - overlap_y_min
+    overlap_width = overlap_x_max - overlap_x_min
+
+    # Initialize overlap metrics
+    current_top_overlap = current_bottom_overlap = kept_top_overlap = kept_bottom_overlap = 0
+    current_left_overlap = current_right_overlap = kept_left_overlap = kept_right_overlap = 0
+    total_vertical_overlap = total_horizontal_overlap = 0
+    max_vertical_overlap = max_side_overlap = 0
+
+    # Calculate vertical overlap metrics if significant height
+    if overlap_height >= 5:
+        current_top_overlap = max(0, current_y_min + current_height/4 - overlap_y_min) / overlap_height
+        current_bottom_overlap = max(0, overlap_y_max - (current_y_max - current_height/4)) / overlap_height
+        kept_top_overlap = max(0, kept_y_min + kept_height/4 - overlap_y_min) / overlap_height
+        kept_bottom_overlap = max(0, overlap_y_max - (kept_y_max - kept_height/4)) / overlap_height
+
+        total_vertical_overlap = current_top_overlap + current_bottom_overlap + kept_top_overlap + kept_bottom_overlap
+        max_vertical_overlap = max(current_top_overlap, current_bottom_overlap, kept_top_overlap, kept_bottom_overlap)
+
+    # Calculate horizontal overlap metrics if significant width
+    if overlap_width >= 5:
+        current_left_overlap = max(0, current_x_min + current_width/4 - overlap_x_min) / overlap_width
+        current_right_overlap = max(0, overlap_x_max - (current_x_max - current_width/4)) / overlap_width
+        kept_left_overlap = max(0, kept_x_min + kept_width/4 - overlap_x_min) / overlap_width
+        kept_right_overlap = max(0, overlap_x_max - (kept_x_max - kept_width/4)) / overlap_width
+
+        total_horizontal_overlap = current_left_overlap + current_right_overlap + kept_left_overlap + kept_right_overlap
+        max_side_overlap = max(current_left_overlap, current_right_overlap, kept_left_overlap, kept_right_overlap)
+
+    # Calculate horizontal alignment
+    horizontal_overlap = max(0, min(current_x_max, kept_x_max) - max(current_x_min, kept_x_min))
+    horizontal_overlap_ratio = horizontal_overlap / min(current_width, kept_width)
+
+    # Calculate containment ratios
+    current_in_kept_ratio = intersection / current_area
+    kept_in_current_ratio = intersection / kept_area
+
+    # Check if overlap is more horizontal than vertical
+    # Consider both total distribution and peak concentration
+    horizontal_bias = (
+        (total_horizontal_overlap > total_vertical_overlap * 1.2 and  # Require 20% more horizontal overlap
+         max_side_overlap > 0.5) or  # Must have significant side overlap
+        (max_side_overlap > 0.7 and  # Strong side concentration
+         max_side_overlap > max_vertical_overlap * 1.3 and  # Much stronger than vertical
+         abs(current_left_overlap - current_right_overlap) > 0.4)  # Concentrated on one side
+    )
+
+    # Check for nearly identical segments using bounding box similarity
+    box_overlap_x = min(current_x_max, kept_x_max) - max(current_x_min, kept_x_min)
+    box_overlap_y = min(current_y_max, kept_y_max) - max(current_y_min, kept_y_min)
+    box_overlap_area = box_overlap_x * box_overlap_y
+    box_union_area = (max(current_x_max, kept_x_max) - min(current_x_min, kept_x_min)) * \
+                    (max(current_y_max, kept_y_max) - min(current_y_min, kept_y_min))
+    box_iou = box_overlap_area / box_union_area if box_union_area > 0 else 0
+
+    # Consider segments nearly identical if:
+    # - High IoU (> 0.65) or high containment ratio (> 0.65)
+    # - Similar bounding boxes (box_iou > 0.7)
+    # - Similar center position (within 10% of box size)
+    center_x_diff = abs((current_x_min + current_x_max) / 2 - (kept_x_min + kept_x_max) / 2)
+    center_y_diff = abs((current_y_min + current_y_max) / 2 - (kept_y_min + kept_y_max) / 2)
+    max_dim = max(current_width, current_height, kept_width, kept_height)
+    centers_close = (center_x_diff < max_dim * 0.1 and center_y_diff < max_dim * 0.1)
+
+    if ((iou > 0.65 or current_in_kept_ratio > 0.65 or kept_in_current_ratio > 0.65) and
+        box_iou > 0.7 and centers_close):
+        # Keep the more stable one
+        return current_stability >= kept_stability
+
+    # Check for subsections with more comprehensive criteria
+    is_subsection = False
+
+    # First check if one segment is significantly contained within the other
+    if (current_in_kept_ratio > containment_threshold and current_area < kept_area * 0.9) or \
+       (kept_in_current_ratio > containment_threshold and kept_area < current_area * 0.9):
+
+        # Then check if it's likely a subsection based on overlap distribution
+        if horizontal_bias:
+            # If there's strong horizontal bias, it's likely a subsection
+            is_subsection = True
+        else:
+            # Check if the overlap is evenly distributed (not concentrated at top/bottom)
+            even_vertical_distribution = (
+                abs(current_top_overlap - current_bottom_overlap) < 0.3 and
+                abs(kept_top_overlap - kept_bottom_overlap) < 0.3
+            )
+
+            # If overlap is even and not concentrated on one side, it's likely a subsection
+            if even_vertical_distribution and \
+               abs(current_left_overlap - current_right_overlap) < 0.3 and \
+               abs(kept_left_overlap - kept_right_overlap) < 0.3:
+                is_subsection = True
+
+    # Check if this might be a combined segment of stacked boxes
+    # Only check if not a subsection and overlap is more vertical than horizontal
+    is_combined_segment = (
+        not is_subsection and
+        not horizontal_bias and
+        current_area > kept_area * 1.4 and  # Slightly lower threshold for combined segments
+        horizontal_overlap_ratio > 0.5 and  # More lenient horizontal alignment
+        current_height > kept_height * 1.6 and  # Should be significantly taller
+        current_stability < kept_stability and  # Individual segments should be more stable
+        ((current_top_overlap > 0.6 and current_bottom_overlap > 0.6) or  # Contains both top and bottom
+         (kept_top_overlap > 0.6 and kept_bottom_overlap > 0.6))  # Contains both top and bottom
+    )
+
+    # Only check for stacking if it's not a subsection and not a combined segment
+    is_stacked = False
+    if not is_subsection and not is_combined_segment:
+        # Calculate relative size - stacked boxes should be similar in size
+        size_ratio = min(current_area, kept_area) / max(current_area, kept_area)
+        width_ratio = min(current_width, kept_width) / max(current_width, kept_width)
+
+        is_stacked = (
+            horizontal_overlap_ratio > 0.5 and  # More lenient horizontal alignment
+            abs(current_aspect_ratio - kept_aspect_ratio) < 0.4 and  # More lenient aspect ratio difference
+            size_ratio > 0.6 and  # More lenient size ratio
+            width_ratio > 0.7 and  # Similar widths
+            iou < overlap_threshold and  # Limited overall overlap
+            ((current_top_overlap > 0.6 and current_bottom_overlap < 0.2) or  # More lenient overlap thresholds
+             (current_bottom_overlap > 0.6 and current_top_overlap < 0.2) or
+             (kept_top_overlap > 0.6 and kept_bottom_overlap < 0.2) or
+             (kept_bottom_overlap > 0.6 and kept_top_overlap < 0.2))
+        )
+
+    # Determine if we should keep this mask
+    if is_combined_segment:
+        # Don't keep combined segments of stacked boxes
+        return False
+    elif is_subsection:
+        # For subsections, always keep the larger mask
+        if current_area < kept_area:
+            return False
+    elif not is_stacked and iou > overlap_threshold:
+        # For overlapping non-stacked masks, keep the one with better stability
+        if current_stability < kept_stability:
+            return False
+    elif is_stacked:
+        # For stacked boxes, keep both unless they're too similar
+        if iou > 0.8:  # Very high overlap suggests same box
+            return False
+
+    return None
+
+
+def filter_overlapping_masks(masks, overlap_threshold=0.3, containment_threshold=0.85):
+    """
+    Resolves overlapping SAM masks, dropping duplicates, subsections and
+    combined segments of stacked boxes while keeping stacked boxes apart.
+
+    Masks are visited in order of decreasing stability score (ties broken by
+    ascending area) and compared against every mask kept so far. Area, bounding
+    box and stability are computed once per mask, kept masks whose bounding box
+    does not touch the current mask are skipped without looking at pixels, and
+    the intersections with the remaining kept masks are computed on the packed
+    bytes of the two masks' shared bounding-box window only.
+
+    Args:
+        masks (list): SAM mask records with 'segmentation' (see mask_store.as_compact)
+            and optionally 'stability_score'
+        overlap_threshold (float): Base IoU threshold for overlapping masks
+        containment_threshold (float): Containment ratio above which one mask is
+            considered to lie within another
+
+    Returns:
+        list: Kept mask records, in visiting order
+    """
+    if not masks:
+        return []
+
+    compact = [as_compact(mask['segmentation']) for mask in masks]
+    areas, bboxes = compute_mask_stats(compact)
+    stabilities = np.array([mask.get('stability_score', 0.0) for mask in masks], dtype=np.float64)
+
+    # Sort masks by stability score first, then by area (ascending)
+    order = sorted(range(len(masks)), key=lambda idx: (-stabilities[idx], areas[idx]))
+
+    kept = []
+    for current in order:
+        if areas[current] == 0:  # Skip empty masks
+            continue
+
+        should_keep = True
+        kept_array = np.array(kept, dtype=np.int64)
+
+        # Only kept masks whose bounding box touches the current mask can overlap it
+        candidates = kept_array[bboxes_intersect(bboxes[current], bboxes[kept_array])]
+        if len(candidates) > 0:
+            intersections, overlap_bboxes = _overlap_metrics(compact, bboxes, current, candidates)
+
+            for candidate, intersection, overlap_bbox in zip(candidates, intersections, overlap_bboxes):
+                # Masks without any overlap never decide anything
+                if intersection == 0:
+                    continue
+                decision = _resolve_pair(
+                    areas[current], bboxes[current], stabilities[current],
+                    areas[candidate], bboxes[candidate], stabilities[candidate],
+                    intersection, overlap_bbox,
+                    overlap_threshold, containment_threshold
+                )
+                if decision is not None:
+                    should_keep = decision
+                    break
+
+        if should_keep:
+            kept.append(current)
+
+    return [masks[idx] for idx in kept]
+
+
+def pairwise_intersections(segmentations, bboxes):
+    """
+    Computes the intersection size of every pair of masks.
+
+    Only pairs whose bounding boxes touch are compared, on the packed bytes of
+    the windows they share (one stacked AND per mask, see _stacked_windows),
+    so no mask is ever expanded.
+
+    Args:
+        segmentations (list): Masks of the same frame (see mask_store.as_compact)
+        bboxes (numpy.ndarray): Array of shape (n, 4) with mask bounding boxes
+
+    Returns:
+        numpy.ndarray: Symmetric int64 matrix of shape (n, n) with intersection
+            pixel counts (the diagonal holds the mask areas)
+    """
+    compact = [as_compact(segmentation) for segmentation in segmentations]
+    n = len(compact)
+    intersections = np.zeros((n, n), dtype=np.int64)
+    valid = bboxes[:, 0] >= 0
+
+    for i in np.flatnonzero(valid):
+        intersections[i, i] = compact[i].area
+        touching = np.flatnonzero(bboxes_intersect(bboxes[i], bboxes[i + 1:]) & valid[i + 1:]) + i + 1
+        if len(touching) == 0:
+            continue
+        for start, stack, _, _ in _stacked_windows(compact, bboxes, i, touching):
+            others = touching[start:start + len(stack)]
+            intersections[i, others] = intersections[others, i] = popcount(stack, axis=(1, 2))
+    return intersections
+
+
+def remove_enveloped_masks(masks, area_ratio=1.5, containment_ratio=0.9):
+    """
+    Removes masks that are (almost) completely enveloped by a much larger mask.
+
+    Masks are ordered by area descending. A mask is dropped when at least
+    containment_ratio of it lies inside a mask that is more than area_ratio
+    times bigger and has not been dropped itself. Areas are computed once and
+    all pairwise intersections are computed up front on the compact masks.
+
+    Args:
+        masks (list): SAM mask records with 'segmentation' (see mask_store.as_compact)
+        area_ratio (float): How much bigger the enveloping mask must be
+        containment_ratio (float): Fraction of the smaller mask that must be contained
+
+    Returns:
+        list: Remaining mask records, ordered by area descending
+    """
+    if not masks:
+        return []
+
+    compact = [as_compact(mask['segmentation']) for mask in masks]
+    areas, bboxes = compute_mask_stats(compact)
+
+    # Sort by area descending so we check larger segments first
+    order = sorted(range(len(masks)), key=lambda idx: areas[idx], reverse=True)
+    areas = areas[order]
+    intersections = pairwise_intersections([compact[idx] for idx in order], bboxes[order])
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # envelops[i, j]: mask i is bigger than mask j and contains enough of it
+        envelops = ((areas[:, None] > areas[None, :] * area_ratio) &
+                    (intersections / areas[None, :] > containment_ratio))
+
+    removed = np.zeros(len(order), dtype=bool)
+    for i in range(len(order)):
+        if removed[i]:
+            continue
+        later = np.arange(len(order)) > i
+
+        # A later mask that envelops this one removes it and ends its comparisons
+        enveloped_by = np.flatnonzero(envelops[:, i] & later & ~removed)
+        if len(enveloped_by) > 0:
+            later &= np.arange(len(order)) < enveloped_by[0]
+            removed[i] = True
+        removed |= envelops[i] & later
+
+    return [masks[idx] for idx, was_removed in zip(order, removed) if not was_removed]
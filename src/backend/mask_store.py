@@ -0,0 +1,312 @@
+import struct
+
+import numpy as np # type: ignore
+
+# Blob layout: little-endian header (y0, x0, height, width) of the mask's
+# bounding box, followed by the row-major bit-packed mask of that box
+_HEADER = struct.Struct('<4I')
+
+
+def crop_mask(mask):
+    """
+    Cuts a boolean mask down to its bounding box.
+
+    Args:
+        mask (numpy.ndarray): 2D boolean mask
+
+    Returns:
+        tuple: (crop, bbox) where crop is a 2D boolean view of the mask and bbox
+            is (y0, x0, height, width) in mask coordinates; empty masks give an
+            empty crop and a zero bbox
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return mask[:0, :0], (0, 0, 0, 0)
+    cols = np.flatnonzero(mask.any(axis=0))
+
+    y0, x0 = int(rows[0]), int(cols[0])
+    height, width = int(rows[-1]) + 1 - y0, int(cols[-1]) + 1 - x0
+    return mask[y0:y0 + height, x0:x0 + width], (y0, x0, height, width)
+
+
+def encode_mask(mask):
+    """
+    Encodes a boolean mask as its bounding-box crop, bit-packed.
+
+    A shelf segment typically covers a small part of the frame, so this is a
+    few KB instead of a full-resolution boolean array.
+
+    Args:
+        mask (numpy.ndarray): 2D boolean mask
+
+    Returns:
+        bytes: Encoded mask
+    """
+    crop, bbox = crop_mask(mask)
+    return _HEADER.pack(*bbox) + np.packbits(crop, axis=None).tobytes()
+
+
+def decode_mask_crop(data):
+    """
+    Decodes an encoded mask into its bounding-box crop.
+
+    The packed bits are read in place from the blob (no copy of the encoded
+    data); only the unpacked crop is allocated.
+
+    Args:
+        data (bytes): Encoded mask from encode_mask
+
+    Returns:
+        tuple: (crop, bbox) where crop is a 2D boolean array and bbox is
+            (y0, x0, height, width) in mask coordinates
+    """
+    y0, x0, height, width = _HEADER.unpack_from(data)
+    packed = np.frombuffer(data, dtype=np.uint8, offset=_HEADER.size)
+    crop = np.unpackbits(packed, count=height * width).reshape(height, width).view(bool)
+    return crop, (y0, x0, height, width)
+
+
+def decode_mask(data, mask_width, mask_height):
+    """
+    Decodes an encoded mask into a full-frame boolean mask.
+
+    Args:
+        data (bytes): Encoded mask from encode_mask
+        mask_width (int): Width of the full mask
+        mask_height (int): Height of the full mask
+
+    Returns:
+        numpy.ndarray: 2D boolean mask of shape (mask_height, mask_width)
+    """
+    crop, (y0, x0, height, width) = decode_mask_crop(data)
+    mask = np.zeros((mask_height, mask_width), dtype=bool)
+    mask[y0:y0 + height, x0:x0 + width] = crop
+    return mask
+
+
+class CompactMask:
+    """
+    A boolean mask held as the bit-packed crop of its bounding box.
+
+    Rows are packed from the byte-aligned column x0 // 8 * 8 of the frame, so
+    the packed bytes of any two masks line up and their overlap can be computed
+    on the bytes of the shared window alone, without unpacking either mask.
+    A shelf segment takes a few KB this way instead of a full-frame array.
+    """
+
+    __slots__ = ("packed", "bbox", "shape", "area")
+
+    def __init__(self, packed, bbox, shape, area):
+        """
+        Args:
+            packed (numpy.ndarray): Row-wise packed bits of shape (height, bytes)
+            bbox (tuple): (y0, x0, height, width) in frame coordinates, as crop_mask
+            shape (tuple): (height, width) of the frame
+            area (int): Number of mask pixels
+        """
+        self.packed = packed
+        self.bbox = bbox
+        self.shape = shape
+        self.area = area
+
+    @classmethod
+    def from_crop(cls, crop, offset, shape):
+        """
+        Builds a compact mask from a part of a frame.
+
+        Args:
+            crop (numpy.ndarray): 2D boolean array (need not be tight around the mask)
+            offset (tuple): (y, x) of the crop's top-left pixel in the frame
+            shape (tuple): (height, width) of the frame
+
+        Returns:
+            CompactMask: The mask; empty masks get a zero bbox
+        """
+        crop, (y0, x0, height, width) = crop_mask(crop)
+        y0, x0 = y0 + int(offset[0]), x0 + int(offset[1])
+        if height == 0:
+            return cls(np.zeros((0, 0), dtype=np.uint8), (0, 0, 0, 0), tuple(shape), 0)
+
+        lead = x0 % 8
+        aligned = np.zeros((height, lead + width), dtype=bool)
+        aligned[:, lead:] = crop
+        return cls(np.packbits(aligned, axis=1), (y0, x0, height, width), tuple(shape),
+                   int(np.count_nonzero(crop)))
+
+    @classmethod
+    def from_mask(cls, mask):
+        """
+        Builds a compact mask from a full-frame boolean mask.
+        """
+        return cls.from_crop(mask, (0, 0), mask.shape)
+
+    @classmethod
+    def from_rle(cls, rle):
+        """
+        Builds a compact mask from SAM's uncompressed RLE (the generator's
+        output_mode="uncompressed_rle"), expanding only the columns the mask spans.
+
+        Args:
+            rle (dict): {"size": [height, width], "counts": [...]} with column-major
+                run lengths, starting with a run of unset pixels
+
+        Returns:
+            CompactMask: The mask
+        """
+        height, width = rle["size"]
+        counts = np.asarray(rle["counts"], dtype=np.int64)
+        ends = np.cumsum(counts)
+        starts, ends = (ends - counts)[1::2], ends[1::2]
+        filled = ends > starts
+        starts, ends = starts[filled], ends[filled]
+        if len(starts) == 0:
+            return cls.from_crop(np.zeros((0, 0), dtype=bool), (0, 0), (height, width))
+
+        # Mark run starts and ends in the strip of columns the runs cover
+        first_col, last_col = int(starts[0] // height), int((ends[-1] - 1) // height)
+        offset = first_col * height
+        edges = np.zeros((last_col - first_col + 1) * height + 1, dtype=np.int32)
+        np.add.at(edges, starts - offset, 1)
+        np.add.at(edges, ends - offset, -1)
+        strip = np.cumsum(edges[:-1]).reshape(last_col - first_col + 1, height).T > 0
+        return cls.from_crop(strip, (0, first_col), (height, width))
+
+    @property
+    def nbytes(self):
+        return self.packed.nbytes
+
+    @property
+    def byte_x0(self):
+        return self.bbox[1] // 8
+
+    def crop(self):
+        """
+        Unpacks the mask's bounding-box crop.
+
+        Returns:
+            numpy.ndarray: 2D boolean array of shape (height, width)
+        """
+        _, x0, height, width = self.bbox
+        lead = x0 % 8
+        return np.unpackbits(self.packed, axis=1, count=lead + width)[:, lead:].view(bool)
+
+    def packed_window(self, y_min, y_max, byte_min, byte_max):
+        """
+        Returns the packed bytes of a window inside the mask's bounding box.
+
+        Args:
+            y_min (int): First frame row (inclusive)
+            y_max (int): Last frame row (inclusive)
+            byte_min (int): First frame byte column (pixel column // 8, inclusive)
+            byte_max (int): Last frame byte column (inclusive)
+
+        Returns:
+            numpy.ndarray: View of the packed bits of the window
+        """
+        y0, byte_x0 = self.bbox[0], self.byte_x0
+        return self.packed[y_min - y0:y_max - y0 + 1, byte_min - byte_x0:byte_max - byte_x0 + 1]
+
+    def count_in(self, frame_mask):
+        """
+        Counts the mask pixels that are also set in a full-frame boolean array.
+        """
+        y0, x0, height, width = self.bbox
+        return int(np.count_nonzero(frame_mask[y0:y0 + height, x0:x0 + width] & self.crop()))
+
+    def paste(self, frame_mask):
+        """
+        Sets the mask pixels in a full-frame boolean array (in place).
+        """
+        y0, x0, height, width = self.bbox
+        frame_mask[y0:y0 + height, x0:x0 + width] |= self.crop()
+
+    def to_mask(self):
+        """
+        Expands the mask to a full-frame boolean array.
+        """
+        mask = np.zeros(self.shape, dtype=bool)
+        self.paste(mask)
+        return mask
+
+    def moved(self, offset, shape):
+        """
+        Places the mask into a larger frame, e.g. a mask of an image region into the whole image.
+
+        Args:
+            offset (tuple): (y, x) of this mask's frame in the new frame
+            shape (tuple): (height, width) of the new frame
+
+        Returns:
+            CompactMask: The mask in the new frame
+        """
+        y0, x0 = self.bbox[:2]
+        return CompactMask.from_crop(self.crop(), (y0 + offset[0], x0 + offset[1]), shape)
+
+    def encode(self):
+        """
+        Encodes the mask in the stored format (see encode_mask).
+
+        Returns:
+            bytes: Encoded mask
+        """
+        return _HEADER.pack(*self.bbox) + np.packbits(self.crop(), axis=None).tobytes()
+
+
+def as_compact(segmentation):
+    """
+    Converts a mask in any of the formats the pipeline handles to a CompactMask.
+
+    Args:
+        segmentation: CompactMask, 2D boolean array or SAM uncompressed RLE dict
+
+    Returns:
+        CompactMask: The mask
+    """
+    if isinstance(segmentation, CompactMask):
+        return segmentation
+    if isinstance(segmentation, dict):
+        return CompactMask.from_rle(segmentation)
+    return CompactMask.from_mask(segmentation)
+
+
+def compact_records(masks, budget_bytes=None):
+    """
+    Replaces the segmentation of mask records with CompactMasks, most stable
+    masks first, until the compact masks would take more than budget_bytes.
+    Masks beyond the budget are dropped without ever being expanded.
+
+    Args:
+        masks (list): Mask records with 'segmentation' (see as_compact) and
+            optionally 'stability_score'
+        budget_bytes (int): Most bytes of compact masks to keep, or None for no limit
+
+    Returns:
+        tuple: (records, dropped) with the converted records in their original
+            order and the number of masks dropped for the budget
+    """
+    order = sorted(range(len(masks)), key=lambda idx: -masks[idx].get('stability_score', 0.0))
+    compact, used = {}, 0
+    for idx in order:
+        segmentation = as_compact(masks[idx]['segmentation'])
+        used += segmentation.nbytes
+        if budget_bytes is not None and used > budget_bytes:
+            break
+        compact[idx] = dict(masks[idx], segmentation=segmentation)
+    return [compact[idx] for idx in sorted(compact)], len(masks) - len(compact)
+
+
+def load_mask_crop(mask_data, mask_path):
+    """
+    Loads a segment mask as its bounding-box crop, from its encoded blob or,
+    for segments stored before the compact format, from its .npy file.
+
+    Args:
+        mask_data (bytes): Encoded mask, or None for legacy segments
+        mask_path (str): Path of the legacy .npy mask file
+
+    Returns:
+        tuple: (crop, bbox) as returned by decode_mask_crop
+    """
+    if mask_data is not None:
+        return decode_mask_crop(mask_data)
+    return crop_mask(np.load(mask_path))
@@ -0,0 +1,165 @@
+import contextvars
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from cached lookups up to full accurate-profile runs on CPU
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# Trace ID of the request being handled; copied into job worker threads with the context
+trace_id_var = contextvars.ContextVar('trace_id', default=None)
+
+
+def new_trace_id():
+    return uuid.uuid4().hex[:16]
+
+
+def log(message, **fields):
+    """
+    Prints a structured (JSON) log line tagged with the current trace ID.
+
+    Args:
+        message (str): Log message
+        **fields: Additional JSON serializable fields
+    """
+    record = {"ts": round(time.time(), 3), "trace_id": trace_id_var.get(), "msg": message}
+    record.update(fields)
+    print(json.dumps(record, default=str), flush=True)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Counter:
+    """
+    Monotonically increasing counter, optionally split by labels. Names end
+    in _total, as Prometheus expects for counters.
+    """
+
+    type = "counter"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values) or ({(): 0} if not self.labelnames else {})
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    """
+    Cumulative histogram of observed values, optionally split by labels.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        self.lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Context manager that observes the wall time of its block.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+        for key, (counts, total, count) in sorted(values.items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', repr(float(bound)))])} {bucket_count}"
+            yield f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {count}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+
+
+class Registry:
+    """
+    Collection of metrics rendered together in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render(self):
+        """
+        Renders every metric in the Prometheus text exposition format (version 0.0.4).
+
+        Returns:
+            str: Exposition text
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Pipeline metrics
+STAGE_SECONDS = Histogram(
+    "pipeline_stage_seconds", "Time spent per pipeline stage "
+    "(decode, alignment, encoder, mask_generation, dedup, ocr, identification)", ["stage"])
+REQUEST_SECONDS = Histogram("pipeline_request_seconds", "End-to-end pipeline time per image", ["outcome"])
+MASKS_GENERATED = Counter("masks_generated_total", "Raw masks produced by SAM")
+MASKS_KEPT = Counter("masks_kept_total", "Masks left after the area, overlap and envelope filters")
+MASKS_OVER_BUDGET = Counter("masks_over_budget_total", "Masks dropped to keep a request within MASK_MEMORY_BUDGET_MB")
+OCR_PASSES = Counter("ocr_passes_total", "Batched EasyOCR calls", ["mode"])
+EMBEDDING_CACHE_LOOKUPS = Counter("embedding_cache_lookups_total", "SAM image embedding cache lookups", ["result"])
+RESULT_CACHE_LOOKUPS = Counter("result_cache_lookups_total", "Stored pipeline result lookups", ["result"])
+CATALOG_LOOKUPS = Counter("title_catalog_lookups_total", "OCR text matches against the local title catalog", ["result"])
+
+# OpenAI metrics
+API_CALLS = Counter("openai_api_calls_total", "OpenAI identification requests", ["outcome"])
+API_SECONDS = Histogram("openai_api_seconds", "Latency of single OpenAI identification requests")
+API_RETRIES = Counter("openai_api_retries_total", "OpenAI requests retried after a rate limit error")
+API_BATCH_SPLITS = Counter("openai_batch_splits_total", "Batched identification requests split after an incomplete answer")
+RATE_LIMIT_WAITS = Counter("openai_rate_limit_waits_total", "Requests that had to wait for the shared rate limiter")
+RATE_LIMIT_WAIT_SECONDS = Counter("openai_rate_limit_wait_seconds_total", "Time spent waiting for the shared rate limiter")
@@ -0,0 +1,566 @@
+"""
+Inference server that owns SAM and EasyOCR for several API worker processes.
+
+With `uvicorn --workers N` every worker imports main.py and would load its own
+copy of the models. Instead, run one model server and point the workers at its
+socket; they then send their mask generation and text checks to it:
+
+    python model_server.py --socket /tmp/shelfie-models.sock
+    MODEL_SERVER_SOCKET=/tmp/shelfie-models.sock uvicorn main:app --workers 4 --host 0.0.0.0 --port 8080
+
+Requests travel over a Unix socket as length-prefixed JSON headers. Images,
+crops and masks are exchanged through shared memory blocks named in the
+headers instead of being pickled into the socket. Requests arriving from
+different workers within MODEL_SERVER_BATCH_WAIT_MS of each other are run
+together: their images share batched image encoder passes and their crops
+share one pooled OCR call.
+"""
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np # type: ignore
+
+from mask_store import CompactMask
+from metrics import log, trace_id_var
+
+MODEL_SERVER_SETTINGS = {
+    "socket_path": os.environ.get('MODEL_SERVER_SOCKET', '/tmp/shelfie-models.sock'),
+    "batch_wait": float(os.environ.get('MODEL_SERVER_BATCH_WAIT_MS', '10')) / 1000,  # Wait for other workers' requests
+    "max_batch_requests": int(os.environ.get('MODEL_SERVER_MAX_BATCH', '16')),       # Requests run together at most
+    "encoder_batch_size": int(os.environ.get('ENCODER_BATCH_SIZE', '4')),            # Images per image encoder pass
+    "timeout": float(os.environ.get('MODEL_SERVER_TIMEOUT', '600'))                  # Seconds a worker waits for an answer
+}
+
+# Message framing: little-endian length of the JSON header that follows
+_LENGTH = struct.Struct('<I')
+
+# Mask record fields sent back with each mask (the pipeline uses no others)
+_MASK_FIELDS = ("area", "bbox", "predicted_iou", "stability_score")
+
+
+class ModelServerError(RuntimeError):
+    """Raised when the model server cannot be reached or a request fails on it."""
+
+
+def send_message(sock, message):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def _receive_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def receive_message(sock):
+    """
+    Reads one message from a socket.
+
+    Returns:
+        dict: The message, or None if the other side closed the connection
+    """
+    header = _receive_exactly(sock, _LENGTH.size)
+    if header is None:
+        return None
+    data = _receive_exactly(sock, _LENGTH.unpack(header)[0])
+    return json.loads(data) if data is not None else None
+
+
+def _untrack(shm):
+    # The other process unlinks this block; keep our resource tracker from
+    # unlinking it (or warning about a leak) when this process exits
+    resource_tracker.unregister(shm._name, "shared_memory")
+
+
+def write_arrays(arrays):
+    """
+    Copies arrays into one new shared memory block.
+
+    Args:
+        arrays (list): numpy arrays
+
+    Returns:
+        tuple: (shm, descriptors) with the SharedMemory block, owned by the
+            caller, and the dtype, shape and offset of every array in it
+    """
+    arrays = [np.ascontiguousarray(array) for array in arrays]
+    shm = SharedMemory(create=True, size=max(1, sum(array.nbytes for array in arrays)))
+    descriptors, offset = [], 0
+    for array in arrays:
+        np.ndarray(array.shape, array.dtype, buffer=shm.buf, offset=offset)[...] = array
+        descriptors.append({"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset})
+        offset += array.nbytes
+    return shm, descriptors
+
+
+def read_arrays(name, descriptors, unlink=False):
+    """
+    Copies the arrays out of a shared memory block written by write_arrays.
+
+    Args:
+        name (str): Name of the block
+        descriptors (list): Array descriptors from write_arrays
+        unlink (bool): Free the block afterwards (the reader owns it)
+
+    Returns:
+        list: numpy arrays
+    """
+    shm = SharedMemory(name=name)
+    try:
+        return [np.ndarray(descriptor["shape"], np.dtype(descriptor["dtype"]), buffer=shm.buf,
+                           offset=descriptor["offset"]).copy()
+                for descriptor in descriptors]
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+        else:
+            _untrack(shm)
+
+
+def encode_masks(masks):
+    """
+    Splits mask records into JSON fields and the packed bits of their CompactMasks.
+
+    Returns:
+        tuple: (records, arrays)
+    """
+    records, arrays = [], []
+    for mask in masks:
+        segmentation = mask["segmentation"]
+        record = {field: np.asarray(mask[field]).tolist() for field in _MASK_FIELDS if field in mask}
+        record["mask"] = {"bbox": [int(v) for v in segmentation.bbox],
+                          "shape": [int(v) for v in segmentation.shape],
+                          "area": int(segmentation.area)}
+        records.append(record)
+        arrays.append(segmentation.packed)
+    return records, arrays
+
+
+def decode_masks(records, arrays):
+    """
+    Rebuilds mask records (see encode_masks) with CompactMask segmentations.
+    """
+    masks = []
+    for record, packed in zip(records, arrays):
+        mask = record.pop("mask")
+        record["segmentation"] = CompactMask(packed, tuple(mask["bbox"]), tuple(mask["shape"]), mask["area"])
+        masks.append(record)
+    return masks
+
+
+class ModelClient:
+    """
+    Sends model work from an API worker to the model server.
+
+    Each thread keeps its own connection, so the worker's pipeline threads
+    wait for the server independently of each other.
+    """
+
+    def __init__(self, socket_path, timeout=MODEL_SERVER_SETTINGS["timeout"]):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connection(self):
+        sock = getattr(self.local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.socket_path)
+            except OSError:
+                sock.close()
+                raise
+            self.local.sock = sock
+        return sock
+
+    def _disconnect(self):
+        sock = getattr(self.local, "sock", None)
+        self.local.sock = None
+        if sock is not None:
+            sock.close()
+
+    def call(self, op, args=None, arrays=()):
+        """
+        Runs one request on the model server.
+
+        Args:
+            op (str): "masks", "text", "precompute" or "status"
+            args (dict): JSON arguments of the operation
+            arrays (list): numpy arrays passed through shared memory
+
+        Returns:
+            tuple: (result, arrays) with the JSON result and the returned arrays
+
+        Raises:
+            ModelServerError: If the server is unreachable or the request failed
+        """
+        message = {"op": op, "args": args or {}, "trace_id": trace_id_var.get()}
+        shm = None
+        if arrays:
+            shm, message["arrays"] = write_arrays(arrays)
+            message["shm"] = shm.name
+        try:
+            # A kept connection may be stale after a server restart: retry once on a new one
+            for attempt in range(2):
+                try:
+                    send_message(self._connection(), message)
+                    response = receive_message(self._connection())
+                except socket.timeout as e:
+                    self._disconnect()
+                    raise ModelServerError(f"No answer from the model server within {self.timeout}s") from e
+                except OSError as e:
+                    self._disconnect()
+                    if attempt == 1:
+                        raise ModelServerError(f"Model server at {self.socket_path} unavailable: {e}") from e
+                    continue
+                if response is not None:
+                    break
+                self._disconnect()
+                if attempt == 1:
+                    raise ModelServerError("Model server closed the connection")
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+        if not response["ok"]:
+            raise ModelServerError(response["error"])
+        result_arrays = read_arrays(response["shm"], response["arrays"], unlink=True) if response.get("shm") else []
+        return response["result"], result_arrays
+
+    def generate_masks(self, image, profile):
+        """
+        Generates the raw SAM masks of an image (see main.run_mask_generator).
+
+        Returns:
+            list: Mask records with CompactMask segmentations
+        """
+        result, arrays = self.call("masks", {"profile": profile}, [image])
+        return decode_masks(result["masks"], arrays)
+
+    def find_text_segments(self, crops, mode, canvas_size, batch_size, with_text=False):
+        """
+        Runs the text filter over segment crops (see text_filter.find_text_segments).
+
+        Returns:
+            list: Confidence per crop, None for crops without text; with
+                with_text, (confidence, text) tuples
+        """
+        if not crops:
+            return []
+        result, _ = self.call("text", {"mode": mode, "canvas_size": canvas_size, "batch_size": batch_size,
+                                       "with_text": with_text}, crops)
+        if with_text:
+            return [tuple(entry) for entry in result["confidences"]]
+        return result["confidences"]
+
+    def precompute(self, images):
+        """
+        Encodes images ahead of generate_masks, in batched image encoder passes.
+        """
+        self.call("precompute", {}, images)
+
+    def status(self):
+        """
+        Returns the model load states of the server (see ModelRegistry.status).
+        """
+        result, _ = self.call("status")
+        return result
+
+
+class Batcher:
+    """
+    Runs requests submitted by several connection threads in batches on one
+    thread. A batch holds whatever arrives within `wait` seconds of its first
+    request, up to max_size requests.
+    """
+
+    def __init__(self, name, run_batch, wait, max_size):
+        """
+        Args:
+            name (str): Name used in logs and thread names
+            run_batch (callable): Called with a list of requests, returns one
+                result (or exception) per request
+            wait (float): Seconds to wait for more requests
+            max_size (int): Most requests per batch
+        """
+        self.name = name
+        self.run_batch = run_batch
+        self.wait = wait
+        self.max_size = max_size
+        self.batches = 0
+        self.requests = 0
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=f"{name}-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        """
+        Queues a request and blocks until its batch has run.
+
+        Returns:
+            object: The request's result
+
+        Raises:
+            Exception: Whatever the request failed with
+        """
+        future = Future()
+        self.queue.put((request, future))
+        return future.result()
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.wait
+        while batch[-1] is not None and len(batch) < self.max_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            stopping = batch[-1] is None
+            batch = [item for item in batch if item is not None]
+            if batch:
+                self.batches += 1
+                self.requests += len(batch)
+                try:
+                    results = self.run_batch([request for request, _ in batch])
+                except Exception as e:
+                    results = [e] * len(batch)
+                for (_, future), result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(result)
+            if stopping:
+                return
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def status(self):
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / self.batches if self.batches else None
+        }
+
+
+class ModelServer:
+    """
+    Owns the models and runs the requests of the API workers in batches: one
+    batcher for SAM (mask generation and encoder precomputation) and one for
+    the text filter.
+    """
+
+    def __init__(self, pipeline, settings=MODEL_SERVER_SETTINGS):
+        """
+        Args:
+            pipeline (module): The main module, providing the model registry,
+                mask generators and run_mask_generator of the local pipeline
+            settings (dict): See MODEL_SERVER_SETTINGS
+        """
+        self.pipeline = pipeline
+        self.settings = settings
+        self.masks = Batcher("masks", self._run_mask_batch, settings["batch_wait"], settings["max_batch_requests"])
+        self.text = Batcher("text", self._run_text_batch, settings["batch_wait"], settings["max_batch_requests"])
+
+    def _run_mask_batch(self, requests):
+        """
+        Encodes the images of every request in batched encoder passes, then
+        generates the masks of each image from its cached embedding.
+        """
+        sam = self.pipeline.models.get("sam")
+        images = [image for _, images, _ in requests for image in images]
+        log("Running mask batch", requests=len(requests), images=len(images),
+            trace_ids=sorted({trace_id for _, _, trace_id in requests if trace_id}))
+        try:
+            self.pipeline.mask_generators.predictor(sam).precompute(
+                images, batch_size=self.settings["encoder_batch_size"])
+        except Exception as e:
+            log("Batched encoding failed, encoding images one by one", error=str(e))
+
+        results = []
+        for profile, images, _ in requests:
+            if profile is None:
+                results.append(None)  # Precompute only
+                continue
+            try:
+                results.append(self.pipeline.run_mask_generator(images[0], profile))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _run_text_batch(self, requests):
+        """
+        Runs one pooled text filter call per distinct set of OCR arguments.
+        """
+        from text_filter import find_text_segments
+
+        results = [None] * len(requests)
+        groups = {}
+        for idx, (args, _) in enumerate(requests):
+            groups.setdefault((args["mode"], args["canvas_size"], args["batch_size"], args.get("with_text", False)),
+                              []).append(idx)
+
+        reader = self.pipeline.models.get("ocr")
+        for (mode, canvas_size, batch_size, with_text), indices in groups.items():
+            crops = [crop for idx in indices for crop in requests[idx][1]]
+            log("Running text batch", requests=len(indices), crops=len(crops), mode=mode)
+            try:
+                confidences = find_text_segments(reader, crops, mode=mode, canvas_size=canvas_size,
+                                                 batch_size=batch_size, with_text=with_text)
+            except Exception as e:
+                for idx in indices:
+                    results[idx] = e
+                continue
+            start = 0
+            for idx in indices:
+                count = len(requests[idx][1])
+                results[idx] = confidences[start:start + count]
+                start += count
+        return results
+
+    def status(self):
+        return dict(self.pipeline.models.status(), model_server={
+            "pid": os.getpid(),
+            "socket": self.settings["socket_path"],
+            "masks": self.masks.status(),
+            "text": self.text.status()
+        })
+
+    def handle(self, message):
+        """
+        Runs one request.
+
+        Args:
+            message (dict): Request with op, args, trace_id and optionally shm/arrays
+
+        Returns:
+            tuple: (response, shm) with the response message and the shared
+                memory block holding its arrays (None if there are none)
+        """
+        trace_id = message.get("trace_id")
+        try:
+            arrays = read_arrays(message["shm"], message["arrays"]) if message.get("shm") else []
+            op, args = message["op"], message.get("args", {})
+            result, result_arrays = {}, []
+            if op == "masks":
+                masks = self.masks.submit((args["profile"], arrays, trace_id))
+                result["masks"], result_arrays = encode_masks(masks)
+            elif op == "precompute":
+                self.masks.submit((None, arrays, trace_id))
+            elif op == "text":
+                result["confidences"] = self.text.submit((args, arrays))
+            elif op == "status":
+                result = self.status()
+            else:
+                raise ValueError(f"Unknown operation '{op}'")
+        except Exception as e:
+            log("Model server request failed", op=message.get("op"), request_trace_id=trace_id, error=str(e))
+            return {"ok": False, "error": str(e)}, None
+
+        response = {"ok": True, "result": result}
+        shm = None
+        if result_arrays:
+            shm, response["arrays"] = write_arrays(result_arrays)
+            response["shm"] = shm.name
+        return response, shm
+
+    def stop(self):
+        self.masks.stop()
+        self.text.stop()
+
+
+class _ConnectionHandler(socketserver.BaseRequestHandler):
+    """Serves the requests of one API worker thread, in order."""
+
+    def handle(self):
+        model_server = self.server.model_server
+        while True:
+            try:
+                message = receive_message(self.request)
+            except (OSError, ValueError):
+                return
+            if message is None:
+                return
+
+            response, shm = model_server.handle(message)
+            try:
+                send_message(self.request, response)
+            except OSError:
+                # Nobody will read the result
+                if shm is not None:
+                    shm.close()
+                    shm.unlink()
+                return
+            if shm is not None:
+                # The worker frees the block once it has copied the result out
+                _untrack(shm)
+                shm.close()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path=MODEL_SERVER_SETTINGS["socket_path"]):
+    """
+    Loads the models and serves API workers on a Unix socket until interrupted.
+
+    Args:
+        socket_path (str): Path of the socket to listen on
+    """
+    import main as pipeline
+
+    pipeline.models.start()
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)  # Left behind by a server that did not shut down cleanly
+
+    model_server = ModelServer(pipeline, dict(MODEL_SERVER_SETTINGS, socket_path=socket_path))
+    with _UnixServer(socket_path, _ConnectionHandler) as server:
+        server.model_server = model_server
+        log("Model server listening", socket_path=socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            model_server.stop()
+            os.unlink(socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--socket', default=MODEL_SERVER_SETTINGS["socket_path"], help="Unix socket to listen on")
+    args = parser.parse_args()
+    serve(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+import os
+import threading
+import time
+
+import numpy as np # type: ignore
+import torch # type: ignore
+import easyocr # type: ignore
+from segment_anything import sam_model_registry, SamPredictor # type: ignore
+
+from metrics import log
+
+# SAM checkpoints by model type
+SAM_CHECKPOINTS = {
+    "vit_b": "sam_vit_b_01ec64.pth",
+    "vit_l": "sam_vit_l_0b3195.pth",
+    "vit_h": "sam_vit_h_4b8939.pth",
+}
+
+SAM_MODEL_TYPE = os.environ.get('SAM_MODEL_TYPE', 'vit_l')
+if SAM_MODEL_TYPE not in SAM_CHECKPOINTS:
+    raise ValueError(f"Unknown SAM_MODEL_TYPE '{SAM_MODEL_TYPE}', expected one of {list(SAM_CHECKPOINTS)}")
+CHECKPOINT_PATH = os.environ.get('SAM_CHECKPOINT_PATH', SAM_CHECKPOINTS[SAM_MODEL_TYPE])
+OCR_LANGUAGES = os.environ.get('OCR_LANGUAGES', 'en').split(',')
+
+# "background": start loading when the app starts and serve health checks meanwhile,
+# "eager": load before the app starts accepting requests,
+# "lazy": load on first use (tests and tooling)
+MODEL_LOADING = os.environ.get('MODEL_LOADING', 'background')
+MODEL_WARMUP = os.environ.get('MODEL_WARMUP', '1') == '1'
+
+DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+# CPU inference profile, used when no GPU is available:
+# - SAM_CPU_PRECISION: "fp32" (default), "int8" (dynamic int8 quantization of
+#   the image encoder's linear layers) or "bf16" (bfloat16 autocast of the
+#   image encoder); check int8/bf16 with check_cpu_profile.py before opting in
+# - SAM_CPU_THREADS: intra-op threads per model worker (0 = cores / MODEL_WORKERS)
+# - SAM_CPU_INTEROP_THREADS: inter-op threads (SAM runs one op at a time, so 1 is enough)
+# - SAM_COMPILE: compile the image encoder with torch.compile
+CPU_PRECISIONS = ("fp32", "int8", "bf16")
+CPU_PRECISION = os.environ.get('SAM_CPU_PRECISION', 'fp32')
+if CPU_PRECISION not in CPU_PRECISIONS:
+    raise ValueError(f"Unknown SAM_CPU_PRECISION '{CPU_PRECISION}', expected one of {CPU_PRECISIONS}")
+CPU_THREADS = int(os.environ.get('SAM_CPU_THREADS', '0'))
+CPU_INTEROP_THREADS = int(os.environ.get('SAM_CPU_INTEROP_THREADS', '1'))
+SAM_COMPILE = os.environ.get('SAM_COMPILE', '0') == '1'
+
+# Precision the SAM image encoder runs at
+SAM_PRECISION = CPU_PRECISION if DEVICE.type == 'cpu' else "fp32"
+
+
+def configure_cpu_threads(threads=CPU_THREADS, interop_threads=CPU_INTEROP_THREADS):
+    """
+    Sets the torch intra-op and inter-op thread counts.
+
+    Args:
+        threads (int): Intra-op threads; 0 splits the cores evenly between the model workers
+        interop_threads (int): Inter-op threads
+    """
+    if threads <= 0:
+        workers = max(1, int(os.environ.get('MODEL_WORKERS', '1')))
+        threads = max(1, (os.cpu_count() or 1) // workers)
+    torch.set_num_threads(threads)
+    try:
+        torch.set_interop_threads(interop_threads)
+    except RuntimeError:
+        # Can only be set once, before any inter-op parallel work has started
+        pass
+    log("Configured torch threads", intra_op=torch.get_num_threads(), inter_op=torch.get_num_interop_threads())
+
+
+class Bfloat16Encoder(torch.nn.Module):
+    """
+    Runs an image encoder under bfloat16 CPU autocast and returns float32
+    embeddings, so the mask decoder and the embedding cache are unchanged.
+    """
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+        self.img_size = encoder.img_size
+
+    def forward(self, x):
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            return self.encoder(x).float()
+
+
+def optimize_for_cpu(sam, precision=CPU_PRECISION, compile_encoder=SAM_COMPILE):
+    """
+    Applies the CPU inference profile to the SAM image encoder, which accounts
+    for nearly all of the inference time. The prompt encoder and mask decoder
+    stay in float32.
+
+    Args:
+        sam (segment_anything.modeling.Sam): SAM model on the CPU
+        precision (str): "int8", "bf16" or "fp32"
+        compile_encoder (bool): Compile the encoder with torch.compile
+
+    Returns:
+        segment_anything.modeling.Sam: The same model with its image encoder replaced
+    """
+    sam.eval()
+    if precision == "int8":
+        try:
+            sam.image_encoder = torch.ao.quantization.quantize_dynamic(
+                sam.image_encoder, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+        except Exception as e:
+            # No quantized engine on this platform; keep float32
+            log("Int8 quantization unavailable, using fp32", error=str(e))
+    elif precision == "bf16":
+        sam.image_encoder = Bfloat16Encoder(sam.image_encoder)
+
+    if compile_encoder:
+        # Compile forward only so attributes like img_size stay reachable
+        sam.image_encoder.forward = torch.compile(sam.image_encoder.forward)
+    return sam
+
+
+def load_sam(model_type=SAM_MODEL_TYPE, checkpoint_path=CHECKPOINT_PATH, precision=SAM_PRECISION):
+    sam = sam_model_registry[model_type](checkpoint=checkpoint_path)
+    sam.to(device=DEVICE)
+    if DEVICE.type == 'cpu':
+        configure_cpu_threads()
+        optimize_for_cpu(sam, precision)
+    return sam
+
+
+def warm_up_sam(sam):
+    # One pass of the image encoder initializes CUDA kernels and the allocator
+    SamPredictor(sam).set_image(np.zeros((64, 64, 3), dtype=np.uint8))
+
+
+def load_reader():
+    return easyocr.Reader(OCR_LANGUAGES)
+
+
+def warm_up_reader(reader):
+    canvas = np.zeros((64, 256, 3), dtype=np.uint8)
+    canvas[24:40, 16:240] = 255
+    reader.readtext(canvas)
+
+
+class LoadedModel:
+    """
+    A model that is loaded once, on first use or in the background.
+
+    Attributes:
+        name (str): Model name used in status reports
+        state (str): "pending", "loading", "warming", "ready" or "failed"
+        load_seconds (float): Time spent loading the weights
+        warmup_seconds (float): Time spent on the warmup inference
+        error (str): Load error, if the model failed to load
+    """
+
+    def __init__(self, name, load, warm_up=None):
+        self.name = name
+        self._load = load
+        self._warm_up = warm_up
+        self.state = "pending"
+        self.load_seconds = None
+        self.warmup_seconds = None
+        self.error = None
+        self.model = None
+        self.lock = threading.Lock()
+
+    def load(self, warm_up=True):
+        """
+        Loads (and optionally warms up) the model unless it is already loaded.
+
+        Args:
+            warm_up (bool): Run a warmup inference after loading
+
+        Returns:
+            object: The loaded model
+
+        Raises:
+            RuntimeError: If loading failed, now or in an earlier attempt
+        """
+        with self.lock:
+            if self.state == "ready":
+                return self.model
+            if self.state == "failed":
+                raise RuntimeError(f"Model '{self.name}' failed to load: {self.error}")
+
+            try:
+                self.state = "loading"
+                start = time.perf_counter()
+                model = self._load()
+                self.load_seconds = time.perf_counter() - start
+                log("Loaded model", model=self.name, seconds=round(self.load_seconds, 1))
+
+                if warm_up and self._warm_up is not None:
+                    self.state = "warming"
+                    start = time.perf_counter()
+                    self._warm_up(model)
+                    self.warmup_seconds = time.perf_counter() - start
+                    log("Warmed up model", model=self.name, seconds=round(self.warmup_seconds, 1))
+            except Exception as e:
+                self.state = "failed"
+                self.error = str(e)
+                log("Error loading model", model=self.name, error=str(e))
+                raise RuntimeError(f"Model '{self.name}' failed to load: {e}") from e
+
+            self.model = model
+            self.state = "ready"
+            return model
+
+    def status(self):
+        return {
+            "state": self.state,
+            "load_seconds": self.load_seconds,
+            "warmup_seconds": self.warmup_seconds,
+            "error": self.error
+        }
+
+
+class ModelRegistry:
+    """
+    Holds the models used by the pipeline and loads them lazily or in a
+    background thread, so the app binds its port before the weights are read.
+
+    Pipeline code calls get(name), which blocks until the model is loaded
+    (loading it on the spot if nothing else has started to).
+    """
+
+    def __init__(self, warm_up=MODEL_WARMUP):
+        self.warm_up = warm_up
+        self.models = {}
+        self.started_at = time.time()
+        self.thread = None
+
+    def register(self, name, load, warm_up=None):
+        self.models[name] = LoadedModel(name, load, warm_up)
+
+    def get(self, name):
+        """
+        Returns a loaded model, loading it first if needed.
+
+        Args:
+            name (str): Registered model name
+
+        Returns:
+            object: The loaded model
+        """
+        return self.models[name].load(self.warm_up)
+
+    def load_all(self):
+        """
+        Loads every registered model in registration order; failures are
+        recorded in the status and do not stop the other models from loading.
+        """
+        for name in self.models:
+            try:
+                self.get(name)
+            except RuntimeError:
+                pass
+
+    def start(self, mode=MODEL_LOADING):
+        """
+        Starts loading the models according to the loading mode.
+
+        Args:
+            mode (str): "background", "eager" or "lazy"
+        """
+        if mode == "eager":
+            self.load_all()
+        elif mode == "background" and self.thread is None:
+            self.thread = threading.Thread(target=self.load_all, name="model-loader", daemon=True)
+            self.thread.start()
+
+    def is_ready(self):
+        return all(model.state == "ready" for model in self.models.values())
+
+    def status(self):
+        """
+        Returns the load state and timings of every model.
+
+        Returns:
+            dict: ready flag, SAM model type, seconds since startup and per-model status
+        """
+        return {
+            "ready": self.is_ready(),
+            "sam_model_type": SAM_MODEL_TYPE,
+            "checkpoint": os.path.basename(CHECKPOINT_PATH),
+            "device": str(DEVICE),
+            "precision": SAM_PRECISION,
+            "uptime_seconds": time.time() - self.started_at,
+            "models": {name: model.status() for name, model in self.models.items()}
+        }
+
+
+models = ModelRegistry()
+models.register("sam", load_sam, warm_up_sam)
+models.register("ocr", load_reader, warm_up_reader)
@@ -0,0 +1,246 @@
+import numpy as np # type: ignore
+import cv2 # type: ignore
+import torch # type: ignore
+from segment_anything.utils.amg import calculate_stability_score # type: ignore
+
+from mask_store import CompactMask
+
+# Settings for the prompted segmentation engine
+PROMPTED_SETTINGS = {
+    "max_prompts": 96,               # Box prompts per image after deduplication
+    "prompt_batch_size": 32,         # Box prompts per mask decoder call
+    "pred_iou_thresh": 0.8,          # Drop masks the decoder is not confident about
+    "stability_score_thresh": 0.88,  # Drop masks that change a lot with the threshold
+    "box_nms_thresh": 0.7,           # Candidate boxes overlapping more than this are merged
+    "min_box_area": 2500,            # Smallest candidate box in pixels (working resolution)
+    "max_box_fraction": 0.6,         # Largest candidate box as a fraction of the image
+    "shelf_line_fraction": 0.35,     # Share of the width a horizontal edge must span to be a shelf line
+    "min_band_height": 40,           # Shelf bands lower than this are ignored
+    "min_spine_width": 12,           # Narrowest spine/box between two vertical edges
+    "text_box_margin": 0.6           # Text regions are grown by this fraction of their size on each side
+}
+
+
+def box_iou(box, boxes):
+    """
+    Vectorized IoU of one XYXY box against an array of XYXY boxes.
+
+    Args:
+        box (numpy.ndarray): Box of shape (4,)
+        boxes (numpy.ndarray): Boxes of shape (n, 4)
+
+    Returns:
+        numpy.ndarray: IoU values of shape (n,)
+    """
+    x0 = np.maximum(box[0], boxes[:, 0])
+    y0 = np.maximum(box[1], boxes[:, 1])
+    x1 = np.minimum(box[2], boxes[:, 2])
+    y1 = np.minimum(box[3], boxes[:, 3])
+    intersection = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return intersection / np.maximum(area + areas - intersection, 1)
+
+
+def find_shelf_bands(edges, line_fraction=0.35, min_band_height=40):
+    """
+    Splits the image into horizontal shelf bands at long horizontal edges.
+
+    Args:
+        edges (numpy.ndarray): Canny edge map
+        line_fraction (float): Share of the width an edge row must cover to count as a shelf line
+        min_band_height (int): Bands lower than this are dropped
+
+    Returns:
+        list: (y0, y1) row ranges of the bands
+    """
+    height, width = edges.shape
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, width // 30), 1))
+    horizontal = cv2.morphologyEx(edges, cv2.MORPH_OPEN, kernel)
+    line_rows = np.flatnonzero((horizontal > 0).mean(axis=1) >= line_fraction)
+
+    # Neighbouring rows belong to the same shelf line
+    cuts = [0]
+    for row in line_rows:
+        if row - cuts[-1] > 2:
+            cuts.append(int(row))
+        else:
+            cuts[-1] = int(row)
+    cuts.append(height)
+
+    return [(y0, y1) for y0, y1 in zip(cuts[:-1], cuts[1:]) if y1 - y0 >= min_band_height]
+
+
+def find_spines(gray, band, min_spine_width=12):
+    """
+    Splits a shelf band into spine/box columns at strong vertical edges.
+
+    Args:
+        gray (numpy.ndarray): Grayscale image
+        band (tuple): (y0, y1) rows of the band
+        min_spine_width (int): Minimum distance between two column boundaries
+
+    Returns:
+        list: XYXY boxes of the columns in the band
+    """
+    y0, y1 = band
+    gradient = np.abs(cv2.Sobel(gray[y0:y1], cv2.CV_32F, 1, 0, ksize=3)).mean(axis=0)
+    profile = cv2.GaussianBlur(gradient.reshape(1, -1), (9, 1), 0).ravel()
+    threshold = profile.mean() + profile.std()
+
+    # Local maxima above the threshold, at least min_spine_width apart (strongest first)
+    peaks = np.flatnonzero((profile[1:-1] >= profile[:-2]) & (profile[1:-1] > profile[2:])
+                           & (profile[1:-1] > threshold)) + 1
+    boundaries = []
+    for peak in peaks[np.argsort(-profile[peaks], kind='stable')]:
+        if all(abs(peak - boundary) >= min_spine_width for boundary in boundaries):
+            boundaries.append(int(peak))
+    boundaries = [0] + sorted(boundaries) + [gray.shape[1]]
+
+    return [(x0, y0, x1, y1) for x0, x1 in zip(boundaries[:-1], boundaries[1:]) if x1 - x0 >= min_spine_width]
+
+
+def find_contour_boxes(edges):
+    """
+    Finds bounding boxes of closed edge contours (box fronts, stacked boxes).
+
+    Args:
+        edges (numpy.ndarray): Canny edge map
+
+    Returns:
+        list: XYXY boxes
+    """
+    closed = cv2.morphologyEx(edges, cv2.MORPH_CLOSE, np.ones((5, 5), np.uint8))
+    contours, _ = cv2.findContours(closed, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        boxes.append((x, y, x + w, y + h))
+    return boxes
+
+
+def find_text_boxes(reader, image, margin=0.6):
+    """
+    Finds text regions with the OCR detector and grows them into box prompts
+    around the object the text is printed on.
+
+    Args:
+        reader (easyocr.Reader): EasyOCR reader
+        image (numpy.ndarray): BGR image
+        margin (float): Growth on each side, as a fraction of the text box size
+
+    Returns:
+        list: XYXY boxes
+    """
+    height, width = image.shape[:2]
+    horizontal_list, _ = reader.detect(image)
+    boxes = []
+    for x_min, x_max, y_min, y_max in (horizontal_list[0] if horizontal_list else []):
+        grow_x, grow_y = (x_max - x_min) * margin, (y_max - y_min) * margin
+        boxes.append((max(0, x_min - grow_x), max(0, y_min - grow_y),
+                      min(width, x_max + grow_x), min(height, y_max + grow_y)))
+    return boxes
+
+
+def find_candidate_boxes(image, reader=None, settings=PROMPTED_SETTINGS):
+    """
+    Proposes box prompts for the games on a shelf image without running SAM.
+
+    Candidates come from text regions (strongest evidence of a game), spine
+    columns between vertical edges within each shelf band, and closed edge
+    contours. They are filtered by size and deduplicated with non-maximum
+    suppression in that order of preference.
+
+    Args:
+        image (numpy.ndarray): BGR image at working resolution
+        reader (easyocr.Reader): EasyOCR reader for text regions; skipped if None
+        settings (dict): See PROMPTED_SETTINGS
+
+    Returns:
+        numpy.ndarray: XYXY boxes of shape (n, 4), at most settings["max_prompts"]
+    """
+    height, width = image.shape[:2]
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    edges = cv2.Canny(cv2.GaussianBlur(gray, (5, 5), 0), 50, 150)
+
+    text_boxes = find_text_boxes(reader, image, settings["text_box_margin"]) if reader is not None else []
+    spine_boxes = []
+    for band in find_shelf_bands(edges, settings["shelf_line_fraction"], settings["min_band_height"]):
+        spine_boxes.extend(find_spines(gray, band, settings["min_spine_width"]))
+    contour_boxes = find_contour_boxes(edges)
+
+    max_area = settings["max_box_fraction"] * height * width
+    kept = []
+    for source in (text_boxes, spine_boxes, contour_boxes):
+        boxes = np.array(source, dtype=np.float32).reshape(-1, 4)
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        in_range = (areas >= settings["min_box_area"]) & (areas <= max_area)
+        boxes, areas = boxes[in_range], areas[in_range]
+        # Larger boxes first within a source, so a box wins over its fragments
+        for box in boxes[np.argsort(-areas, kind='stable')]:
+            if len(kept) >= settings["max_prompts"]:
+                break
+            if kept and box_iou(box, np.array(kept)).max() > settings["box_nms_thresh"]:
+                continue
+            kept.append(box)
+
+    return np.array(kept, dtype=np.float32).reshape(-1, 4)
+
+
+def segment_with_box_prompts(predictor, image, boxes, settings=PROMPTED_SETTINGS):
+    """
+    Segments the image with one encoder pass and batched box prompts.
+
+    Args:
+        predictor (segment_anything.SamPredictor): Predictor (e.g. a caching predictor)
+        image (numpy.ndarray): Image at working resolution, in the same channel
+            order the automatic mask generator is given
+        boxes (numpy.ndarray): XYXY boxes of shape (n, 4) in image coordinates
+        settings (dict): See PROMPTED_SETTINGS
+
+    Returns:
+        list: Mask records in the format of SamAutomaticMaskGenerator (segmentation
+            as a mask_store.CompactMask, area, bbox as XYWH, predicted_iou, stability_score)
+    """
+    if len(boxes) == 0:
+        return []
+
+    predictor.set_image(image)
+    mask_threshold = predictor.model.mask_threshold
+
+    masks = []
+    batch_size = settings["prompt_batch_size"]
+    for start in range(0, len(boxes), batch_size):
+        batch = torch.as_tensor(boxes[start:start + batch_size], device=predictor.device)
+        with torch.no_grad():
+            logits, iou_predictions, _ = predictor.predict_torch(
+                point_coords=None,
+                point_labels=None,
+                boxes=predictor.transform.apply_boxes_torch(batch, image.shape[:2]),
+                multimask_output=False,
+                return_logits=True
+            )
+            logits, iou_predictions = logits[:, 0], iou_predictions[:, 0]
+            stability_scores = calculate_stability_score(logits, mask_threshold, 1.0)
+
+        segmentations = (logits > mask_threshold).cpu().numpy()
+        iou_predictions = iou_predictions.cpu().numpy()
+        stability_scores = stability_scores.cpu().numpy()
+
+        for segmentation, predicted_iou, stability_score in zip(segmentations, iou_predictions, stability_scores):
+            if predicted_iou < settings["pred_iou_thresh"] or stability_score < settings["stability_score_thresh"]:
+                continue
+            mask = CompactMask.from_mask(segmentation)
+            if mask.area == 0:
+                continue
+            y0, x0, height, width = mask.bbox
+            masks.append({
+                "segmentation": mask,
+                "area": mask.area,
+                "bbox": [x0, y0, width, height],
+                "predicted_iou": float(predicted_iou),
+                "stability_score": float(stability_score)
+            })
+
+    predictor.reset_image()
+    return masks
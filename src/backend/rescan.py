@@ -0,0 +1,159 @@
+import numpy as np # type: ignore
+import cv2 # type: ignore
+
+# Settings for rescanning a shelf that was processed before (pixel values at working resolution)
+RESCAN_SETTINGS = {
+    "max_features": 4000,            # ORB keypoints per photo
+    "ratio_test": 0.75,              # Lowe's ratio test for feature matches
+    "min_inliers": 40,               # Fewer homography inliers means the photos show different scenes
+    "ransac_threshold": 4.0,         # Reprojection error of a homography inlier
+    "diff_threshold": 45,            # Gray level difference from which a pixel counts as changed
+    "min_region_area": 2000,         # Smaller changed regions are noise
+    "region_margin": 24,             # Changed regions are grown by this much before segmenting
+    "max_regions": 6,                # More changed regions than this -> process the whole photo
+    "max_changed_fraction": 0.5,     # More of the photo changed than this -> process the whole photo
+    "max_segment_change": 0.15,      # Stored segments with more changed pixels than this are redone
+    "min_visible_fraction": 0.8,     # Stored segments must stay this visible in the new photo
+    "min_new_mask_change": 0.3,      # New masks must mostly cover changed pixels
+    "max_carried_overlap": 0.5       # New masks overlapping carried-over segments more than this are dropped
+}
+
+
+class RescanNotPossible(Exception):
+    """Raised when a photo cannot be processed incrementally against the previous one."""
+
+
+def align_images(previous, current, settings=RESCAN_SETTINGS):
+    """
+    Estimates the homography that maps the previous photo onto the current one
+    from matched ORB features.
+
+    Args:
+        previous (numpy.ndarray): BGR image of the previous scan
+        current (numpy.ndarray): BGR image of the new photo
+        settings (dict): See RESCAN_SETTINGS
+
+    Returns:
+        tuple: (homography, inliers) where homography is a 3x3 matrix, or None if
+            the photos could not be aligned, and inliers the number of matches
+            supporting it
+    """
+    orb = cv2.ORB_create(nfeatures=settings["max_features"])
+    previous_keypoints, previous_descriptors = orb.detectAndCompute(cv2.cvtColor(previous, cv2.COLOR_BGR2GRAY), None)
+    current_keypoints, current_descriptors = orb.detectAndCompute(cv2.cvtColor(current, cv2.COLOR_BGR2GRAY), None)
+    if previous_descriptors is None or current_descriptors is None:
+        return None, 0
+
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+    matches = [pair[0] for pair in matcher.knnMatch(previous_descriptors, current_descriptors, k=2)
+               if len(pair) == 2 and pair[0].distance < settings["ratio_test"] * pair[1].distance]
+    if len(matches) < settings["min_inliers"]:
+        return None, len(matches)
+
+    source = np.float32([previous_keypoints[match.queryIdx].pt for match in matches]).reshape(-1, 1, 2)
+    target = np.float32([current_keypoints[match.trainIdx].pt for match in matches]).reshape(-1, 1, 2)
+    homography, inlier_mask = cv2.findHomography(source, target, cv2.RANSAC, settings["ransac_threshold"])
+    inliers = int(inlier_mask.sum()) if inlier_mask is not None else 0
+    if homography is None or inliers < settings["min_inliers"]:
+        return None, inliers
+
+    # Reject mirrored or wildly rescaled fits
+    scale = np.linalg.det(homography[:2, :2])
+    if not 0.25 < scale < 4:
+        return None, inliers
+    return homography, inliers
+
+
+def warp_mask(mask, homography, shape):
+    """
+    Maps a mask of the previous photo into the frame of the current one.
+
+    Args:
+        mask (numpy.ndarray): 2D boolean mask
+        homography (numpy.ndarray): 3x3 homography from align_images
+        shape (tuple): (height, width) of the current photo
+
+    Returns:
+        numpy.ndarray: 2D boolean mask of the given shape
+    """
+    warped = cv2.warpPerspective(mask.astype(np.uint8), homography, (shape[1], shape[0]), flags=cv2.INTER_NEAREST)
+    return warped > 0
+
+
+def _normalized_gray(image, visible):
+    gray = cv2.GaussianBlur(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (5, 5), 0).astype(np.float32)
+    values = gray[visible]
+    return (gray - values.mean()) / max(float(values.std()), 1.0)
+
+
+def find_changes(previous, current, homography, settings=RESCAN_SETTINGS):
+    """
+    Finds the pixels of the current photo that differ from the aligned previous
+    one. Brightness and contrast are equalized first, so a change in lighting
+    between the photos is not reported as a change. Parts of the current
+    photo that the previous one did not show count as changed.
+
+    Args:
+        previous (numpy.ndarray): BGR image of the previous scan
+        current (numpy.ndarray): BGR image of the new photo
+        homography (numpy.ndarray): 3x3 homography from align_images
+        settings (dict): See RESCAN_SETTINGS
+
+    Returns:
+        numpy.ndarray: 2D boolean mask of changed pixels in the current photo
+    """
+    height, width = current.shape[:2]
+    warped = cv2.warpPerspective(previous, homography, (width, height))
+    visible = warp_mask(np.ones(previous.shape[:2], dtype=bool), homography, (height, width))
+    # Interpolated pixels along the border of the warped photo are unreliable
+    visible = cv2.erode(visible.astype(np.uint8), np.ones((5, 5), np.uint8)) > 0
+    if not visible.any():
+        return np.ones((height, width), dtype=bool)
+
+    # Compare in the current photo's gray level units
+    current_gray = cv2.GaussianBlur(cv2.cvtColor(current, cv2.COLOR_BGR2GRAY), (5, 5), 0).astype(np.float32)
+    spread = max(float(current_gray[visible].std()), 1.0)
+    difference = np.abs(_normalized_gray(warped, visible) - _normalized_gray(current, visible)) * spread
+
+    changed = ((difference > settings["diff_threshold"]) & visible).astype(np.uint8)
+    # Thin differences along edges come from small alignment errors
+    changed = cv2.morphologyEx(changed, cv2.MORPH_OPEN, np.ones((5, 5), np.uint8))
+    changed = cv2.morphologyEx(changed, cv2.MORPH_CLOSE, np.ones((15, 15), np.uint8))
+    return (changed > 0) | ~visible
+
+
+def find_changed_regions(changed, settings=RESCAN_SETTINGS):
+    """
+    Groups changed pixels into boxes to re-segment. Small regions are ignored,
+    the others are grown by a margin and overlapping boxes are merged.
+
+    Args:
+        changed (numpy.ndarray): 2D boolean mask of changed pixels
+        settings (dict): See RESCAN_SETTINGS
+
+    Returns:
+        list: XYXY boxes
+    """
+    height, width = changed.shape
+    margin = settings["region_margin"]
+    _, _, stats, _ = cv2.connectedComponentsWithStats(changed.astype(np.uint8), connectivity=8)
+
+    boxes = []
+    for x, y, w, h, area in stats[1:]:
+        if area >= settings["min_region_area"]:
+            boxes.append([max(0, x - margin), max(0, y - margin), min(width, x + w + margin), min(height, y + h + margin)])
+
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [tuple(int(v) for v in box) for box in boxes]
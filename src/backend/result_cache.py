@@ -0,0 +1,307 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np # type: ignore
+import torch # type: ignore
+from segment_anything import SamPredictor # type: ignore
+
+from disk_budget import DiskBudget
+from metrics import EMBEDDING_CACHE_LOOKUPS, STAGE_SECONDS, log
+
+# Bump whenever the segmentation/identification pipeline changes in a way that
+# makes previously stored results invalid (filters, OCR rules, prompts, ...)
+PIPELINE_VERSION = "2"
+
+EMBEDDING_CACHE_DIR = '/app/data/embeddings'
+# Disk budget of the embedding cache (roughly 4 MB per image), 0 for no limit
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get('EMBEDDING_CACHE_MAX_MB', '2048')) * 1024 * 1024
+
+
+def hash_image(image_data):
+    """
+    Computes the content hash used to recognize repeated uploads.
+
+    Args:
+        image_data (bytes): Raw image data in bytes
+
+    Returns:
+        str: Hex encoded SHA-256 digest of the image bytes
+    """
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def settings_key(settings):
+    """
+    Computes a stable key for a set of segmentation settings.
+
+    Args:
+        settings (dict): JSON serializable settings (generator parameters, thresholds, ...)
+
+    Returns:
+        str: Hex encoded SHA-256 digest of the canonical JSON form of the settings
+    """
+    canonical = json.dumps(settings, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def cache_version(checkpoint_path, precision="fp32"):
+    """
+    Builds the version tag stored with each cache entry. Entries written with
+    a different checkpoint, encoder precision or pipeline version are treated
+    as stale.
+
+    Args:
+        checkpoint_path (str): Path of the SAM checkpoint in use
+        precision (str): Precision of the SAM image encoder ("fp32", "int8", "bf16")
+
+    Returns:
+        str: Version tag
+    """
+    checkpoint = os.path.basename(checkpoint_path)
+    if precision != "fp32":
+        checkpoint = f"{checkpoint}-{precision}"
+    return f"{checkpoint}:{PIPELINE_VERSION}"
+
+
+def purge_stale_results(conn, version):
+    """
+    Deletes every cached result written by another checkpoint or pipeline version.
+
+    Args:
+        conn (sqlite3.Connection): Database connection
+        version (str): Current cache version
+
+    Returns:
+        int: Number of deleted entries
+    """
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM result_cache WHERE version != ?", (version,))
+    conn.commit()
+    return cursor.rowcount
+
+
+def get_cached_result(conn, image_hash, key, version):
+    """
+    Looks up the stored pipeline result for an image and settings combination.
+
+    Args:
+        conn (sqlite3.Connection): Database connection
+        image_hash (str): Content hash of the uploaded image
+        key (str): Segmentation settings key
+        version (str): Current cache version
+
+    Returns:
+        dict: The stored response payload, or None on a miss or a stale entry
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT version, result FROM result_cache
+        WHERE image_hash=? AND settings_key=?
+    """, (image_hash, key))
+    row = cursor.fetchone()
+
+    if not row:
+        return None
+
+    if row[0] != version:
+        # Written by another checkpoint or pipeline version
+        cursor.execute("DELETE FROM result_cache WHERE image_hash=? AND settings_key=?", (image_hash, key))
+        conn.commit()
+        return None
+
+    return json.loads(row[1])
+
+
+def store_result(conn, image_hash, key, version, image_id, result):
+    """
+    Stores the pipeline result for an image and settings combination.
+
+    Args:
+        conn (sqlite3.Connection): Database connection
+        image_hash (str): Content hash of the uploaded image
+        key (str): Segmentation settings key
+        version (str): Current cache version
+        image_id (int): ID of the stored image the result belongs to
+        result (dict): JSON serializable response payload
+    """
+    conn.execute("""
+        INSERT OR REPLACE INTO result_cache (image_hash, settings_key, version, image_id, result, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (image_hash, key, version, image_id, json.dumps(result), time.time()))
+    conn.commit()
+
+
+class EmbeddingCache:
+    """
+    Two-level cache (memory LRU + disk) for SAM image encoder outputs keyed by
+    the hash of the exact image fed to the encoder.
+
+    The disk level is held to max_disk_bytes, deleting the least recently used
+    files first. Files are written atomically, so concurrent readers (other
+    workers or processes) never load a partial entry.
+    """
+
+    def __init__(self, version, cache_dir=EMBEDDING_CACHE_DIR, max_memory_entries=16,
+                 max_disk_bytes=EMBEDDING_CACHE_MAX_BYTES):
+        self.version = version
+        self.cache_dir = cache_dir
+        self.max_memory_entries = max_memory_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk_budget = DiskBudget(cache_dir, max_disk_bytes, (".npz",))
+
+    def key(self, image):
+        """
+        Computes the cache key of an image array.
+
+        Args:
+            image (numpy.ndarray): HWC uint8 image passed to the predictor
+
+        Returns:
+            str: Hex encoded SHA-256 digest of version, shape and pixels
+        """
+        digest = hashlib.sha256()
+        digest.update(self.version.encode('utf-8'))
+        digest.update(str(image.shape).encode('utf-8'))
+        digest.update(np.ascontiguousarray(image).data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.npz")
+
+    def get(self, key):
+        """
+        Returns the cached (features, original_size, input_size) tuple or None.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                entry = (data['features'],
+                         tuple(int(v) for v in data['original_size']),
+                         tuple(int(v) for v in data['input_size']))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            log("Discarding unreadable embedding cache entry", path=path, error=str(e))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        self.disk_budget.touch(path)
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key, features, original_size, input_size):
+        """
+        Stores encoder features for an image in memory and on disk. A failed
+        write (e.g. a full disk) is logged and does not raise.
+        """
+        entry = (features, tuple(original_size), tuple(input_size))
+        self._remember(key, entry)
+
+        temp_path = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, features=features,
+                         original_size=np.array(original_size), input_size=np.array(input_size))
+                size = f.tell()
+            os.replace(temp_path, self._path(key))
+        except OSError as e:
+            log("Could not cache image embedding", error=str(e))
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+            return
+        self.disk_budget.add(size)
+
+    def _remember(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_memory_entries:
+                self.entries.popitem(last=False)
+
+
+class CachingSamPredictor(SamPredictor):
+    """
+    SamPredictor that skips the ViT image encoder when the embedding of the
+    same image is already in the embedding cache.
+    """
+
+    def __init__(self, sam_model, embedding_cache):
+        super().__init__(sam_model)
+        self.embedding_cache = embedding_cache
+
+    def set_image(self, image, image_format="RGB"):
+        key = self.embedding_cache.key(image) + image_format
+        cached = self.embedding_cache.get(key)
+
+        if cached is not None:
+            EMBEDDING_CACHE_LOOKUPS.inc(result="hit")
+            features, original_size, input_size = cached
+            self.reset_image()
+            self.original_size = original_size
+            self.input_size = input_size
+            self.features = torch.from_numpy(features).to(self.device)
+            self.is_image_set = True
+            return
+
+        EMBEDDING_CACHE_LOOKUPS.inc(result="miss")
+        with STAGE_SECONDS.time(stage="encoder"):
+            super().set_image(image, image_format)
+        self.embedding_cache.put(key, self.features.detach().cpu().numpy(), self.original_size, self.input_size)
+
+    def precompute(self, images, image_format="RGB", batch_size=4):
+        """
+        Runs the image encoder on several images at once and stores their
+        embeddings in the embedding cache, so the following set_image calls on
+        the same images are cache hits. Images already in the cache are skipped.
+
+        Every image is resized and padded to the encoder's square input, so
+        images of different sizes share one batch.
+
+        Args:
+            images (list): HWC uint8 images, as later passed to set_image
+            image_format (str): Channel order of the images, as passed to set_image
+            batch_size (int): Images per encoder pass
+
+        Returns:
+            int: Number of images that were encoded
+        """
+        pending = {}
+        for image in images:
+            key = self.embedding_cache.key(image) + image_format
+            if key not in pending and self.embedding_cache.get(key) is None:
+                pending[key] = image
+        pending = list(pending.items())
+
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            inputs, sizes = [], []
+            for _, image in batch:
+                if image_format != self.model.image_format:
+                    image = image[..., ::-1]
+                input_image = self.transform.apply_image(image)
+                input_torch = torch.as_tensor(input_image, device=self.device).permute(2, 0, 1).contiguous()
+                inputs.append(self.model.preprocess(input_torch[None, :, :, :]))
+                sizes.append((image.shape[:2], tuple(input_torch.shape[-2:])))
+
+            with STAGE_SECONDS.time(stage="encoder"), torch.no_grad():
+                features = self.model.image_encoder(torch.cat(inputs)).detach().cpu().numpy()
+            for (key, _), batch_features, (original_size, input_size) in zip(batch, features, sizes):
+                self.embedding_cache.put(key, batch_features[None], original_size, input_size)
+
+        return len(pending)
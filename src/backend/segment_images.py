@@ -0,0 +1,131 @@
+import base64
+import hashlib
+import os
+import tempfile
+
+import cv2 # type: ignore
+
+from disk_budget import DiskBudget
+from metrics import log
+
+# How segment images are delivered in responses: "full" inlines the full-frame
+# PNG of every segment, "thumbnail" a cropped, size-capped thumbnail plus the
+# URL of the full crop (/segments/{id}/image)
+IMAGE_MODES = ("full", "thumbnail")
+VARIANTS = ("crop", "thumbnail")
+
+SEGMENT_IMAGE_SETTINGS = {
+    "cache_dir": os.environ.get('SEGMENT_IMAGE_CACHE_DIR', '/app/data/segment_images'),
+    # Disk budget of the cache, least recently used images are deleted first (0 for no limit)
+    "max_bytes": int(os.environ.get('SEGMENT_IMAGE_CACHE_MAX_MB', '1024')) * 1024 * 1024,
+    "format": os.environ.get('SEGMENT_IMAGE_FORMAT', 'jpeg'),  # "jpeg" or "webp"
+    "thumbnail_size": int(os.environ.get('SEGMENT_THUMBNAIL_SIZE', '256')),  # Longest side
+    "thumbnail_quality": 75,
+    "crop_max_size": 1600,           # Longest side of full crops
+    "crop_quality": 90,
+    "cache_control": "private, max-age=604800, immutable"  # Segment images never change
+}
+
+_EXTENSIONS = {"jpeg": ".jpg", "webp": ".webp"}
+_QUALITY_FLAGS = {"jpeg": cv2.IMWRITE_JPEG_QUALITY, "webp": cv2.IMWRITE_WEBP_QUALITY}
+
+
+def media_type(image_format):
+    return f"image/{image_format}"
+
+
+def encode_image(image, image_format="jpeg", max_size=None, quality=90):
+    """
+    Encodes a BGR image as JPEG or WebP, downscaled to max_size if it is larger.
+
+    Args:
+        image (numpy.ndarray): BGR image
+        image_format (str): "jpeg" or "webp"
+        max_size (int): Longest side of the encoded image, or None to keep the size
+        quality (int): Encoder quality (0-100)
+
+    Returns:
+        bytes: Encoded image
+    """
+    height, width = image.shape[:2]
+    if max_size and max(height, width) > max_size:
+        scale = max_size / max(height, width)
+        image = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+    _, buffer = cv2.imencode(_EXTENSIONS[image_format], image, [_QUALITY_FLAGS[image_format], quality])
+    return buffer.tobytes()
+
+
+def etag(data):
+    return '"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+
+
+class SegmentImageCache:
+    """
+    Disk cache of encoded segment crops and thumbnails, keyed by segment id.
+
+    Segments are immutable once stored, so entries never need invalidating;
+    files are written atomically so concurrent readers never see partial images.
+    The cache is held to settings["max_bytes"]; evicted images are cut from the
+    stored masks again when requested.
+    """
+
+    def __init__(self, settings=SEGMENT_IMAGE_SETTINGS):
+        if settings["format"] not in _EXTENSIONS:
+            raise ValueError(f"Unknown SEGMENT_IMAGE_FORMAT '{settings['format']}', expected one of {tuple(_EXTENSIONS)}")
+        self.settings = settings
+        self.cache_dir = settings["cache_dir"]
+        self.image_format = settings["format"]
+        self.disk_budget = DiskBudget(self.cache_dir, settings.get("max_bytes", 0), tuple(_EXTENSIONS.values()))
+
+    def _path(self, segment_id, variant):
+        return os.path.join(self.cache_dir, f"{segment_id}-{variant}{_EXTENSIONS[self.image_format]}")
+
+    def get(self, segment_id, variant):
+        """
+        Returns the cached encoded image of a segment, or None on a miss.
+        """
+        path = self._path(segment_id, variant)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        self.disk_budget.touch(path)
+        return data
+
+    def put(self, segment_id, crop):
+        """
+        Encodes a segment crop and its thumbnail and stores both. A failed
+        write (e.g. a full disk) is logged and does not raise.
+
+        Args:
+            segment_id (int): Segment ID
+            crop (numpy.ndarray): BGR crop of the segment
+
+        Returns:
+            dict: Encoded image per variant
+        """
+        images = {
+            "crop": encode_image(crop, self.image_format, self.settings["crop_max_size"],
+                                 self.settings["crop_quality"]),
+            "thumbnail": encode_image(crop, self.image_format, self.settings["thumbnail_size"],
+                                      self.settings["thumbnail_quality"])
+        }
+
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            for variant, data in images.items():
+                fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, self._path(segment_id, variant))
+        except OSError as e:
+            # The images are still returned, they are just encoded again next time
+            log("Could not cache segment image", segment_id=segment_id, error=str(e))
+            return images
+        self.disk_budget.add(sum(len(data) for data in images.values()))
+        return images
+
+    def data_url(self, data):
+        return f"data:{media_type(self.image_format)};base64,{base64.b64encode(data).decode('utf-8')}"
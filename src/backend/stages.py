@@ -0,0 +1,177 @@
+import contextvars
+import queue
+import threading
+
+_CLOSED = object()
+
+
+class Stage:
+    """
+    One stage of a streaming pipeline.
+
+    Worker threads take micro-batches of up to batch_size items from a bounded
+    inbox (whatever is waiting; a worker never holds items back for a fuller
+    batch), run fn on them and report every result on the shared events queue
+    as (name, "result", value). A failure is reported as (name, "error",
+    exception) and, once the inbox is closed and drained, the last worker
+    reports (name, "finished", None).
+
+    put() blocks while the inbox is full, so a slow stage holds back whatever
+    feeds it instead of letting work pile up in memory; likewise workers wait
+    while the events queue is full. Every wait ends when the stage is cancelled.
+    """
+
+    def __init__(self, name, fn, events, workers=1, batch_size=1, queue_size=16):
+        """
+        Args:
+            name (str): Stage name used in events and thread names
+            fn (callable): Called with a list of items, returns an iterable of results
+            events (queue.Queue): Queue the events of every stage go to
+            workers (int): Worker threads
+            batch_size (int): Most items per fn call
+            queue_size (int): Most items waiting in the inbox
+        """
+        self.name = name
+        self.fn = fn
+        self.events = events
+        self.batch_size = max(1, batch_size)
+        self.inbox = queue.Queue(maxsize=max(1, queue_size))
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.running = max(1, workers)
+
+        # Every worker runs in its own copy of the creator's context (trace ID)
+        self.threads = [
+            threading.Thread(target=contextvars.copy_context().run, args=(self._work,),
+                             name=f"{name}-{index}", daemon=True)
+            for index in range(self.running)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item, block=True):
+        """
+        Adds an item to the inbox, waiting while it is full.
+
+        Args:
+            item: Item to process
+            block (bool): If False, give up at once when the inbox is full
+
+        Returns:
+            bool: False if the item was not added (the stage was cancelled, or
+                the inbox is full and block is False)
+        """
+        if not block:
+            if self.cancelled.is_set():
+                return False
+            try:
+                self.inbox.put_nowait(item)
+                return True
+            except queue.Full:
+                return False
+        return _put(self.inbox, item, self.cancelled)
+
+    def close(self):
+        """
+        Tells the workers that no more items will come. Waits for room in the
+        inbox unless the stage is cancelled.
+
+        Returns:
+            bool: False if the stage was cancelled first
+        """
+        return self.put(_CLOSED)
+
+    def cancel(self):
+        """
+        Stops the stage: queued and later items are dropped without being processed.
+        """
+        self.cancelled.set()
+
+    def feed(self, items):
+        """
+        Puts the items into the inbox from a background thread, then closes it.
+
+        Args:
+            items (iterable): Items to process
+        """
+        def run():
+            try:
+                for item in items:
+                    if not self.put(item):
+                        return
+            except Exception as e:
+                self._emit("error", e)
+                return
+            self.close()
+
+        threading.Thread(target=contextvars.copy_context().run, args=(run,),
+                         name=f"{self.name}-feeder", daemon=True).start()
+
+    def _next_batch(self):
+        """
+        Returns the next micro-batch, or None once the inbox is closed or the
+        stage cancelled.
+        """
+        while True:
+            try:
+                item = self.inbox.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if self.cancelled.is_set():
+                    return None
+        if item is _CLOSED:
+            # Leave the marker for the other workers
+            self.inbox.put(_CLOSED)
+            return None
+        batch = [item]
+        while len(batch) < self.batch_size:
+            try:
+                item = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            if item is _CLOSED:
+                # Leave the marker for the next call (and the other workers)
+                self.inbox.put(_CLOSED)
+                break
+            batch.append(item)
+        return batch
+
+    def _work(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            if self.cancelled.is_set():
+                continue
+            try:
+                for result in self.fn(batch):
+                    if not self._emit("result", result):
+                        break
+            except Exception as e:
+                self._emit("error", e)
+
+        with self.lock:
+            self.running -= 1
+            last = self.running == 0
+        if last:
+            self._emit("finished", None)
+
+    def _emit(self, kind, value):
+        # Waits for room in the events queue; False if the stage was cancelled first
+        return _put(self.events, (self.name, kind, value), self.cancelled)
+
+
+def _put(target, item, cancelled):
+    """
+    Puts an item on a bounded queue, waiting while it is full until cancelled is set.
+
+    Returns:
+        bool: False if cancelled was set before the item could be added
+    """
+    while not cancelled.is_set():
+        try:
+            target.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
@@ -0,0 +1,217 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from AIAPI import AIAPI
+from metrics import API_RETRIES
+
+
+def single_answer(images):
+    return {"boardGame": {"name": f"Game {images[0]}"}}
+
+
+class MockOpenAI(ThreadingHTTPServer):
+    """
+    Threaded stand-in for the /v1/chat/completions endpoint.
+
+    Every request is answered by reply(images), which gets the image payloads
+    of the request (the base64 part of the data URLs) and returns the
+    structured content as a dict, a ("refusal", text) tuple, or "429".
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), MockHandler)
+        self.reply = single_answer
+        self.latency = 0.0
+        self.lock = threading.Lock()
+        self.requests = []          # Image payloads per request, in arrival order
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.rate_limited = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/v1"
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["content-length"])))
+        images = [part["image_url"]["url"].split(",", 1)[1]
+                  for message in body["messages"] if isinstance(message["content"], list)
+                  for part in message["content"] if part.get("type") == "image_url"]
+
+        with server.lock:
+            server.requests.append(images)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.latency * random.random())
+            reply = server.reply(images)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+        if reply == "429":
+            with server.lock:
+                server.rate_limited += 1
+            self._send(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                       {"retry-after-ms": "10", "retry-after": "0.01"})
+            return
+
+        if isinstance(reply, tuple):
+            message = {"role": "assistant", "content": None, "refusal": reply[1]}
+        else:
+            message = {"role": "assistant", "content": json.dumps(reply), "refusal": None}
+        self._send(200, {
+            "id": "chatcmpl-mock", "object": "chat.completion", "created": 0, "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop", "message": message}]
+        })
+
+    def _send(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def mock_openai(monkeypatch):
+    server = MockOpenAI()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("OPENAI_BASE_URL", server.url)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def new_ai(**kwargs):
+    # A fresh key gets a fresh pooled client pointed at the mock server
+    return AIAPI(api_key=f"test-{uuid.uuid4().hex}", **kwargs)
+
+
+def test_concurrent_requests_stay_within_the_in_flight_cap(mock_openai):
+    mock_openai.latency = 0.05
+    images = [f"img{index}" for index in range(24)]
+
+    results = dict(new_ai(concurrency=3).getAPIResponses(images, max_retries=3, initial_backoff=0.01))
+
+    assert len(results) == len(images)
+    assert mock_openai.max_in_flight <= 3
+    assert mock_openai.max_in_flight > 1
+
+
+def test_rate_limited_request_is_retried(mock_openai):
+    attempts = {}
+
+    def reply(images):
+        attempts[images[0]] = attempts.get(images[0], 0) + 1
+        return "429" if attempts[images[0]] == 1 else single_answer(images)
+
+    mock_openai.reply = reply
+    retries_before = API_RETRIES.values.get((), 0)
+
+    results = dict(new_ai(concurrency=2).getAPIResponses(["img0", "img1"], max_retries=3, initial_backoff=0.01))
+
+    assert mock_openai.rate_limited == 2
+    assert API_RETRIES.values.get((), 0) - retries_before == 2
+    assert {index: json.loads(response)["boardGame"]["name"] for index, response in results.items()} == \
+        {0: "Game img0", 1: "Game img1"}
+
+
+def test_results_map_back_to_input_order(mock_openai):
+    # Random latencies make the requests complete out of order
+    mock_openai.latency = 0.05
+    images = [f"img{index}" for index in range(16)]
+
+    results = list(new_ai(concurrency=8).getAPIResponses(images, max_retries=3, initial_backoff=0.01))
+
+    assert sorted(index for index, _ in results) == list(range(len(images)))
+    names = [json.loads(response)["boardGame"]["name"] for _, response in sorted(results)]
+    assert names == [f"Game {image}" for image in images]
+
+
+def batch_answer(images):
+    return {"boardGames": [{"image": number, "name": f"Game {image}"}
+                           for number, image in enumerate(images, start=1)]}
+
+
+def canned_batch_reply(first_answer):
+    """
+    Answers the first batched request with first_answer and every later
+    request correctly.
+    """
+    answered = []
+
+    def reply(images):
+        if len(images) == 1:
+            return single_answer(images)
+        if not answered:
+            answered.append(images)
+            return first_answer(images)
+        return batch_answer(images)
+
+    return reply
+
+
+def names(responses):
+    return [json.loads(response)["boardGame"]["name"] if response else None for response in responses]
+
+
+def test_incomplete_batch_answer_is_split_and_retried(mock_openai):
+    mock_openai.reply = canned_batch_reply(lambda images: {"boardGames": batch_answer(images)["boardGames"][:-1]})
+    images = [f"img{index}" for index in range(4)]
+
+    responses = new_ai().getBatchAPIResponse(images, max_retries=3, initial_backoff=0.01)
+
+    assert names(responses) == [f"Game {image}" for image in images]
+    assert [len(request) for request in mock_openai.requests] == [4, 2, 2]
+
+
+@pytest.mark.parametrize("bad_number", [1, 9], ids=["duplicate", "unknown"])
+def test_misnumbered_batch_answer_is_split_and_retried(mock_openai, bad_number):
+    def misnumbered(images):
+        answer = batch_answer(images)
+        answer["boardGames"][-1]["image"] = bad_number
+        return answer
+
+    mock_openai.reply = canned_batch_reply(misnumbered)
+    images = [f"img{index}" for index in range(4)]
+
+    responses = new_ai().getBatchAPIResponse(images, max_retries=3, initial_backoff=0.01)
+
+    assert names(responses) == [f"Game {image}" for image in images]
+    assert [len(request) for request in mock_openai.requests] == [4, 2, 2]
+
+
+def test_refused_batch_is_split_down_to_single_images(mock_openai):
+    # Every batch is refused, and so is the single image img2
+    def reply(images):
+        if len(images) > 1 or images == ["img2"]:
+            return ("refusal", "I can't help with that.")
+        return single_answer(images)
+
+    mock_openai.reply = reply
+    images = [f"img{index}" for index in range(4)]
+
+    results = list(new_ai(batch_size=4).getAPIResponses(images, max_retries=3, initial_backoff=0.01))
+
+    assert sorted(index for index, _ in results) == list(range(len(images)))
+    assert names(response for _, response in sorted(results)) == ["Game img0", "Game img1", None, "Game img3"]
+    assert sorted(len(request) for request in mock_openai.requests) == [1, 1, 1, 1, 2, 2, 4]
@@ -0,0 +1,54 @@
+import pytest
+
+from catalog import TitleCatalog
+
+
+TITLES = ["Players", "Risk", "Clue", "Strategy", "Catan", "Ticket to Ride",
+          "Ticket to Ride: Europe", "Pandemic", "Pandemic Legacy", "The Castles of Burgundy"]
+
+
+@pytest.fixture(scope="module")
+def catalog():
+    return TitleCatalog(TITLES)
+
+
+@pytest.mark.parametrize("text", [
+    "For 2-4 players ages 10+",
+    "asterisk",
+    "clueless",
+    "A family strategy game",
+    "Catan Trade Build Settle Kosmos 3-4 players",
+])
+def test_stray_box_text_does_not_match(catalog, text):
+    title, score = catalog.match(text)
+
+    assert title is None, (text, title, score)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("TICKET TO RIDE", "Ticket to Ride"),
+    ("Ticket to Ride EUROPE", "Ticket to Ride: Europe"),
+    ("CATAN", "Catan"),
+    ("Pandemic", "Pandemic"),
+    ("PANDEMIC LEGACY season 1", "Pandemic Legacy"),
+    ("the castles of burgundy", "The Castles of Burgundy"),
+    ("Pandémic!", "Pandemic"),
+])
+def test_title_text_matches(catalog, text, expected):
+    title, _ = catalog.match(text)
+
+    assert title == expected
+
+
+def test_every_title_word_must_be_a_whole_word(catalog):
+    # "ticket" and "ride" as substrings of other words share most trigrams
+    title, _ = catalog.match("tickets to rider")
+
+    assert title is None
+
+
+def test_short_titles_need_enough_shared_trigrams():
+    catalog = TitleCatalog(["Risk"], min_shared=5)
+
+    assert catalog.match("RISK") == (None, 1.0)
+    assert TitleCatalog(["Risk"], min_shared=4).match("RISK")[0] == "Risk"
@@ -0,0 +1,42 @@
+import os
+
+from disk_budget import DiskBudget
+
+
+def write(directory, name, size, mtime):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(b"x" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_least_recently_used_files_are_deleted_first(tmp_path):
+    directory = str(tmp_path)
+    budget = DiskBudget(directory, max_bytes=300, suffixes=(".npz",), low_water=0.7)
+    touched = write(directory, "a.npz", 100, 1000)
+    oldest = write(directory, "b.npz", 100, 2000)
+    middle = write(directory, "c.npz", 100, 3000)
+    unrelated = write(directory, "notes.txt", 500, 0)
+
+    budget.add(0)
+    assert budget.used == 300
+
+    # Reading a.npz makes it the most recently used file
+    budget.touch(touched)
+    newest = write(directory, "d.npz", 100, 4000)
+    budget.add(100)
+
+    # 400 bytes are over budget: delete down to 210, oldest first
+    assert not os.path.exists(oldest)
+    assert not os.path.exists(middle)
+    assert all(os.path.exists(path) for path in (touched, newest, unrelated))
+    assert budget.used == 200
+
+
+def test_no_limit_never_scans(tmp_path):
+    budget = DiskBudget(str(tmp_path), max_bytes=0, suffixes=(".npz",))
+    write(str(tmp_path), "a.npz", 100, 1000)
+    budget.add(100)
+    assert budget.used is None
+    assert os.path.exists(os.path.join(str(tmp_path), "a.npz"))
@@ -0,0 +1,77 @@
+import sqlite3
+
+import numpy as np # type: ignore
+import pytest
+
+from db import migrate
+from identification_cache import IdentificationCache
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "images.db")
+    conn = sqlite3.connect(path)
+    migrate(conn)
+    conn.close()
+    return path
+
+
+def crop(seed):
+    return (np.random.RandomState(seed).rand(64, 48, 3) * 255).astype(np.uint8)
+
+
+def count_reloads(cache):
+    reloads = []
+    original = cache._refresh
+
+    def refresh(conn):
+        version = cache._version
+        original(conn)
+        if cache._version is not version:
+            reloads.append(version)
+
+    cache._refresh = refresh
+    return reloads
+
+
+def test_own_stores_update_the_index_without_reloading(db_path):
+    conn = sqlite3.connect(db_path)
+    cache = IdentificationCache()
+    reloads = count_reloads(cache)
+    assert cache.lookup(conn, crop(0)) is None
+
+    for seed in range(5):
+        cache.store(conn, crop(seed), f"Game {seed}")
+        assert cache.lookup(conn, crop(seed)) == f"Game {seed}"
+
+    # Only the first lookup loaded the (empty) table
+    assert len(reloads) == 1
+    assert len(cache._ids) == 5
+
+
+def test_evicted_entries_leave_the_index(db_path):
+    conn = sqlite3.connect(db_path)
+    cache = IdentificationCache(max_entries=2)
+    cache.lookup(conn, crop(0))
+
+    for seed in range(4):
+        cache.store(conn, crop(seed), f"Game {seed}")
+
+    stored = [row[0] for row in conn.execute("SELECT id FROM identification_cache ORDER BY id")]
+    assert sorted(cache._ids.tolist()) == stored
+    assert cache.lookup(conn, crop(0)) is None
+    assert cache.lookup(conn, crop(3)) == "Game 3"
+
+
+def test_stores_of_another_worker_are_picked_up(db_path):
+    first, second = sqlite3.connect(db_path), sqlite3.connect(db_path)
+    cache, other_cache = IdentificationCache(), IdentificationCache()
+    cache.lookup(first, crop(0))
+
+    other_cache.store(second, crop(1), "Game 1")
+    # The other worker's entry makes this store fall back to a reload on the next lookup
+    cache.store(first, crop(2), "Game 2")
+
+    assert cache.lookup(first, crop(1)) == "Game 1"
+    assert cache.lookup(first, crop(2)) == "Game 2"
+    assert len(cache._ids) == 2
@@ -0,0 +1,59 @@
+import asyncio
+
+from jobs import JobQueue
+
+
+def run(queue, job):
+    return asyncio.run(queue.wait(job))
+
+
+def test_inline_jobs_are_dropped_once_finished():
+    queue = JobQueue(max_workers=1)
+    job = run(queue, queue.submit_inline(lambda: ({"segments": ["large"]}, 200)))
+
+    assert job.result == {"segments": ["large"]}
+    assert queue.get(job.id) is None
+    assert queue.jobs == {}
+    queue.shutdown()
+
+
+def test_expired_results_are_pruned_on_read():
+    queue = JobQueue(max_workers=1, result_ttl=3600)
+    job = run(queue, queue.submit(lambda: ({"ok": True}, 200)))
+    assert queue.get(job.id) is job
+
+    job.finished_at -= 7200
+    assert queue.get(job.id) is None
+    assert queue.depth == 0
+    queue.shutdown()
+
+
+def endless_events(produced, closed):
+    try:
+        while True:
+            produced.append(len(produced))
+            yield {"event": "progress", "count": len(produced)}
+    finally:
+        closed.append(True)
+
+
+def test_closing_the_stream_closes_the_generator():
+    queue = JobQueue(max_workers=1, stream_buffer=4)
+    produced, closed = [], []
+
+    async def read_two_and_disconnect():
+        job, events = queue.submit_stream(endless_events, produced, closed)
+        received = [await events.__anext__(), await events.__anext__()]
+        # Give the pipeline time to fill the buffer
+        await asyncio.sleep(0.2)
+        await events.aclose()
+        return await queue.wait(job), received
+
+    job, received = asyncio.run(read_two_and_disconnect())
+
+    assert [event["count"] for event in received] == [1, 2]
+    assert closed == [True]
+    # Two events read, four buffered and one waiting for room
+    assert len(produced) <= 2 + 4 + 1
+    assert job.status_code == 499
+    queue.shutdown()
@@ -0,0 +1,366 @@
+import numpy as np # type: ignore
+import pytest
+
+import mask_filters
+from mask_filters import (compute_mask_stats, filter_overlapping_masks, pairwise_intersections,
+                          remove_enveloped_masks)
+from mask_store import CompactMask
+
+# Deliberately not a multiple of 8, so packed rows end in a partial byte
+FRAME = (97, 131)
+
+
+def reference_filter_overlapping_masks(masks, overlap_threshold=0.3, containment_threshold=0.85):
+    """
+    The original per-pair loop over full-frame boolean masks that
+    filter_overlapping_masks replaced (its logic unchanged, comments dropped),
+    kept as the reference.
+    """
+    def calculate_iou(mask1, mask2):
+        intersection = np.logical_and(mask1, mask2).sum()
+        union = np.logical_or(mask1, mask2).sum()
+        if union == 0:
+            return 0
+        return intersection / union
+
+    sorted_masks = sorted(masks, key=lambda x: (-x.get('stability_score', 0.0), np.sum(x['segmentation'])))
+    masks_to_keep = []
+
+    for i, mask in enumerate(sorted_masks):
+        should_keep = True
+
+        current_mask = mask['segmentation']
+        current_area = np.sum(current_mask)
+        current_stability = mask.get('stability_score', 0.0)
+
+        current_indices = np.where(current_mask)
+        if len(current_indices[0]) == 0:
+            continue
+
+        current_y_min, current_y_max = np.min(current_indices[0]), np.max(current_indices[0])
+        current_x_min, current_x_max = np.min(current_indices[1]), np.max(current_indices[1])
+        current_height = current_y_max - current_y_min
+        current_width = current_x_max - current_x_min
+        current_aspect_ratio = current_width / current_height if current_height > 0 else 0
+
+        for kept_idx in masks_to_keep:
+            kept_mask = sorted_masks[kept_idx]['segmentation']
+            kept_stability = sorted_masks[kept_idx].get('stability_score', 0.0)
+
+            kept_indices = np.where(kept_mask)
+            kept_y_min, kept_y_max = np.min(kept_indices[0]), np.max(kept_indices[0])
+            kept_x_min, kept_x_max = np.min(kept_indices[1]), np.max(kept_indices[1])
+            kept_height = kept_y_max - kept_y_min
+            kept_width = kept_x_max - kept_x_min
+            kept_aspect_ratio = kept_width / kept_height if kept_height > 0 else 0
+            kept_area = np.sum(kept_mask)
+
+            overlap_region = np.logical_and(current_mask, kept_mask)
+            intersection = np.sum(overlap_region)
+            iou = calculate_iou(current_mask, kept_mask)
+
+            if intersection == 0:
+                continue
+
+            overlap_indices = np.where(overlap_region)
+            overlap_y_min, overlap_y_max = np.min(overlap_indices[0]), np.max(overlap_indices[0])
+            overlap_height = overlap_y_max - overlap_y_min
+            overlap_width = overlap_indices[1].max() - overlap_indices[1].min()
+
+            current_top_overlap = current_bottom_overlap = kept_top_overlap = kept_bottom_overlap = 0
+            current_left_overlap = current_right_overlap = kept_left_overlap = kept_right_overlap = 0
+            total_vertical_overlap = total_horizontal_overlap = 0
+            max_vertical_overlap = max_side_overlap = 0
+
+            if overlap_height >= 5:
+                current_top_overlap = max(0, current_y_min + current_height/4 - overlap_y_min) / overlap_height
+                current_bottom_overlap = max(0, overlap_y_max - (current_y_max - current_height/4)) / overlap_height
+                kept_top_overlap = max(0, kept_y_min + kept_height/4 - overlap_y_min) / overlap_height
+                kept_bottom_overlap = max(0, overlap_y_max - (kept_y_max - kept_height/4)) / overlap_height
+                total_vertical_overlap = current_top_overlap + current_bottom_overlap + kept_top_overlap + kept_bottom_overlap
+                max_vertical_overlap = max(current_top_overlap, current_bottom_overlap, kept_top_overlap, kept_bottom_overlap)
+
+            if overlap_width >= 5:
+                current_left_overlap = max(0, current_x_min + current_width/4 - overlap_indices[1].min()) / overlap_width
+                current_right_overlap = max(0, overlap_indices[1].max() - (current_x_max - current_width/4)) / overlap_width
+                kept_left_overlap = max(0, kept_x_min + kept_width/4 - overlap_indices[1].min()) / overlap_width
+                kept_right_overlap = max(0, overlap_indices[1].max() - (kept_x_max - kept_width/4)) / overlap_width
+                total_horizontal_overlap = current_left_overlap + current_right_overlap + kept_left_overlap + kept_right_overlap
+                max_side_overlap = max(current_left_overlap, current_right_overlap, kept_left_overlap, kept_right_overlap)
+
+            horizontal_overlap = max(0, min(current_x_max, kept_x_max) - max(current_x_min, kept_x_min))
+            horizontal_overlap_ratio = horizontal_overlap / min(current_width, kept_width)
+
+            current_in_kept_ratio = intersection / current_area
+            kept_in_current_ratio = intersection / kept_area
+
+            horizontal_bias = (
+                (total_horizontal_overlap > total_vertical_overlap * 1.2 and
+                 max_side_overlap > 0.5) or
+                (max_side_overlap > 0.7 and
+                 max_side_overlap > max_vertical_overlap * 1.3 and
+                 abs(current_left_overlap - current_right_overlap) > 0.4)
+            )
+
+            box_overlap_x = min(current_x_max, kept_x_max) - max(current_x_min, kept_x_min)
+            box_overlap_y = min(current_y_max, kept_y_max) - max(current_y_min, kept_y_min)
+            box_overlap_area = box_overlap_x * box_overlap_y
+            box_union_area = (max(current_x_max, kept_x_max) - min(current_x_min, kept_x_min)) * \
+                            (max(current_y_max, kept_y_max) - min(current_y_min, kept_y_min))
+            box_iou = box_overlap_area / box_union_area if box_union_area > 0 else 0
+
+            center_x_diff = abs((current_x_min + current_x_max) / 2 - (kept_x_min + kept_x_max) / 2)
+            center_y_diff = abs((current_y_min + current_y_max) / 2 - (kept_y_min + kept_y_max) / 2)
+            max_dim = max(current_width, current_height, kept_width, kept_height)
+            centers_close = (center_x_diff < max_dim * 0.1 and center_y_diff < max_dim * 0.1)
+
+            if ((iou > 0.65 or current_in_kept_ratio > 0.65 or kept_in_current_ratio > 0.65) and
+                box_iou > 0.7 and centers_close):
+                should_keep = current_stability >= kept_stability
+                break
+
+            is_subsection = False
+            if (current_in_kept_ratio > containment_threshold and current_area < kept_area * 0.9) or \
+               (kept_in_current_ratio > containment_threshold and kept_area < current_area * 0.9):
+                if horizontal_bias:
+                    is_subsection = True
+                else:
+                    even_vertical_distribution = (
+                        abs(current_top_overlap - current_bottom_overlap) < 0.3 and
+                        abs(kept_top_overlap - kept_bottom_overlap) < 0.3
+                    )
+                    if even_vertical_distribution and \
+                       abs(current_left_overlap - current_right_overlap) < 0.3 and \
+                       abs(kept_left_overlap - kept_right_overlap) < 0.3:
+                        is_subsection = True
+
+            is_combined_segment = (
+                not is_subsection and
+                not horizontal_bias and
+                current_area > kept_area * 1.4 and
+                horizontal_overlap_ratio > 0.5 and
+                current_height > kept_height * 1.6 and
+                current_stability < kept_stability and
+                ((current_top_overlap > 0.6 and current_bottom_overlap > 0.6) or
+                 (kept_top_overlap > 0.6 and kept_bottom_overlap > 0.6))
+            )
+
+            is_stacked = False
+            if not is_subsection and not is_combined_segment:
+                size_ratio = min(current_area, kept_area) / max(current_area, kept_area)
+                width_ratio = min(current_width, kept_width) / max(current_width, kept_width)
+                is_stacked = (
+                    horizontal_overlap_ratio > 0.5 and
+                    abs(current_aspect_ratio - kept_aspect_ratio) < 0.4 and
+                    size_ratio > 0.6 and
+                    width_ratio > 0.7 and
+                    iou < overlap_threshold and
+                    ((current_top_overlap > 0.6 and current_bottom_overlap < 0.2) or
+                     (current_bottom_overlap > 0.6 and current_top_overlap < 0.2) or
+                     (kept_top_overlap > 0.6 and kept_bottom_overlap < 0.2) or
+                     (kept_bottom_overlap > 0.6 and kept_top_overlap < 0.2))
+                )
+
+            if is_combined_segment:
+                should_keep = False
+                break
+            elif is_subsection:
+                if current_area < kept_area:
+                    should_keep = False
+                    break
+            elif not is_stacked and iou > overlap_threshold:
+                if current_stability < kept_stability:
+                    should_keep = False
+                    break
+            elif is_stacked:
+                if iou > 0.8:
+                    should_keep = False
+                    break
+
+        if should_keep:
+            masks_to_keep.append(i)
+
+    return [sorted_masks[i] for i in masks_to_keep]
+
+
+def reference_remove_enveloped_masks(masks):
+    """
+    The original nested loop over full-frame boolean masks that
+    remove_enveloped_masks replaced, kept as the reference.
+    """
+    masks = list(masks)
+    masks.sort(key=lambda x: np.sum(x['segmentation']), reverse=True)
+    masks_to_remove = set()
+
+    for i in range(len(masks)):
+        if i in masks_to_remove:
+            continue
+        mask1 = masks[i]['segmentation']
+        area1 = np.sum(mask1)
+
+        for j in range(i + 1, len(masks)):
+            if j in masks_to_remove:
+                continue
+            mask2 = masks[j]['segmentation']
+            area2 = np.sum(mask2)
+
+            intersection = np.logical_and(mask1, mask2).sum()
+
+            if area1 > area2 * 1.5:
+                if intersection / area2 > 0.9:
+                    masks_to_remove.add(j)
+            elif area2 > area1 * 1.5:
+                if intersection / area1 > 0.9:
+                    masks_to_remove.add(i)
+                    break
+
+    return [mask for i, mask in enumerate(masks) if i not in masks_to_remove]
+
+def box(y0, y1, x0, x1, stability):
+    mask = np.zeros(FRAME, dtype=bool)
+    mask[y0:y1, x0:x1] = True
+    return {"name": f"{y0}:{y1},{x0}:{x1}", "segmentation": mask, "stability_score": stability}
+
+
+def kept_names(masks):
+    return [mask["name"] for mask in masks]
+
+
+def assert_same_decisions(masks):
+    expected = kept_names(reference_filter_overlapping_masks(masks))
+    assert kept_names(filter_overlapping_masks(masks)) == expected
+
+    # Compact inputs must give the same decisions as boolean ones
+    compact = [dict(mask, segmentation=CompactMask.from_mask(mask["segmentation"])) for mask in masks]
+    assert kept_names(filter_overlapping_masks(compact)) == expected
+    return expected
+
+
+SCENES = {
+    # The same box twice: only the more stable one is kept
+    "identical": ([box(10, 50, 10, 60, 0.95), box(11, 50, 10, 61, 0.90)], ["10:50,10:60"]),
+    # A less stable label inside a box: the label mask is dropped
+    "subsection": ([box(10, 80, 10, 60, 0.97), box(30, 50, 25, 45, 0.92)], ["10:80,10:60"]),
+    # Two stacked boxes and a less stable mask spanning both: the combined mask is
+    # dropped. (By the IoU rule: the combined-segment rule needs top and bottom
+    # overlap shares above 0.6 each, but for one overlap interval they add up to
+    # less than 1, so it never fires in either implementation.)
+    "combined": ([box(10, 40, 10, 60, 0.97), box(40, 70, 10, 60, 0.96), box(10, 70, 10, 60, 0.90)],
+                 ["10:40,10:60", "40:70,10:60"]),
+    # Two boxes stacked with a slight overlap: both are kept
+    "stacked": ([box(10, 40, 10, 60, 0.97), box(32, 62, 12, 62, 0.96)], ["10:40,10:60", "32:62,12:62"]),
+}
+
+
+@pytest.mark.parametrize("scene", SCENES.keys())
+def test_scene_matches_reference(scene):
+    masks, expected = SCENES[scene]
+    assert assert_same_decisions(masks) == expected
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_random_boxes_match_reference(seed):
+    rng = np.random.RandomState(seed)
+    masks = []
+    for _ in range(rng.randint(2, 12)):
+        y0, x0 = rng.randint(0, FRAME[0] - 10), rng.randint(0, FRAME[1] - 10)
+        y1, x1 = rng.randint(y0 + 6, FRAME[0] + 1), rng.randint(x0 + 6, FRAME[1] + 1)
+        masks.append(box(y0, y1, x0, x1, round(float(rng.uniform(0.85, 1.0)), 2)))
+    assert_same_decisions(masks)
+
+
+@pytest.mark.parametrize("stack_bytes", [1, 8 * 1024 * 1024], ids=["chunk-per-pair", "single-chunk"])
+def test_pairwise_intersections_match_full_frame_counts(monkeypatch, stack_bytes):
+    monkeypatch.setattr(mask_filters, "_STACK_BYTES", stack_bytes)
+    rng = np.random.RandomState(7)
+    masks = []
+    for _ in range(12):
+        # Ragged blobs, so windows differ in shape and hold partial bytes
+        y0, x0 = rng.randint(0, FRAME[0] - 20), rng.randint(0, FRAME[1] - 20)
+        mask = np.zeros(FRAME, dtype=bool)
+        mask[y0:y0 + rng.randint(5, 60), x0:x0 + rng.randint(5, 90)] = True
+        masks.append(mask & (rng.rand(*FRAME) < 0.7))
+    masks.append(np.zeros(FRAME, dtype=bool))
+
+    compact = [CompactMask.from_mask(mask) for mask in masks]
+    _, bboxes = compute_mask_stats(compact)
+    expected = np.array([[np.count_nonzero(first & second) for second in masks] for first in masks])
+    assert (pairwise_intersections(compact, bboxes) == expected).all()
+
+    # The overlap filter's intersection boxes come from the same stacks
+    for seed in range(10):
+        rng = np.random.RandomState(seed)
+        assert_same_decisions([box(y0, y0 + rng.randint(6, 50), x0, x0 + rng.randint(6, 70),
+                                   round(float(rng.uniform(0.85, 1.0)), 2))
+                               for y0, x0 in zip(rng.randint(0, FRAME[0] - 10, 8), rng.randint(0, FRAME[1] - 10, 8))])
+
+
+def random_envelope_scene(rng):
+    # Boxes nested in boxes (some only partly inside), ragged blobs, exact
+    # duplicates for area ties and the odd empty mask
+    masks = []
+    for _ in range(rng.randint(2, 14)):
+        kind = rng.randint(4)
+        if kind == 0 and masks:
+            outer = masks[rng.randint(len(masks))]["segmentation"]
+            ys, xs = np.nonzero(outer)
+            if len(ys) == 0:
+                continue
+            y0, x0 = rng.randint(ys.min(), ys.max() + 1), rng.randint(xs.min(), xs.max() + 1)
+            mask = np.zeros(FRAME, dtype=bool)
+            mask[y0:y0 + rng.randint(2, 30), x0:x0 + rng.randint(2, 40)] = True
+        elif kind == 1:
+            y0, x0 = rng.randint(0, FRAME[0] - 10), rng.randint(0, FRAME[1] - 10)
+            mask = np.zeros(FRAME, dtype=bool)
+            mask[y0:y0 + rng.randint(5, 60), x0:x0 + rng.randint(5, 90)] = True
+            mask &= rng.rand(*FRAME) < 0.8
+        elif kind == 2 and masks:
+            mask = masks[rng.randint(len(masks))]["segmentation"].copy()
+        elif rng.rand() < 0.1:
+            mask = np.zeros(FRAME, dtype=bool)
+        else:
+            y0, x0 = rng.randint(0, FRAME[0] - 10), rng.randint(0, FRAME[1] - 10)
+            mask = np.zeros(FRAME, dtype=bool)
+            mask[y0:rng.randint(y0 + 2, FRAME[0] + 1), x0:rng.randint(x0 + 2, FRAME[1] + 1)] = True
+        masks.append({"name": str(len(masks)), "segmentation": mask})
+    return masks
+
+
+def region(y0, y1, x0, x1, name):
+    mask = np.zeros(FRAME, dtype=bool)
+    mask[y0:y1, x0:x1] = True
+    return {"name": name, "segmentation": mask}
+
+
+ENVELOPE_SCENES = {
+    # Fully inside a box more than 1.5 times bigger: dropped
+    "enveloped": ([region(0, 20, 0, 20, "outer"), region(5, 15, 5, 15, "inner")], ["outer"]),
+    # Exactly 1.5 times bigger is not enough
+    "area-ratio-boundary": ([region(0, 15, 0, 20, "outer"), region(0, 10, 0, 20, "inner")], ["outer", "inner"]),
+    # Exactly 90% inside is not enough, just above is
+    "containment-boundary": ([region(0, 40, 0, 40, "outer"), region(31, 41, 0, 10, "inner")], ["outer", "inner"]),
+    "containment-above": ([region(0, 40, 0, 40, "outer"), region(30, 40, 0, 10, "inner")], ["outer"]),
+    # Nested three deep: the middle and the innermost go
+    "chain": ([region(0, 60, 0, 60, "outer"), region(10, 40, 10, 40, "middle"), region(20, 25, 20, 25, "inner")],
+              ["outer"]),
+    # Identical masks never envelop each other
+    "duplicates": ([region(0, 20, 0, 20, "first"), region(0, 20, 0, 20, "second")], ["first", "second"]),
+}
+
+
+@pytest.mark.parametrize("scene", ENVELOPE_SCENES.keys())
+def test_envelope_scene_matches_reference(scene):
+    masks, expected = ENVELOPE_SCENES[scene]
+    assert kept_names(reference_remove_enveloped_masks(masks)) == expected
+    assert kept_names(remove_enveloped_masks(masks)) == expected
+
+@pytest.mark.parametrize("seed", range(60))
+def test_remove_enveloped_masks_matches_reference(seed):
+    masks = random_envelope_scene(np.random.RandomState(seed))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = kept_names(reference_remove_enveloped_masks(masks))
+    assert kept_names(remove_enveloped_masks(masks)) == expected
+
+    # Compact inputs must give the same result as boolean ones
+    compact = [dict(mask, segmentation=CompactMask.from_mask(mask["segmentation"])) for mask in masks]
+    assert kept_names(remove_enveloped_masks(compact)) == expected
@@ -0,0 +1,27 @@
+import queue
+import threading
+import time
+
+from stages import Stage
+
+
+def test_cancel_releases_workers_blocked_on_a_full_events_queue():
+    events = queue.Queue(maxsize=1)
+    stage = Stage("double", lambda batch: [item * 2 for item in batch], events, workers=2, queue_size=2)
+    stage.feed(range(100))
+    time.sleep(0.2)
+
+    stage.cancel()
+    for thread in stage.threads:
+        thread.join(timeout=1)
+
+    assert not any(thread.is_alive() for thread in stage.threads)
+    assert not any(thread.name == "double-feeder" for thread in threading.enumerate())
+
+
+def test_close_gives_up_once_cancelled():
+    stage = Stage("idle", lambda batch: batch, queue.Queue(), workers=1, queue_size=1)
+    stage.cancel()
+    # The inbox is full and nobody drains it: close must not block
+    stage.inbox.put_nowait("item")
+    assert stage.close() is False
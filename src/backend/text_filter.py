@@ -0,0 +1,132 @@
+import numpy as np # type: ignore
+import cv2 # type: ignore
+
+from metrics import OCR_PASSES
+
+# OCR modes: "recognize" runs the EasyOCR detector and recognizer and keeps
+# segments with recognized text, "detect" only runs the detector and keeps
+# segments where any text region is found
+OCR_MODES = ("recognize", "detect")
+
+
+def crop_segment(image, mask_crop, mask_bbox, mask_shape):
+    """
+    Cuts the region of a segment out of the full-resolution image.
+
+    The mask may be at a lower (working) resolution than the image. Only the
+    pixels inside the mask's bounding box are sampled, so no full-frame mask or
+    canvas is built.
+
+    Args:
+        image (numpy.ndarray): Full-resolution BGR image
+        mask_crop (numpy.ndarray): 2D boolean mask cropped to its bounding box
+        mask_bbox (tuple): (y0, x0, height, width) of the crop in mask coordinates
+        mask_shape (tuple): (height, width) of the full mask
+
+    Returns:
+        tuple: (crop, box) where crop is the BGR crop with pixels outside the mask
+            blacked out and box is (y0, y1, x0, x1) in image coordinates (exclusive
+            ends), or (None, None) if the mask is empty
+    """
+    mask_y0, mask_x0, mask_crop_height, mask_crop_width = mask_bbox
+    if mask_crop_height == 0 or mask_crop_width == 0:
+        return None, None
+
+    height, width = image.shape[:2]
+    scale_y = height / mask_shape[0]
+    scale_x = width / mask_shape[1]
+
+    # Bounding box in mask coordinates, scaled out to image coordinates
+    mask_y1, mask_x1 = mask_y0 + mask_crop_height, mask_x0 + mask_crop_width
+    y0, y1 = int(np.floor(mask_y0 * scale_y)), min(height, int(np.ceil(mask_y1 * scale_y)))
+    x0, x1 = int(np.floor(mask_x0 * scale_x)), min(width, int(np.ceil(mask_x1 * scale_x)))
+
+    # Nearest-neighbour sampling of the mask for just the pixels of the crop
+    # (pixels that map to rows/columns outside the mask's bounding box are background)
+    source_rows = (np.arange(y0, y1) / scale_y).astype(np.int64)
+    source_cols = (np.arange(x0, x1) / scale_x).astype(np.int64)
+    valid_rows = (source_rows >= mask_y0) & (source_rows < mask_y1)
+    valid_cols = (source_cols >= mask_x0) & (source_cols < mask_x1)
+    sampled = mask_crop[np.ix_(np.clip(source_rows - mask_y0, 0, mask_crop_height - 1),
+                               np.clip(source_cols - mask_x0, 0, mask_crop_width - 1))]
+    sampled &= valid_rows[:, None] & valid_cols[None, :]
+
+    crop = image[y0:y1, x0:x1].copy()
+    crop[~sampled] = 0
+    return crop, (y0, y1, x0, x1)
+
+
+def letterbox(image, size):
+    """
+    Scales an image to fit a size x size canvas without distorting it and pads the rest with black.
+
+    Args:
+        image (numpy.ndarray): BGR image
+        size (int): Side of the square canvas
+
+    Returns:
+        numpy.ndarray: size x size BGR image
+    """
+    height, width = image.shape[:2]
+    scale = size / max(height, width)
+    new_width, new_height = max(1, round(width * scale)), max(1, round(height * scale))
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    resized = cv2.resize(image, (new_width, new_height), interpolation=interpolation)
+
+    canvas = np.zeros((size, size, 3), dtype=image.dtype)
+    canvas[:new_height, :new_width] = resized
+    return canvas
+
+
+def find_text_segments(reader, crops, mode="recognize", canvas_size=800, batch_size=16, with_text=False):
+    """
+    Checks which segment crops contain text, running EasyOCR on batches of crops.
+
+    Crops are letterboxed to a common canvas_size x canvas_size canvas so a whole
+    batch goes through the detector (and recognizer) in one call.
+
+    Args:
+        reader (easyocr.Reader): EasyOCR reader
+        crops (list): BGR segment crops
+        mode (str): "recognize" to require recognized text with a confidence above 0,
+            "detect" to only require a detected text region
+        canvas_size (int): Side of the square canvas crops are fitted into
+        batch_size (int): Number of crops per EasyOCR call
+        with_text (bool): Also return the recognized text of each crop
+
+    Returns:
+        list: One entry per crop: the OCR confidence of the first recognized text
+            (1.0 in detect mode) if the crop contains text, otherwise None. With
+            with_text, (confidence, text) tuples instead, where text joins every
+            recognized piece of text in reading order ("" in detect mode)
+    """
+    if mode not in OCR_MODES:
+        raise ValueError(f"Unknown OCR mode '{mode}', expected one of {OCR_MODES}")
+
+    results = []
+    for start in range(0, len(crops), batch_size):
+        batch = np.stack([letterbox(crop, canvas_size) for crop in crops[start:start + batch_size]])
+        OCR_PASSES.inc(mode=mode)
+
+        if mode == "detect":
+            horizontal_lists, free_lists = reader.detect(batch, reformat=False)
+            for horizontal, free in zip(horizontal_lists, free_lists):
+                confidence = 1.0 if (len(horizontal) > 0 or len(free) > 0) else None
+                results.append((confidence, "") if with_text else confidence)
+            continue
+
+        for items in reader.readtext_batched(batch):
+            confidence = None
+            texts = []
+            for item in items:
+                if isinstance(item, (tuple, list)) and len(item) == 3:  # Ensure valid tuple
+                    _, item_text, item_confidence = item
+                    if isinstance(item_confidence, (float, int)) and item_confidence > 0.0:
+                        if confidence is None:
+                            confidence = item_confidence
+                        if not with_text:
+                            break
+                        texts.append(str(item_text))
+            results.append((confidence, " ".join(texts)) if with_text else confidence)
+
+    return results